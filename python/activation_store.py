@@ -0,0 +1,356 @@
+"""
+An on-disk store for the responses of a layer to every image of the corpus,
+so that repeated analyses (re-ranking patches, the bottom-k, the response
+distribution of a unit, ...) read the responses instead of running the
+corpus through the network again.
+
+The responses are indexed by (image, unit, y, x) and stored as float16 in
+memory-mapped shard files of a fixed number of images. Each shard is laid out
+unit-major, (num_units, images_per_shard, height, width), so that all the
+responses of one unit within a shard are one contiguous read.
+
+Layout of a store directory:
+    meta.json           num_images, response_shape (C, H, W), dtype, images_per_shard
+    written.npy         bool mask of the images that have been written
+    acts_000.npy        images [0, images_per_shard)
+    acts_001.npy        images [images_per_shard, 2 * images_per_shard)
+    ...
+
+Example:
+    # In the main process
+    stores = create_activation_stores(model, {0: 'conv1.acts', 3: 'conv2.acts'},
+                                      num_images=50000, image_shape=(227, 227))
+    # In the workers (or the main process)
+    store_activations(model, stores, images, range(50000))
+    # Later
+    store = ActivationStore('conv2.acts')
+    responses = store.read_unit(17)           # (50000, 27, 27)
+    max_responses, max_spatial_indices = store.spatial_max(17)
+
+"""
+
+import os
+import json
+import shutil
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from image_store import ImageStore, NpyImageDirectory
+from model_utils import TruncationCache
+from patch_ranking import PatchRanker
+
+__all__ = ['ActivationStore', 'create_activation_stores', 'store_activations', 'rank_store']
+
+DTYPES = ('float16', 'float32')
+
+
+class ActivationStore:
+    """
+    The responses of a layer, with shape (num_images, num_units, height,
+    width). Values are read back as float32.
+    """
+    def __init__(self, path: str, mode: str = 'r'):
+        """
+        Opens an existing store (see create()).
+
+        Args:
+            path (str): The directory of the store.
+            mode (str): 'r' (read-only) or 'r+' (read and write).
+        """
+        if mode not in ('r', 'r+'):
+            raise ValueError(f'mode must be "r" or "r+", but got "{mode}"')
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.mode = mode
+        self.num_images = meta['num_images']
+        self.response_shape = tuple(meta['response_shape'])
+        self.dtype = meta['dtype']
+        self.images_per_shard = meta['images_per_shard']
+        self._written = np.load(os.path.join(path, 'written.npy'), mmap_mode=mode)
+        self._shards = {}
+
+    @classmethod
+    def create(cls, path: str, num_images: int, response_shape: Tuple[int, int, int],
+               dtype: str = 'float16', images_per_shard: int = 1000) -> 'ActivationStore':
+        """
+        Creates an empty store, replacing any existing store at path. All
+        shard files are allocated up front (as sparse files), so that workers
+        can write to them concurrently.
+
+        Args:
+            path (str): The directory of the store.
+            num_images (int): The number of images of the corpus.
+            response_shape (tuple of ints): The (num_units, height, width) of
+            the responses to one image.
+            dtype (str): 'float16' or 'float32'.
+            images_per_shard (int): The number of images per shard file.
+
+        Returns:
+            The store, opened in 'r+' mode.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f'dtype "{dtype}" not supported. Options: {DTYPES}')
+        num_units, height, width = response_shape
+        images_per_shard = max(1, min(images_per_shard, num_images))
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        for shard_index, img_start in enumerate(range(0, num_images, images_per_shard)):
+            img_stop = min(img_start + images_per_shard, num_images)
+            shard = np.lib.format.open_memmap(cls._shard_path(path, shard_index), mode='w+', dtype=dtype,
+                                              shape=(num_units, img_stop - img_start, height, width))
+            del shard
+        np.save(os.path.join(path, 'written.npy'), np.zeros(num_images, dtype=bool))
+        # The metadata is written last, so that a store without it is known
+        # to be incomplete.
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'num_images': num_images, 'response_shape': list(response_shape),
+                       'dtype': dtype, 'images_per_shard': images_per_shard}, f)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def _shard_path(path: str, shard_index: int) -> str:
+        return os.path.join(path, f"acts_{shard_index:03d}.npy")
+
+    def _get_shard(self, shard_index: int) -> np.memmap:
+        if shard_index not in self._shards:
+            self._shards[shard_index] = np.load(self._shard_path(self.path, shard_index),
+                                                mmap_mode=self.mode)
+        return self._shards[shard_index]
+
+    def _iter_shards(self, img_start: int, img_stop: int) -> Iterator[Tuple[int, np.memmap, int, int]]:
+        """Yields (img_index, shard, offset_start, offset_stop) of the images [img_start, img_stop)."""
+        img_index = img_start
+        while img_index < img_stop:
+            shard_index, offset = divmod(img_index, self.images_per_shard)
+            shard = self._get_shard(shard_index)
+            offset_stop = min(shard.shape[1], offset + img_stop - img_index)
+            yield img_index, shard, offset, offset_stop
+            img_index += offset_stop - offset
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (self.num_images, *self.response_shape)
+
+    @property
+    def num_units(self) -> int:
+        return self.response_shape[0]
+
+    def __len__(self) -> int:
+        return self.num_images
+
+    def is_written(self, img_index: int) -> bool:
+        """Whether the responses to the image have been written."""
+        return bool(self._written[img_index])
+
+    def write(self, img_start: int, responses: Union[np.ndarray, torch.Tensor]) -> None:
+        """
+        Writes the responses to the images [img_start, img_start +
+        len(responses)), with shape (num_images, num_units, height, width).
+
+        Raises:
+            ValueError: If a response is not finite in the dtype of the
+            store, e.g., if it exceeds the float16 range. Nothing is written.
+        """
+        if self.mode != 'r+':
+            raise RuntimeError("The store was opened read-only.")
+        if isinstance(responses, torch.Tensor):
+            responses = responses.detach().cpu().numpy()
+        if responses.shape[1:] != self.response_shape:
+            raise ValueError(f"The responses to an image must have shape {self.response_shape}, "
+                             f"but got {responses.shape[1:]}")
+        with np.errstate(over='ignore'):
+            responses = responses.astype(self.dtype, copy=False)
+        if not np.isfinite(responses).all():
+            raise ValueError(f"The responses to images {img_start}-{img_start + len(responses) - 1} "
+                             f"are not finite as {self.dtype} (the float16 range is +-65504). "
+                             f"Recreate the store with dtype='float32' (e.g., with STORE_DTYPE = "
+                             f"'float32' in make_activation_store.py).")
+        img_stop = img_start + len(responses)
+        for img_index, shard, offset_start, offset_stop in self._iter_shards(img_start, img_stop):
+            batch = responses[img_index - img_start:img_index - img_start + offset_stop - offset_start]
+            shard[:, offset_start:offset_stop] = batch.transpose(1, 0, 2, 3)
+        self._written[img_start:img_stop] = True
+
+    def read(self, img_start: int, img_stop: Optional[int] = None) -> np.ndarray:
+        """
+        Reads the responses to the images [img_start, img_stop) as float32,
+        with shape (num_images, num_units, height, width). If img_stop is
+        None, returns the responses to img_start only, with shape
+        response_shape.
+        """
+        if img_stop is None:
+            return self.read(img_start, img_start + 1)[0]
+        img_stop = min(img_stop, self.num_images)
+        responses = np.empty((max(0, img_stop - img_start), *self.response_shape), dtype=np.float32)
+        for img_index, shard, offset_start, offset_stop in self._iter_shards(img_start, img_stop):
+            responses[img_index - img_start:img_index - img_start + offset_stop - offset_start] = \
+                shard[:, offset_start:offset_stop].transpose(1, 0, 2, 3)
+        return responses
+
+    def read_unit(self, unit_index: int, img_start: int = 0,
+                  img_stop: Optional[int] = None) -> np.ndarray:
+        """
+        Reads the responses of one unit to the images [img_start, img_stop)
+        (defaults to all images) as float32, with shape (num_images, height,
+        width). Only the bytes of the unit are read.
+        """
+        img_stop = self.num_images if img_stop is None else min(img_stop, self.num_images)
+        responses = np.empty((max(0, img_stop - img_start), *self.response_shape[1:]), dtype=np.float32)
+        for img_index, shard, offset_start, offset_stop in self._iter_shards(img_start, img_stop):
+            responses[img_index - img_start:img_index - img_start + offset_stop - offset_start] = \
+                shard[unit_index, offset_start:offset_stop]
+        return responses
+
+    def get_response(self, img_index: int, unit_index: int, y: int, x: int) -> float:
+        """Returns the response of a unit to an image at the spatial location (y, x)."""
+        shard_index, offset = divmod(img_index, self.images_per_shard)
+        return float(self._get_shard(shard_index)[unit_index, offset, y, x])
+
+    def iter_chunks(self, chunk_size: Optional[int] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Iterates over the responses, chunk_size images at a time (defaults to
+        the shard size of the store). Yields (img_start, responses).
+        """
+        chunk_size = self.images_per_shard if chunk_size is None else chunk_size
+        for img_start in range(0, self.num_images, chunk_size):
+            yield img_start, self.read(img_start, img_start + chunk_size)
+
+    def spatial_max(self, unit_index: Optional[int] = None,
+                    largest: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reduces the responses over the spatial dimensions, one shard at a
+        time.
+
+        Args:
+            unit_index (int): The unit. Defaults to all units.
+            largest (bool): Whether to take the maximum (True) or the
+            minimum (False).
+
+        Returns:
+            responses: The maximum (or minimum) response of the unit to every
+            image, with shape (num_images,), or (num_images, num_units) for
+            all units.
+            spatial_indices: Where it is, as y * width + x, with the same shape.
+        """
+        reduce, arg_reduce = (np.max, np.argmax) if largest else (np.min, np.argmin)
+        units = slice(None) if unit_index is None else unit_index
+        shape = (self.num_images,) if unit_index is not None else (self.num_images, self.num_units)
+        responses = np.empty(shape, dtype=np.float32)
+        spatial_indices = np.empty(shape, dtype=np.int64)
+        for img_index, shard, offset_start, offset_stop in self._iter_shards(0, self.num_images):
+            # (num_units or 1, num_images, height * width) -> (num_images, num_units or 1)
+            chunk = np.asarray(shard[units, offset_start:offset_stop])
+            chunk = chunk.reshape(*chunk.shape[:-2], -1)
+            img_slice = slice(img_index, img_index + offset_stop - offset_start)
+            responses[img_slice] = reduce(chunk, axis=-1).T
+            spatial_indices[img_slice] = arg_reduce(chunk, axis=-1).T
+        return responses, spatial_indices
+
+    def flush(self) -> None:
+        """Writes the pending changes to disk."""
+        if self.mode == 'r+':
+            for shard in self._shards.values():
+                shard.flush()
+            self._written.flush()
+
+    def close(self) -> None:
+        """Flushes and unmaps the shards."""
+        self.flush()
+        self._shards = {}
+
+
+def create_activation_stores(model: Union[nn.Module, TruncationCache], store_paths: Dict[int, str],
+                             num_images: int, image_shape: Tuple[int, int],
+                             dtype: str = 'float16',
+                             images_per_shard: int = 1000) -> Dict[int, ActivationStore]:
+    """
+    Creates an empty store for each of several layers of a model.
+
+    Args:
+        model (nn.Module or TruncationCache): The neural network, or its
+        truncation cache.
+        store_paths (dict): {layer_index: the directory of its store}.
+        num_images (int): The number of images of the corpus.
+        image_shape (tuple of ints): The (height, width) of the images.
+        dtype, images_per_shard: See ActivationStore.create().
+
+    Returns:
+        {layer_index: ActivationStore}, opened in 'r+' mode.
+    """
+    truncations = model if isinstance(model, TruncationCache) else TruncationCache(model)
+    multi_output_model = truncations.get_multi_output(list(store_paths))
+    device = next(multi_output_model.parameters()).device
+    with torch.no_grad():
+        responses = multi_output_model(torch.zeros((1, 3, *image_shape), device=device))
+    return {layer_index: ActivationStore.create(path, num_images, tuple(responses[layer_index].shape[1:]),
+                                                dtype=dtype, images_per_shard=images_per_shard)
+            for layer_index, path in store_paths.items()}
+
+
+def store_activations(model: Union[nn.Module, TruncationCache], stores: Dict[int, ActivationStore],
+                      images: Union[ImageStore, NpyImageDirectory], img_indices: Sequence[int],
+                      batch_size: int = 64, device: Optional[Union[str, torch.device]] = None,
+                      skip_written: bool = True) -> None:
+    """
+    Runs the images through the model and writes the responses of several
+    layers, in one pass, to their stores. The responses to image i are
+    written to row i of the stores.
+
+    Args:
+        model (nn.Module or TruncationCache): The neural network, or its
+        truncation cache.
+        stores (dict): {layer_index: ActivationStore}, opened in 'r+' mode.
+        images: Where to read the images from (see
+        image_store.open_image_source()).
+        img_indices (list of int): The images. Runs of consecutive indices
+        are written in one go.
+        batch_size (int): The number of images per forward pass.
+        device (str or torch.device): The device of the model. Defaults to
+        the device of its parameters.
+        skip_written (bool): Whether to skip the images that all stores
+        already contain, e.g., to resume an interrupted run.
+    """
+    truncations = model if isinstance(model, TruncationCache) else TruncationCache(model)
+    multi_output_model = truncations.get_multi_output(list(stores))
+    if device is None:
+        device = next(multi_output_model.parameters()).device
+    img_indices = [img_index for img_index in img_indices
+                   if not (skip_written and all(store.is_written(img_index) for store in stores.values()))]
+
+    with torch.no_grad():
+        for batch_start in tqdm(range(0, len(img_indices), batch_size)):
+            batch_indices = img_indices[batch_start:batch_start + batch_size]
+            batch = np.stack([images.get_image(img_index) for img_index in batch_indices])
+            responses = multi_output_model(torch.from_numpy(batch.astype(np.float32, copy=False)).to(device))
+            for layer_index, store in stores.items():
+                layer_responses = responses[layer_index].cpu().numpy()
+                # Write every run of consecutive images at once
+                run_start = 0
+                for i in range(1, len(batch_indices) + 1):
+                    if i == len(batch_indices) or batch_indices[i] != batch_indices[i - 1] + 1:
+                        store.write(batch_indices[run_start], layer_responses[run_start:i])
+                        run_start = i
+    for store in stores.values():
+        store.flush()
+
+
+def rank_store(store: ActivationStore, k: int = 100,
+               chunk_size: Optional[int] = None) -> PatchRanker:
+    """
+    Ranks the image patches of all units from the stored responses, instead
+    of running the images through the model again (see patch_ranking.py).
+    Only chunk_size images are in memory at a time. With a float16 store,
+    responses that differ by less than the float16 precision may be ranked
+    in a different order than by patch_ranking.rank_images().
+    """
+    ranker = PatchRanker(store.num_units, k)
+    for img_start, responses in store.iter_chunks(chunk_size):
+        ranker.update(torch.from_numpy(responses), range(img_start, img_start + len(responses)))
+    return ranker
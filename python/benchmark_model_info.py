@@ -0,0 +1,70 @@
+"""
+Benchmarks the startup and per-call latency of ModelInfo, and compares the
+lookups with the boolean-mask scans of a pandas.DataFrame that ModelInfo used
+before (the same table, from ModelInfo.to_dataframe()).
+
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from model_utils import ModelInfo
+
+# Please specify the benchmark details here:
+MODEL_NAME = 'resnet18'
+NUM_CALLS = 10000  # number of calls per getter
+NUM_STARTUPS = 5  # number of fresh interpreters used to time the startup
+
+STARTUP_CODE = """
+import sys, time
+start_time = time.perf_counter()
+from model_utils import ModelInfo
+import_time = time.perf_counter() - start_time
+start_time = time.perf_counter()
+ModelInfo()
+print(import_time, time.perf_counter() - start_time, 'pandas' in sys.modules)
+"""
+
+
+def time_calls(fn, layer_names):
+    start_time = time.perf_counter()
+    for i in range(NUM_CALLS):
+        fn(layer_names[i % len(layer_names)])
+    return (time.perf_counter() - start_time) / NUM_CALLS
+
+
+if __name__ == '__main__':
+    import_times, load_times = [], []
+    for _ in range(NUM_STARTUPS):
+        output = subprocess.run([sys.executable, '-c', STARTUP_CODE], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.realpath(__file__))).stdout.split()
+        import_times.append(float(output[0]))
+        load_times.append(float(output[1]))
+        imports_pandas = output[2] == 'True'
+    print(f"Startup (best of {NUM_STARTUPS}): import model_utils {1000 * min(import_times):.1f} ms "
+          f"(mostly torch), ModelInfo() {1000 * min(load_times):.2f} ms, "
+          f"imports pandas: {imports_pandas}")
+
+    model_info = ModelInfo()
+    layer_names = model_info.get_layer_names(MODEL_NAME)
+    df = model_info.to_dataframe()
+
+    def pandas_get(column):
+        return lambda layer_name: df.loc[(df['model'] == MODEL_NAME) &
+                                         (df['layer'] == layer_name), column].iloc[0]
+
+    print(f"{'getter':>15} {'dict (us)':>10} {'pandas (us)':>12} {'speedup':>8}")
+    for column in ['layer_index', 'rf_size', 'xn', 'num_units']:
+        getter = getattr(model_info, f"get_{column}")
+        dict_time = time_calls(lambda layer_name: getter(MODEL_NAME, layer_name), layer_names)
+        pandas_time = time_calls(pandas_get(column), layer_names)
+        for layer_name in layer_names:
+            if getter(MODEL_NAME, layer_name) != pandas_get(column)(layer_name):
+                raise RuntimeError(f"get_{column}({MODEL_NAME}, {layer_name}) differs from pandas")
+        print(f"{'get_' + column:>15} {1e6 * dict_time:>10.2f} {1e6 * pandas_time:>12.2f} "
+              f"{pandas_time / dict_time:>7.0f}x")
+
+    table_time = time_calls(lambda _: model_info.get_layer_table(MODEL_NAME), layer_names)
+    print(f"get_layer_table: {1e6 * table_time:.2f} us for all {len(layer_names)} layers")
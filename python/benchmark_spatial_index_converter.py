@@ -0,0 +1,53 @@
+"""
+Benchmarks the memoized projection of SpatialIndexConverter against the
+original recursion, which follows every path of the graph separately, and
+checks that both give identical boxes.
+
+"""
+
+import time
+
+import torch.nn as nn
+from torchvision import models
+
+from spatial_utils import SpatialIndexConverter
+
+# Please specify the benchmark details here:
+MODEL_NAME = 'resnet18'
+IMAGE_SHAPE = (227, 227)
+NUM_INDICES = 5  # number of spatial indices converted per conv layer
+
+if __name__ == '__main__':
+    model = getattr(models, MODEL_NAME)()
+    converter = SpatialIndexConverter(model, IMAGE_SHAPE)
+
+    print(f"{'layer':>5} {'recursive (ms)':>15} {'memoized (ms)':>14} {'speedup':>8}")
+    total_recursive_time = total_memoized_time = 0.0
+    for layer_index, layer in enumerate(converter.layers):
+        if not isinstance(layer, nn.Conv2d):
+            continue
+        _, height, width = converter.output_sizes[layer_index]
+        indices = [(height * i // NUM_INDICES, width * i // NUM_INDICES) for i in range(NUM_INDICES)]
+        start_layer_name = converter.idx_to_node[layer_index]
+        end_layer_name = converter.idx_to_node[0]
+
+        start_time = time.perf_counter()
+        recursive_boxes = [converter._backward_convert_recursive(vx, hx, vx, hx, start_layer_name, end_layer_name)
+                           for vx, hx in indices]
+        recursive_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        memoized_boxes = [converter._backward_convert(vx, hx, vx, hx, start_layer_name, end_layer_name)
+                          for vx, hx in indices]
+        memoized_time = time.perf_counter() - start_time
+
+        if memoized_boxes != recursive_boxes:
+            raise RuntimeError(f"Layer {layer_index}: the memoized boxes {memoized_boxes} differ "
+                               f"from the recursive boxes {recursive_boxes}")
+        total_recursive_time += recursive_time
+        total_memoized_time += memoized_time
+        print(f"{layer_index:>5} {1000 * recursive_time:>15.2f} {1000 * memoized_time:>14.2f} "
+              f"{recursive_time / memoized_time:>7.1f}x")
+
+    print(f"Total: {1000 * total_recursive_time:.1f} ms (recursive) vs. "
+          f"{1000 * total_memoized_time:.1f} ms (memoized). All boxes are identical.")
@@ -0,0 +1,188 @@
+"""
+Utilities for compiling truncated models into faster modules. On CPU, the
+per-operation dispatch overhead of an eager GraphModule dominates the small
+gradient ascent steps of the early layers, so folding, fusing, and compiling
+the model pays off quickly.
+
+Example:
+    model = models.resnet18(pretrained=True)
+    compiled_model = get_compiled_model(model, 21, (49, 49), backend='torchscript')
+    ga = GradientAscent(compiled_model, unit_indices, img)
+
+"""
+
+import warnings
+from typing import Dict, Hashable, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn as nn
+from torch.fx.experimental.optimization import fuse
+
+from model_utils import TruncationCache, get_truncated_model
+from spatial_utils import CenterConeModel
+
+__all__ = ['CompiledModel', 'compile_truncated_model', 'get_compiled_model',
+           'check_compiled_model']
+
+BACKENDS = ('fuse', 'torchscript', 'inductor')
+
+# Compiled models, keyed by (model, layer_index, image_shape, options). The
+# model itself is stored alongside so that its id() cannot be reused.
+_COMPILED_MODEL_CACHE: Dict[Hashable, Tuple[nn.Module, nn.Module]] = {}
+
+
+class CompiledModel(nn.Module):
+    """
+    Wraps a compiled truncated model. Converts the input to the memory format
+    the model was compiled for, and keeps the "unit_indices" attribute of a
+    pruned model so that GradientAscent can find the channel of each unit.
+    """
+    def __init__(self, module: nn.Module, channels_last: bool,
+                 unit_indices: Optional[Sequence[int]] = None):
+        super().__init__()
+        self.module = module
+        self.channels_last = channels_last
+        self.unit_indices = unit_indices
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.module(x)
+
+
+def compile_truncated_model(truncated_model: nn.Module, image_shape: Tuple[int, int],
+                            backend: str = 'torchscript', center_cone: bool = False,
+                            channels_last: bool = True) -> CompiledModel:
+    """
+    Compiles a truncated model. All backends first fold every BatchNorm layer
+    into the conv layer before it.
+
+    Args:
+        truncated_model (nn.Module): The truncated model, as returned by
+        get_truncated_model().
+        image_shape (tuple of ints): The (height, width) of the input images.
+        backend (str): 'fuse' (only fold Conv+BN), 'torchscript' (trace and
+        freeze, which also lets TorchScript fuse Conv+ReLU), or 'inductor'
+        (torch.compile(), requires torch >= 2.0).
+        center_cone (bool): Whether to only compute the dependency cone of the
+        center unit (see spatial_utils.CenterConeModel). The compiled model
+        then only returns the center responses.
+        channels_last (bool): Whether to use the channels-last memory format,
+        which is faster for convolutions on CPU.
+
+    Returns:
+        The compiled model. The weights are copies (BatchNorm folding changes
+        them), so the model does not track later changes to truncated_model.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Backend "{backend}" not supported. Options: {BACKENDS}')
+    unit_indices = getattr(truncated_model, 'unit_indices', None)
+
+    model = fuse(truncated_model.eval())
+    if center_cone:
+        model = CenterConeModel(model, image_shape)
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if backend == 'torchscript':
+        example_input = torch.zeros((1, 3, *image_shape), device=next(model.parameters()).device)
+        if channels_last:
+            example_input = example_input.contiguous(memory_format=torch.channels_last)
+        with warnings.catch_warnings():
+            # The shape check of CenterConeModel is traced as a constant.
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            model = torch.jit.freeze(torch.jit.trace(model, example_input))
+    elif backend == 'inductor':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError(f"The 'inductor' backend requires torch >= 2.0, but got {torch.__version__}")
+        model = torch.compile(model)
+
+    return CompiledModel(model, channels_last, unit_indices)
+
+
+def get_compiled_model(model: Union[nn.Module, TruncationCache], layer_index: int,
+                       image_shape: Tuple[int, int], backend: str = 'torchscript',
+                       unit_indices: Optional[Sequence[int]] = None,
+                       center_cone: bool = False, channels_last: bool = True,
+                       model_name: Optional[str] = None, verify: bool = True) -> CompiledModel:
+    """
+    Returns the compiled truncated model of a layer. The compiled models are
+    cached per (model, layer_index, image_shape) and options, so that every
+    layer is only compiled once per process.
+
+    Args:
+        model (nn.Module or TruncationCache): The neural network, or its
+        truncation cache, which saves tracing the model for every layer.
+        layer_index (int): The index of the last layer of the truncated model.
+        image_shape (tuple of ints): The (height, width) of the input images.
+        backend, center_cone, channels_last: See compile_truncated_model().
+        unit_indices (list of int): If given, prune the last layer to these
+        units (see model_utils.prune_output_channels()).
+        model_name (str): Identifies the model in the cache. Defaults to the
+        id() of the model.
+        verify (bool): Whether to compare the compiled model against the eager
+        truncated model with check_compiled_model().
+
+    Returns:
+        The compiled model.
+    """
+    key = (model_name if model_name is not None else id(model), layer_index,
+           tuple(image_shape), backend,
+           tuple(unit_indices) if unit_indices is not None else None,
+           center_cone, channels_last)
+    if key in _COMPILED_MODEL_CACHE:
+        return _COMPILED_MODEL_CACHE[key][1]
+
+    if isinstance(model, TruncationCache):
+        truncated_model = model.get(layer_index, unit_indices)
+    else:
+        truncated_model = get_truncated_model(model, layer_index, unit_indices)
+    compiled_model = compile_truncated_model(truncated_model, image_shape, backend=backend,
+                                             center_cone=center_cone,
+                                             channels_last=channels_last)
+    if verify:
+        errors = check_compiled_model(truncated_model, compiled_model, image_shape)
+        if not errors['passed']:
+            raise RuntimeError(f"The compiled model of layer {layer_index} does not match "
+                               f"the eager model: {errors}")
+
+    _COMPILED_MODEL_CACHE[key] = (model, compiled_model)
+    return compiled_model
+
+
+def check_compiled_model(eager_model: nn.Module, compiled_model: nn.Module,
+                         image_shape: Tuple[int, int], num_images: int = 2,
+                         rtol: float = 1e-3, atol: float = 1e-4, seed: int = 0) -> Dict[str, float]:
+    """
+    Compares the center responses of a compiled model, and their gradients
+    with respect to the input, against the eager model on random images.
+    These are the quantities that gradient ascent depends on.
+
+    Returns:
+        {'response_error': max. absolute error of the responses,
+         'gradient_error': max. absolute error of the gradients,
+         'passed': whether both errors are within atol + rtol * max. value}
+    """
+    generator = torch.Generator().manual_seed(seed)
+    device = next(eager_model.parameters()).device
+    img = torch.randn((num_images, 3, *image_shape), generator=generator).to(device)
+
+    results = []
+    for model in (eager_model, compiled_model):
+        x = img.clone().requires_grad_(True)
+        responses = model(x)
+        _, _, ny, nx = responses.shape
+        center_responses = responses[:, :, ny//2, nx//2]
+        center_responses.sum().backward()
+        results.append((center_responses.detach(), x.grad.detach()))
+
+    (eager_responses, eager_grad), (compiled_responses, compiled_grad) = results
+    response_error = (eager_responses - compiled_responses).abs().max().item()
+    gradient_error = (eager_grad - compiled_grad).abs().max().item()
+    passed = (response_error <= atol + rtol * eager_responses.abs().max().item() and
+              gradient_error <= atol + rtol * eager_grad.abs().max().item())
+    return {'response_error': response_error, 'gradient_error': gradient_error,
+            'passed': passed}
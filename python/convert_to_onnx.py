@@ -9,7 +9,7 @@ import os
 import torch
 import torchvision.models as models
 
-from model_utils import get_truncated_model, ModelInfo
+from model_utils import TruncationCache, ModelInfo
 
 
 ######################## Define some helper functions #########################
@@ -20,13 +20,13 @@ def export_model(model_name: str, rf_data: ModelInfo, export_dir: str) -> None:
     model = model_func(pretrained=True)
     
     layer_names = rf_data.get_layer_names(model_name)
+    truncations = TruncationCache(model)  # traces the model only once
     
     for layer_name in layer_names:
         layer_index = rf_data.get_layer_index(model_name, layer_name)
         xn = rf_data.get_xn(model_name, layer_name)
 
-        truncated_model = get_truncated_model(model, layer_index)
-        truncated_model.eval()
+        truncated_model = truncations.get(layer_index)
 
         dummy_input = torch.zeros((1, 3, xn, xn))
         print(dummy_input.shape)
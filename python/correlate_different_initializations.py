@@ -8,15 +8,14 @@ Tony Fu, Bair Lab, March 2023
 
 import os
 
-import numpy as np
-from scipy.stats import pearsonr
-from tqdm import tqdm
-
 from model_utils import ModelInfo
+from result_store import open_layer_results
+from correlation_utils import correlate_layer_results, save_correlations
 
 # Please specify some details here:
 MODEL_NAME = "alexnet"
 OPTIMIZATION_METHOD = 'SGD'
+CHUNK_SIZE = 32  # number of units loaded into memory at a time
 
 # Locate the result directories
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -28,44 +27,29 @@ TOP_PATCH_INIT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results',
 # Set the output path
 OUTPUT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results',
                            OPTIMIZATION_METHOD, 'correlation')
-OUTPUT_PATH = os.path.join(OUTPUT_DIR, f"{MODEL_NAME}_zero_vs_top_patch.txt")
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
+OUTPUT_PATH = os.path.join(OUTPUT_DIR, f"{MODEL_NAME}_zero_vs_top_patch.npz")
 
 ########################### DON'T TOUCH CODE BELOW ############################
 
 # Load model and related information
 MODEL_INFO = ModelInfo()
-LAYER_NAMES = MODEL_INFO.get_layer_names(MODEL_NAME)
-
-##################### Define a few small helper functions #####################
-
-def crop_padding(img, padding):
-    """Removes the padding from the image."""
-    return img[padding:-padding, padding:-padding, :]
+LAYER_TABLE = MODEL_INFO.get_layer_table(MODEL_NAME)
 
 ###############################################################################
 
-with open(OUTPUT_PATH, "w") as f:
-    f.write(f"layer_name unit_index correlation\n")
-    
-    for layer_name in LAYER_NAMES:
-        # Determine layer-specific information
-        print(f"Computing correlation for {layer_name}...")
-        num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
-        xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
-        rf_size = MODEL_INFO.get_rf_size(MODEL_NAME, layer_name)
-        padding = (xn - rf_size) // 2
-        
-        # Load the result arrays of two different initializations
-        zero_init_layer_array = np.load(os.path.join(ZERO_INIT_DIR, layer_name, f"{layer_name}.npy"))
-        top_patch_init_layer_array = np.load(os.path.join(TOP_PATCH_INIT_DIR, layer_name, f"{layer_name}.npy"))
-        
-        for unit_index in tqdm(range(num_units)):
-            # Remove the surrounding zero padding
-            img1 = crop_padding(zero_init_layer_array[unit_index], padding)
-            img2 = crop_padding(top_patch_init_layer_array[unit_index], padding)
-
-            # Compute and record the Pearson correlation coefficient
-            correlation, _ = pearsonr(img1.flatten(), img2.flatten())
-            f.write(f"{layer_name} {unit_index} {correlation:.4f}\n")
+if __name__ == '__main__':
+    correlations = {}
+    for layer in LAYER_TABLE:
+        print(f"Computing correlation for {layer.layer}...")
+        padding = (layer.xn - layer.rf_size) // 2
+
+        # Open the results of two different initializations. They are read
+        # lazily, CHUNK_SIZE units at a time, and the correlations of a chunk
+        # are computed all at once.
+        zero_init_results = open_layer_results(os.path.join(ZERO_INIT_DIR, layer.layer), layer.layer)
+        top_patch_init_results = open_layer_results(os.path.join(TOP_PATCH_INIT_DIR, layer.layer), layer.layer)
+        correlations[layer.layer] = correlate_layer_results(zero_init_results, top_patch_init_results,
+                                                            padding, chunk_size=CHUNK_SIZE)
+
+    save_correlations(OUTPUT_PATH, correlations)
+    print(f"Saved the correlations to {OUTPUT_PATH}")
@@ -0,0 +1,286 @@
+"""
+Vectorized Pearson correlations between the per-unit results of two runs
+(e.g., zero- vs. top-patch-initialized gradient ascent). The correlations of
+a chunk of units are computed in one reduction over the stacked results,
+instead of one scipy.stats.pearsonr() call per unit.
+
+The correlations are saved in a columnar .npz file:
+    layer_names     the names of the layers
+    layer_codes     the layer of every row, as an index into layer_names
+    unit_indices    the unit of every row
+    correlations    the correlation coefficient of every row (float32)
+
+The all-pairs similarity of the units (every result of a layer against every
+other, or against every result of another run) is computed with blocked
+matrix multiplications of normalized results, within a memory budget, and
+saved as an .npz file with the full matrix and the most similar pairs.
+
+Example:
+    correlations = correlate_layer_results(zero_init_results, top_patch_init_results, padding)
+    save_correlations(path, {'conv1': correlations})
+    load_correlations(path)['conv1']
+
+    matrix = similarity_matrix(sgd_results, adam_results, padding)
+    save_similarity(path, matrix, top_similar_pairs(matrix, k=100))
+
+"""
+
+import os
+import tempfile
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from result_store import ResultStore
+
+__all__ = ['crop_padding', 'pearson_correlations', 'correlate_layer_results',
+           'save_correlations', 'load_correlations', 'normalize_rows',
+           'similarity_matrix', 'top_similar_pairs', 'save_similarity', 'load_similarity']
+
+
+def crop_padding(results: np.ndarray, padding: int) -> np.ndarray:
+    """
+    Removes the padding from results of shape (..., xn, xn, num_channels).
+    A padding of 0 returns the results unchanged.
+    """
+    height, width = results.shape[-3:-1]
+    return results[..., padding:height-padding, padding:width-padding, :]
+
+
+def pearson_correlations(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Returns the Pearson correlation coefficient of every pair (x[i], y[i]).
+
+    Args:
+        x, y (numpy.ndarray): Arrays of the same shape (num_units, ...).
+        Everything after the first dimension is flattened.
+
+    Returns:
+        The correlations, with shape (num_units,). Like pearsonr(), the
+        correlation is nan if x[i] or y[i] is constant.
+    """
+    if x.shape != y.shape:
+        raise ValueError(f"x and y must have the same shape, but got {x.shape} and {y.shape}")
+    x = normalize_rows(x, dtype=np.float64)
+    y = normalize_rows(y, dtype=np.float64)
+    return np.clip(np.einsum('ij,ij->i', x, y), -1.0, 1.0)
+
+
+def normalize_rows(x: np.ndarray, dtype: type = np.float32) -> np.ndarray:
+    """
+    Flattens x to (num_units, -1), and centers and scales every row to unit
+    norm, so that the dot product of two rows is their Pearson correlation.
+    Constant rows become nan.
+    """
+    x = x.reshape(len(x), -1).astype(dtype)
+    x -= x.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum('ij,ij->i', x, x))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x /= norms[:, None]
+    x[norms == 0] = np.nan
+    return x
+
+
+def correlate_layer_results(results1: Union[ResultStore, np.ndarray],
+                            results2: Union[ResultStore, np.ndarray], padding: int = 0,
+                            chunk_size: int = 32) -> np.ndarray:
+    """
+    Computes the correlations between the results of two runs, unit by unit.
+
+    Args:
+        results1, results2: The results of a layer, of shape (num_units, xn,
+        xn, 3), e.g., from result_store.open_layer_results(). They are read
+        lazily, chunk_size units at a time.
+        padding (int): The padding removed before correlating, i.e.,
+        (xn - rf_size) // 2.
+        chunk_size (int): The number of units loaded into memory at a time.
+
+    Returns:
+        The correlations, with shape (num_units,).
+    """
+    if len(results1) != len(results2):
+        raise ValueError(f"The results have {len(results1)} and {len(results2)} units")
+    correlations = np.empty(len(results1), dtype=np.float32)
+    for unit_start in range(0, len(results1), chunk_size):
+        chunk1 = crop_padding(results1[unit_start:unit_start + chunk_size], padding)
+        chunk2 = crop_padding(results2[unit_start:unit_start + chunk_size], padding)
+        correlations[unit_start:unit_start + len(chunk1)] = pearson_correlations(chunk1, chunk2)
+    return correlations
+
+
+def _save_npz(path: str, arrays: Dict[str, np.ndarray]) -> None:
+    # Write atomically, so that readers never see a partially written file.
+    output_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def save_correlations(path: str, correlations: Dict[str, np.ndarray],
+                      unit_indices: Optional[Dict[str, np.ndarray]] = None) -> None:
+    """
+    Saves the correlations of several layers as a columnar .npz file,
+    atomically.
+
+    Args:
+        path (str): The path of the file.
+        correlations (dict): {layer_name: correlations of its units}.
+        unit_indices (dict): {layer_name: the unit of every correlation}.
+        Defaults to 0, 1, 2, ... for every layer.
+    """
+    layer_names = list(correlations)
+    if unit_indices is None:
+        unit_indices = {layer_name: np.arange(len(correlations[layer_name]))
+                        for layer_name in layer_names}
+    columns = {
+        'layer_names': np.array(layer_names),
+        'layer_codes': np.concatenate([np.full(len(correlations[layer_name]), i, dtype=np.int32)
+                                       for i, layer_name in enumerate(layer_names)]),
+        'unit_indices': np.concatenate([np.asarray(unit_indices[layer_name], dtype=np.int64)
+                                        for layer_name in layer_names]),
+        'correlations': np.concatenate([np.asarray(correlations[layer_name], dtype=np.float32)
+                                        for layer_name in layer_names]),
+    }
+
+    _save_npz(path, columns)
+
+
+def load_correlations(path: str) -> Dict[str, np.ndarray]:
+    """
+    Loads a file saved by save_correlations().
+
+    Returns:
+        {layer_name: correlations of its units}, in the order of the file.
+    """
+    with np.load(path) as columns:
+        layer_codes = columns['layer_codes']
+        return {str(layer_name): columns['correlations'][layer_codes == i]
+                for i, layer_name in enumerate(columns['layer_names'])}
+
+
+def _iter_normalized_blocks(results: Union[ResultStore, np.ndarray], padding: int,
+                            block_size: int) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yields (unit_start, normalized results of the next block_size units)."""
+    for unit_start in range(0, len(results), block_size):
+        block = crop_padding(results[unit_start:unit_start + block_size], padding)
+        yield unit_start, normalize_rows(block)
+
+
+def similarity_matrix(results1: Union[ResultStore, np.ndarray],
+                      results2: Optional[Union[ResultStore, np.ndarray]] = None,
+                      padding: int = 0, max_bytes: int = 1024 ** 3) -> np.ndarray:
+    """
+    Computes the Pearson correlation of every unit of results1 with every
+    unit of results2 (or of results1 itself), with blocked matrix
+    multiplications.
+
+    The results are normalized once per block, so that every block of the
+    matrix is a single matrix multiplication. At most two blocks of units
+    are in memory at a time, and blocks are as large as max_bytes allows. If
+    results2 fits in half of the budget, it is only read once.
+
+    Args:
+        results1, results2: The results of a layer, of shape (num_units, xn,
+        xn, 3), e.g., from result_store.open_layer_results(). They are read
+        lazily. If results2 is None, results1 is compared with itself, and
+        only the upper half of the (symmetric) matrix is computed.
+        padding (int): The padding removed before correlating, i.e.,
+        (xn - rf_size) // 2.
+        max_bytes (int): The memory budget of the normalized blocks.
+
+    Returns:
+        The matrix of correlations, with shape (len(results1), len(results2)).
+        Units with a constant result have nan correlations.
+    """
+    symmetric = results2 is None
+    if symmetric:
+        results2 = results1
+    if results1.shape[1:] != results2.shape[1:]:
+        raise ValueError(f"The results have different shapes: {results1.shape} and {results2.shape}")
+    num_features = int(np.prod(crop_padding(results1[0:1], padding).shape[1:]))
+    block_size = max(1, max_bytes // (2 * num_features * np.dtype(np.float32).itemsize))
+
+    matrix = np.empty((len(results1), len(results2)), dtype=np.float32)
+    # Keep results2 in memory if it fits in its half of the budget
+    blocks2 = None
+    if len(results2) <= block_size and not symmetric:
+        blocks2 = list(_iter_normalized_blocks(results2, padding, block_size))
+
+    for start1, block1 in _iter_normalized_blocks(results1, padding, block_size):
+        stop1 = start1 + len(block1)
+        if symmetric:
+            # Only the blocks on and above the diagonal
+            matrix[start1:stop1, start1:stop1] = block1 @ block1.T
+            blocks = ((start2, normalize_rows(crop_padding(results2[start2:start2 + block_size], padding)))
+                      for start2 in range(stop1, len(results2), block_size))
+        else:
+            blocks = blocks2 if blocks2 is not None else _iter_normalized_blocks(results2, padding,
+                                                                                 block_size)
+        for start2, block2 in blocks:
+            matrix[start1:stop1, start2:start2 + len(block2)] = block1 @ block2.T
+
+    if symmetric:
+        upper = np.triu_indices(len(matrix), k=1)
+        matrix[upper[1], upper[0]] = matrix[upper]
+    return np.clip(matrix, -1.0, 1.0, out=matrix)
+
+
+def top_similar_pairs(matrix: np.ndarray, k: int = 100,
+                      symmetric: Optional[bool] = None) -> np.ndarray:
+    """
+    Returns the k most similar pairs of units of a similarity matrix.
+
+    Args:
+        matrix (numpy.ndarray): The matrix, from similarity_matrix().
+        k (int): The number of pairs.
+        symmetric (bool): Whether the matrix compares a run with itself, in
+        which case the diagonal and the pairs (j, i) of pairs (i, j) are
+        skipped. Defaults to whether the matrix is square and symmetric.
+
+    Returns:
+        A structured array with the fields unit_i, unit_j, and correlation,
+        most similar first.
+    """
+    if symmetric is None:
+        symmetric = matrix.shape[0] == matrix.shape[1] and np.array_equal(matrix, matrix.T,
+                                                                           equal_nan=True)
+    if symmetric:
+        rows, columns = np.triu_indices(len(matrix), k=1)
+    else:
+        rows, columns = np.indices(matrix.shape).reshape(2, -1)
+    values = matrix[rows, columns]
+    valid = ~np.isnan(values)
+    rows, columns, values = rows[valid], columns[valid], values[valid]
+
+    k = min(k, len(values))
+    top = np.argpartition(-values, k - 1)[:k] if k > 0 else np.array([], dtype=np.int64)
+    top = top[np.argsort(-values[top], kind='stable')]
+    pairs = np.empty(k, dtype=[('unit_i', np.int64), ('unit_j', np.int64), ('correlation', np.float32)])
+    pairs['unit_i'], pairs['unit_j'], pairs['correlation'] = rows[top], columns[top], values[top]
+    return pairs
+
+
+def save_similarity(path: str, matrix: np.ndarray, pairs: np.ndarray) -> None:
+    """
+    Saves a similarity matrix and its most similar pairs (see
+    top_similar_pairs()) as an .npz file with the arrays matrix, unit_i,
+    unit_j, and correlation, atomically.
+    """
+    _save_npz(path, {'matrix': matrix, 'unit_i': pairs['unit_i'],
+                     'unit_j': pairs['unit_j'], 'correlation': pairs['correlation']})
+
+
+def load_similarity(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Loads a file saved by save_similarity(). Returns (matrix, pairs)."""
+    with np.load(path) as arrays:
+        pairs = np.empty(len(arrays['unit_i']), dtype=[('unit_i', np.int64), ('unit_j', np.int64),
+                                                        ('correlation', np.float32)])
+        for field in ('unit_i', 'unit_j', 'correlation'):
+            pairs[field] = arrays[field]
+        return arrays['matrix'], pairs
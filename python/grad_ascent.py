@@ -1,61 +1,527 @@
+import numbers
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
 import torch
 import torch.optim as optim
 
-__all__ = ['GradientAscent']
+__all__ = ['GradientAscent', 'UnitStats', 'find_dead_units', 'run_gradient_ascent',
+           'precision_fidelity_report']
+
+# Scale of the random noise added to the starting image of a "dead" unit when
+# it is restarted (see run_gradient_ascent()).
+DEAD_UNIT_RESTART_NOISE = 1e-3
+
+
+class UnitStats:
+    """
+    Per-unit statistics of a gradient ascent run.
+
+    Attributes:
+        unit_index: The index of the unit.
+        responses: The response of the unit before each step.
+        grad_norms: The norm of the gradient of each step. Only recorded if
+            GradientAscent was created with record_norms=True or a grad_tol.
+        step_sizes: The norm of the change of the image in each step. Only
+            recorded if GradientAscent was created with record_norms=True.
+        status: 'running', 'converged' (a stopping criterion was met),
+            'max_iter' (the maximum number of steps was reached), or 'dead'
+            (the gradient at the starting image is exactly zero, so the unit
+            was skipped; see find_dead_units()).
+    """
+    def __init__(self, unit_index: int):
+        self.unit_index = unit_index
+        self.responses = []
+        self.grad_norms = []
+        self.step_sizes = []
+        self.status = 'running'
+
+    @property
+    def num_steps(self) -> int:
+        return len(self.responses)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status != 'running'
+
+    def __repr__(self) -> str:
+        response = self.responses[-1] if self.responses else None
+        return f"UnitStats(unit_index={self.unit_index}, status='{self.status}', "\
+               f"num_steps={self.num_steps}, response={response})"
 
 
 class GradientAscent:
-    def __init__(self, truncated_model: torch.nn.Module, unit_index: int, img: torch.Tensor,
-                 lr: float = 0.1, optimizer: str = 'SGD', momentum: bool = False):
+    def __init__(self, truncated_model: torch.nn.Module,
+                 unit_index: Union[int, Sequence[int]], img: torch.Tensor,
+                 lr: float = 0.1, optimizer: str = 'SGD', momentum: bool = False,
+                 max_iter: Optional[int] = None, rel_tol: Optional[float] = None,
+                 grad_tol: Optional[float] = None, precision: str = 'float32',
+                 record_norms: bool = False):
         """
         Performs gradient ascent on a given image to maximize the response of a specified unit in a neural network.
-        
+
+        If a list of unit indices is given instead of a single index, the units
+        are optimized together in a batch: img must then have one image per
+        unit, i.e., shape (num_units, 3, xn, xn), and every step advances all
+        units with a single forward/backward pass. Because the images do not
+        interact (the model is in eval mode), the result of each unit is the
+        same as optimizing it alone.
+
+        If the last layer of truncated_model has been pruned to a subset of
+        units (see model_utils.prune_output_channels()), the output channel of
+        each unit is looked up from the model's "unit_indices" attribute. The
+        model may keep more units than the ones being optimized.
+
+        The response of each unit (and, optionally, its gradient norm and step
+        size) is recorded in self.stats. A unit is marked as finished when it meets one of the
+        stopping criteria (all of them are disabled by default). Finished units
+        keep being optimized until they are removed or replaced with
+        remove_unit() or replace_unit(); see run_gradient_ascent().
+
         Args:
             truncated_model: The truncated neural network.
-            unit_index: The index of the unit of interest.
-            img: The starting image for optimization.
+            unit_index: The index of the unit of interest, or a list of unit
+                indices to optimize in a batch.
+            img: The starting image for optimization, or a batch of starting
+                images (one per unit).
             lr: The learning rate for the optimizer.
             optimizer: The optimizer to use. Options: 'SGD', 'Adam'.
             momentum: Whether to use momentum with the optimizer.
+            max_iter: The maximum number of steps of a unit.
+            rel_tol: A unit converges when the relative change of its response
+                between two steps is at most rel_tol.
+            grad_tol: A unit converges when the norm of its gradient is at most
+                grad_tol.
+            precision: The precision of the model's forward and backward
+                passes. Options: 'float32', 'bfloat16' (autocast; the image
+                itself stays in float32). Use precision_fidelity_report() to
+                check that bfloat16 does not change the results.
+            record_norms: Whether to record the gradient norm and the step
+                size of every step in self.stats. The gradient norms are also
+                computed when grad_tol is set. Both cost extra work per step.
         """
         self.model = truncated_model
-        self.unit_index = unit_index
-        self.img = img.requires_grad_(True)
+        self.is_batched = not isinstance(unit_index, numbers.Integral)
+        self.unit_indices = list(unit_index) if self.is_batched else [unit_index]
+        if img.shape[0] != len(self.unit_indices):
+            raise ValueError(f"Expected {len(self.unit_indices)} image(s) (one per unit), "
+                             f"but got a batch of {img.shape[0]}")
+        self._channel_indices = None
+        self._get_channel_indices()  # fail early if the model is pruned to other units
+        if precision not in ('float32', 'bfloat16'):
+            raise ValueError(f'Precision "{precision}" not supported')
+        self.precision = precision
+        self.max_iter = max_iter
+        self.rel_tol = rel_tol
+        self.grad_tol = grad_tol
+        self.record_norms = record_norms
+        self.stats = [UnitStats(unit_index) for unit_index in self.unit_indices]
+
+        # Each unit gets its own image tensor (and therefore its own optimizer
+        # state), so that units can be replaced in the middle of a run. A
+        # single image is optimized in place.
+        if img.shape[0] == 1:
+            self.imgs = [img.requires_grad_(True)]
+        else:
+            self.imgs = [x.clone().requires_grad_(True) for x in img.detach().split(1)]
         self.optimizer = self._get_optimizer(optimizer, lr, momentum)
 
+    @property
+    def img(self) -> torch.Tensor:
+        """The current image, or batch of images."""
+        if len(self.imgs) == 1:
+            return self.imgs[0]
+        return torch.cat(self.imgs).detach()
+
     def _get_optimizer(self, optimizer_name: str, lr: float, momentum: bool) -> optim.Optimizer:
         if optimizer_name == 'Adam':
-            return optim.Adam([self.img], lr=lr)
+            return optim.Adam(self.imgs, lr=lr)
         elif optimizer_name == 'SGD':
-            return optim.SGD([self.img], lr=lr, momentum=momentum)
+            return optim.SGD(self.imgs, lr=lr, momentum=momentum)
         else:
             raise ValueError(f'Optimizer "{optimizer_name}" not supported')
 
+    def _get_channel_indices(self) -> List[int]:
+        """Returns the output channel of each unit."""
+        if self._channel_indices is not None:
+            return self._channel_indices
+        pruned_unit_indices = getattr(self.model, 'unit_indices', None)
+        if pruned_unit_indices is None:
+            self._channel_indices = list(self.unit_indices)
+            return self._channel_indices
+        channels = {unit_index: channel for channel, unit_index in enumerate(pruned_unit_indices)}
+        try:
+            self._channel_indices = [channels[unit_index] for unit_index in self.unit_indices]
+        except KeyError:
+            raise ValueError(f"The model has been pruned to units {pruned_unit_indices}, "
+                             f"which do not include all of units {self.unit_indices}")
+        return self._channel_indices
+
+    def has_units(self, unit_indices: Sequence[int]) -> bool:
+        """Whether the model computes the output channels of all the units."""
+        pruned_unit_indices = getattr(self.model, 'unit_indices', None)
+        return pruned_unit_indices is None or set(unit_indices) <= set(pruned_unit_indices)
+
     def _objective_function(self, x: torch.Tensor) -> torch.Tensor:
-        responses = self.model(x)
+        """Returns the center responses of the units, one per image."""
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16,
+                            enabled=(self.precision == 'bfloat16')):
+            responses = self.model(x)
+        responses = responses.float()
         num_images, num_units, ny, nx = responses.shape
-        return responses[0, self.unit_index, ny//2, nx//2]
+        image_indices = torch.arange(num_images, device=responses.device)
+        channel_indices = torch.as_tensor(self._get_channel_indices(), device=responses.device)
+        return responses[image_indices, channel_indices, ny//2, nx//2]
+
+    def _update_status(self, stats: UnitStats) -> None:
+        """Marks the unit as finished if it meets a stopping criterion."""
+        if stats.is_finished:
+            return
+        if self.max_iter is not None and stats.num_steps >= self.max_iter:
+            stats.status = 'max_iter'
+        elif self.grad_tol is not None and stats.grad_norms[-1] <= self.grad_tol:
+            stats.status = 'converged'
+        elif self.rel_tol is not None and stats.num_steps >= 2:
+            previous, current = stats.responses[-2], stats.responses[-1]
+            if abs(current - previous) <= self.rel_tol * max(abs(previous), 1e-12):
+                stats.status = 'converged'
 
     def step(self) -> torch.Tensor:
         """
         Takes one optimization step and returns the updated image tensor.
-        
+
         Returns:
             The updated image tensor.
         """
         self.optimizer.zero_grad()
 
         # Need to put a negative sign because optimizer minimizes the "loss",
-        # but this is an response, and we want to maximize it.
-        response = -self._objective_function(self.img)
+        # but this is an response, and we want to maximize it. The responses
+        # of the units are summed so that the whole batch shares one backward
+        # pass; each image only receives the gradient of its own unit.
+        x = self.imgs[0] if len(self.imgs) == 1 else torch.cat(self.imgs)
+        responses = self._objective_function(x)
+        response = -responses.sum()
 
         # Compute the gradient of the response with respect to the image.
         response.backward()
 
+        # The statistics of all units are computed as batches and copied to
+        # the CPU together, once per step.
+        columns = [responses.detach()]
+        if self.record_norms or self.grad_tol is not None:
+            columns.append(torch.cat([img.grad for img in self.imgs]).flatten(start_dim=1).norm(dim=1))
+        if self.record_norms:
+            # A single image is updated in place, so it must be copied.
+            old_x = x.detach().clone() if len(self.imgs) == 1 else x.detach()
+
         # Update the image using the optimizer.
         self.optimizer.step()
 
+        # Record the statistics of each unit.
+        if self.record_norms:
+            new_x = torch.cat([img.detach() for img in self.imgs])
+            columns.append((new_x - old_x).flatten(start_dim=1).norm(dim=1))
+        columns = torch.stack(columns).tolist()
+        for slot, stats in enumerate(self.stats):
+            stats.responses.append(columns[0][slot])
+            if len(columns) > 1:
+                stats.grad_norms.append(columns[1][slot])
+            if len(columns) > 2:
+                stats.step_sizes.append(columns[2][slot])
+            self._update_status(stats)
+
         # Reset the gradient to zero.
-        self.img.grad.zero_()
+        for img in self.imgs:
+            img.grad.zero_()
 
         return self.img
+
+    def probe(self) -> Tuple[List[float], List[float]]:
+        """
+        Computes the response and the gradient norm of each unit at the
+        current images without taking a step.
+
+        Returns:
+            The responses and the gradient norms, one per unit.
+        """
+        x = torch.cat([img.detach() for img in self.imgs]).requires_grad_(True)
+        responses = self._objective_function(x)
+        responses.sum().backward()
+        grad_norms = x.grad.flatten(start_dim=1).norm(dim=1)
+        return responses.detach().tolist(), grad_norms.tolist()
+
+    def measure(self) -> List[float]:
+        """
+        Returns the response of each unit at the current images, with a
+        forward pass only.
+        """
+        with torch.no_grad():
+            return self._objective_function(torch.cat([img.detach() for img in self.imgs])).tolist()
+
+    def get_results(self) -> List[torch.Tensor]:
+        """
+        Returns one (1, 3, xn, xn) image per unit, in the same order as the
+        unit indices.
+        """
+        return [img.detach() for img in self.imgs]
+
+    def finished_slots(self) -> List[int]:
+        """Returns the positions (in self.unit_indices) of the finished units."""
+        return [slot for slot, stats in enumerate(self.stats) if stats.is_finished]
+
+    def set_model(self, truncated_model: torch.nn.Module) -> None:
+        """
+        Replaces the model, e.g., with one that is pruned to the current units.
+        """
+        self.model = truncated_model
+        self._channel_indices = None
+
+    def replace_unit(self, slot: int, unit_index: int, img: torch.Tensor) -> None:
+        """
+        Replaces the unit at the given position with a new unit and its
+        (1, 3, xn, xn) starting image. The optimizer state of the new unit
+        starts fresh.
+        """
+        new_img = img.detach().clone().requires_grad_(True)
+        self.optimizer.state.pop(self.imgs[slot], None)
+        self.optimizer.param_groups[0]['params'][slot] = new_img
+        self.imgs[slot] = new_img
+        self.unit_indices[slot] = unit_index
+        self.stats[slot] = UnitStats(unit_index)
+        self._channel_indices = None
+
+    def remove_unit(self, slot: int) -> None:
+        """Removes the unit at the given position from the batch."""
+        self.optimizer.state.pop(self.imgs[slot], None)
+        del self.optimizer.param_groups[0]['params'][slot]
+        del self.imgs[slot]
+        del self.unit_indices[slot]
+        del self.stats[slot]
+        self._channel_indices = None
+
+
+def find_dead_units(truncated_model: torch.nn.Module, unit_indices: Sequence[int],
+                    init_img_fn: Callable[[int], torch.Tensor], batch_size: int = 64,
+                    model_fn: Optional[Callable[[List[int]], torch.nn.Module]] = None
+                    ) -> Dict[int, Tuple[float, float]]:
+    """
+    Finds the units that cannot move from their starting image. For example,
+    a unit behind a ReLU or max pooling with a non-positive pre-activation at
+    a zero image gets an exactly zero gradient, so gradient ascent would
+    return the starting image after wasting all its iterations. The check
+    costs one batched forward/backward pass per batch_size units.
+
+    Args:
+        truncated_model: The truncated neural network.
+        unit_indices: The units to check.
+        init_img_fn: Returns the (1, 3, xn, xn) starting image of a unit.
+        batch_size: The number of units checked at the same time.
+        model_fn: See run_gradient_ascent().
+
+    Returns:
+        {unit_index: (response, gradient norm)} of the dead units.
+    """
+    unit_indices = list(unit_indices)
+    dead_units = {}
+    for batch_start in range(0, len(unit_indices), batch_size):
+        batch_units = unit_indices[batch_start:batch_start + batch_size]
+        model = model_fn(batch_units) if model_fn is not None else truncated_model
+        img = torch.cat([init_img_fn(unit_index) for unit_index in batch_units])
+        ga = GradientAscent(model, batch_units, img.detach())
+        responses, grad_norms = ga.probe()
+        for unit_index, response, grad_norm in zip(batch_units, responses, grad_norms):
+            if grad_norm == 0:
+                dead_units[unit_index] = (response, grad_norm)
+    return dead_units
+
+
+def run_gradient_ascent(truncated_model: torch.nn.Module, unit_indices: Sequence[int],
+                        init_img_fn: Callable[[int], torch.Tensor], batch_size: int = 64,
+                        lr: float = 0.1, optimizer: str = 'SGD', momentum: bool = False,
+                        max_iter: int = 100, rel_tol: Optional[float] = None,
+                        grad_tol: Optional[float] = None,
+                        model_fn: Optional[Callable[[List[int]], torch.nn.Module]] = None,
+                        dead_units: Optional[str] = None,
+                        restart_img_fn: Optional[Callable[[int], torch.Tensor]] = None,
+                        precision: str = 'float32', record_norms: bool = False,
+                        seed: Optional[int] = None
+                        ) -> Iterator[Tuple[int, torch.Tensor, UnitStats]]:
+    """
+    Runs gradient ascent on many units, batch_size units at a time. As soon as
+    a unit meets a stopping criterion (see GradientAscent), it is retired and
+    its slot in the batch is given to the next pending unit, so that the
+    computation goes to the units that are still improving.
+
+    Args:
+        truncated_model: The truncated neural network.
+        unit_indices: The units to optimize.
+        init_img_fn: Returns the (1, 3, xn, xn) starting image of a unit.
+        batch_size: The number of units optimized at the same time.
+        lr, optimizer, momentum, precision, record_norms: See GradientAscent.
+        max_iter, rel_tol, grad_tol: The stopping criteria. See GradientAscent.
+        model_fn: If given, called with a list of units, and the returned
+            model is used instead of truncated_model (e.g., a model pruned to
+            these units). The list holds the active units and up to batch_size
+            pending units, so that the model is only rebuilt when a backfilled
+            unit is not in it, i.e., at most once every batch_size retirements.
+        dead_units: What to do with the units whose gradient is exactly zero at
+            their starting image (see find_dead_units()). Options: None (do
+            not check), 'skip' (return the starting image with the status
+            'dead'), or 'restart' (start from restart_img_fn instead).
+        restart_img_fn: Returns the (1, 3, xn, xn) starting image of a dead
+            unit. Defaults to the original starting image plus a tiny random
+            perturbation.
+        seed: If given, the random perturbation of a dead unit is drawn from
+            a generator seeded with seed + unit_index, so that the results
+            are reproducible (e.g., to cache them). Otherwise, the global
+            random number generator is used.
+
+    Yields:
+        (unit_index, result, stats) of each unit, in the order they finish.
+        The result is the (1, 3, xn, xn) image after the last step.
+    """
+    if max_iter is None:
+        raise ValueError("max_iter must be specified, otherwise the run may never end.")
+    if dead_units not in (None, 'skip', 'restart'):
+        raise ValueError(f'Dead unit option "{dead_units}" not supported')
+    pending = list(unit_indices)
+
+    if dead_units is not None:
+        dead = find_dead_units(truncated_model, pending, init_img_fn,
+                               batch_size=batch_size, model_fn=model_fn)
+        if dead_units == 'skip':
+            pending = [unit_index for unit_index in pending if unit_index not in dead]
+            for unit_index, (response, grad_norm) in dead.items():
+                stats = UnitStats(unit_index)
+                stats.responses.append(response)
+                stats.grad_norms.append(grad_norm)
+                stats.status = 'dead'
+                yield unit_index, init_img_fn(unit_index).detach(), stats
+        elif dead:
+            original_init_img_fn = init_img_fn
+            if restart_img_fn is None:
+                def restart_img_fn(unit_index):
+                    img = original_init_img_fn(unit_index)
+                    generator = None if seed is None else torch.Generator().manual_seed(seed + unit_index)
+                    noise = torch.randn(img.shape, generator=generator, dtype=img.dtype)
+                    return img + DEAD_UNIT_RESTART_NOISE * noise.to(img.device)
+
+            def init_img_fn(unit_index):
+                if unit_index in dead:
+                    return restart_img_fn(unit_index)
+                return original_init_img_fn(unit_index)
+
+    first_units, pending = pending[:batch_size], pending[batch_size:]
+    if not first_units:
+        return
+
+    def get_model(active_units):
+        # Include the next pending units, which will backfill the slots of
+        # the units that retire.
+        return model_fn(list(active_units) + pending[:batch_size])
+
+    model = get_model(first_units) if model_fn is not None else truncated_model
+    img = torch.cat([init_img_fn(unit_index) for unit_index in first_units])
+    ga = GradientAscent(model, first_units, img, lr=lr, optimizer=optimizer,
+                        momentum=momentum, max_iter=max_iter, rel_tol=rel_tol,
+                        grad_tol=grad_tol, precision=precision, record_norms=record_norms)
+
+    while ga.unit_indices:
+        ga.step()
+        finished_slots = ga.finished_slots()
+        if not finished_slots:
+            continue
+
+        results = [(ga.unit_indices[slot], ga.imgs[slot].detach().clone(), ga.stats[slot])
+                   for slot in finished_slots]
+
+        # Backfill the slots with pending units, and drop the rest. Go
+        # backward so that removing a slot does not shift the others.
+        for slot in reversed(finished_slots):
+            if pending:
+                unit_index = pending.pop(0)
+                ga.replace_unit(slot, unit_index, init_img_fn(unit_index))
+            else:
+                ga.remove_unit(slot)
+        if model_fn is not None and not ga.has_units(ga.unit_indices):
+            ga.set_model(get_model(ga.unit_indices))
+
+        yield from results
+
+
+def precision_fidelity_report(truncated_model: torch.nn.Module, unit_indices: Sequence[int],
+                              init_img_fn: Callable[[int], torch.Tensor],
+                              precision: str = 'bfloat16', num_samples: int = 8,
+                              seed: int = 0, min_correlation: float = 0.99,
+                              max_response_delta: float = 0.02, **kwargs) -> List[Dict[str, float]]:
+    """
+    Checks whether a reduced precision changes the gradient ascent results.
+    A random sample of units is optimized twice, in float32 and in the given
+    precision, with the same settings. The two results of each unit are
+    compared, and both are measured with the float32 model (forward only).
+
+    Run it once per layer, with all the units of the layer, and only use the
+    reduced precision for the layer if every sampled unit passed.
+
+    Args:
+        truncated_model: The truncated neural network.
+        unit_indices: The units to sample from.
+        init_img_fn: Returns the (1, 3, xn, xn) starting image of a unit.
+        precision: The reduced precision to check. See GradientAscent.
+        num_samples: The number of units to check.
+        seed: The seed of the random sample.
+        min_correlation: The minimum correlation of the two results of a
+            unit for it to pass.
+        max_response_delta: The maximum relative response delta of a unit
+            for it to pass.
+        **kwargs: Passed to run_gradient_ascent() (lr, max_iter, etc.).
+
+    Returns:
+        One dict per sampled unit with the keys 'unit_index', 'correlation'
+        (the Pearson correlation of the two result images, 1 if they are
+        identical), 'response_float32', 'response_reduced' (the float32
+        responses to the two results), 'response_delta' (their difference),
+        'relative_delta' (the difference relative to response_float32), and
+        'passed' (whether the unit meets both thresholds).
+    """
+    unit_indices = list(unit_indices)
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randperm(len(unit_indices), generator=generator)[:num_samples].tolist()
+    sample_units = sorted(unit_indices[i] for i in sample)
+
+    results = {}
+    for run_precision in ('float32', precision):
+        runs = run_gradient_ascent(truncated_model, sample_units, init_img_fn,
+                                   precision=run_precision, **kwargs)
+        results[run_precision] = {unit_index: result for unit_index, result, _ in runs}
+
+    model_fn = kwargs.get('model_fn')
+    model = model_fn(sample_units) if model_fn is not None else truncated_model
+    measured = {}
+    for run_precision in ('float32', precision):
+        imgs = torch.cat([results[run_precision][unit_index] for unit_index in sample_units])
+        measured[run_precision] = GradientAscent(model, sample_units, imgs).measure()
+
+    report = []
+    for i, unit_index in enumerate(sample_units):
+        x = results['float32'][unit_index].flatten().double()
+        y = results[precision][unit_index].flatten().double()
+        if torch.equal(x, y):
+            correlation = 1.0
+        else:
+            x, y = x - x.mean(), y - y.mean()
+            denominator = (x.norm() * y.norm()).item()
+            correlation = (x @ y).item() / denominator if denominator > 0 else float('nan')
+        response_float32 = measured['float32'][i]
+        response_reduced = measured[precision][i]
+        response_delta = response_reduced - response_float32
+        relative_delta = abs(response_delta) / max(abs(response_float32), 1e-12)
+        report.append({'unit_index': unit_index,
+                       'correlation': correlation,
+                       'response_float32': response_float32,
+                       'response_reduced': response_reduced,
+                       'response_delta': response_delta,
+                       'relative_delta': relative_delta,
+                       # nan correlations fail
+                       'passed': correlation >= min_correlation and relative_delta <= max_response_delta})
+    return report
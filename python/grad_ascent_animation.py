@@ -9,12 +9,11 @@ Tony Fu, Bair Lab, March 2023
 import os
 
 import torch
-import torchvision.models as models
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
 # Custom modules
-from model_utils import ModelInfo, get_truncated_model
+from model_utils import ModelInfo, load_model, get_truncated_model
 from tensor_utils import process_tensor
 from grad_ascent import GradientAscent
 
@@ -27,7 +26,7 @@ UNIT_INDEX = 2
 
 # Setting up
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL = getattr(models, MODEL_NAME)(pretrained=True).to(DEVICE)
+MODEL = load_model(MODEL_NAME, DEVICE)
 MODEL_INFO = ModelInfo()
 
 # Compute Gradient Ascent visualizations and save them to .png
@@ -0,0 +1,171 @@
+"""
+A packed, memory-mapped store for the 50,000 images used by the top-patch
+scripts. Reading a receptive-field crop from the store only touches the bytes
+of the crop, instead of opening and parsing a whole 3 x 227 x 227 .npy file.
+
+The images are packed into a few shard files of shape (N, H, W, C), so that
+every row of a crop is one contiguous read of width * C values. The shards
+have a fixed stride per image, so the location of image i is computed, not
+looked up.
+
+Layout of a store directory:
+    meta.json           num_images, image_shape (C, H, W), dtype, images_per_shard
+    images_000.npy      images [0, images_per_shard)
+    images_001.npy      images [images_per_shard, 2 * images_per_shard)
+    ...
+
+Example:
+    pack_images(IMG_DIR, IMG_STORE_DIR)   # once, see make_image_store.py
+    images = open_image_source(IMG_STORE_DIR)
+    patch = images.crop(img_index, (y_min, x_min, y_max, x_max))
+
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+__all__ = ['ImageStore', 'NpyImageDirectory', 'pack_images', 'open_image_source']
+
+
+class ImageStore:
+    """
+    Read-only access to a packed image store (see pack_images()). All
+    returned images and crops have shape (C, H, W), like the original .npy
+    files, and dtype float32.
+    """
+    def __init__(self, store_dir: str):
+        """
+        Args:
+            store_dir (str): The directory of the store.
+        """
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.store_dir = store_dir
+        self.num_images = meta['num_images']
+        self.image_shape = tuple(meta['image_shape'])
+        self.images_per_shard = meta['images_per_shard']
+        self._shards = {}
+
+    def __len__(self) -> int:
+        return self.num_images
+
+    def _get_shard(self, shard_index: int) -> np.memmap:
+        if shard_index not in self._shards:
+            self._shards[shard_index] = np.load(_shard_path(self.store_dir, shard_index),
+                                                mmap_mode='r')
+        return self._shards[shard_index]
+
+    def _locate(self, img_index: int) -> Tuple[np.memmap, int]:
+        if not 0 <= img_index < self.num_images:
+            raise IndexError(f"image index {img_index} out of range for {self.num_images} images")
+        shard_index, offset = divmod(int(img_index), self.images_per_shard)
+        return self._get_shard(shard_index), offset
+
+    def get_image(self, img_index: int) -> np.ndarray:
+        """Returns the whole image, with shape (C, H, W)."""
+        shard, offset = self._locate(img_index)
+        return shard[offset].transpose(2, 0, 1).astype(np.float32)
+
+    def crop(self, img_index: int, box: Tuple[int, int, int, int]) -> np.ndarray:
+        """
+        Returns the pixels [y_min, y_max] x [x_min, x_max] (inclusive) of an
+        image, with shape (C, h, w). The box is clipped to the image, like
+        slicing a numpy array would be.
+        """
+        y_min, x_min, y_max, x_max = box
+        shard, offset = self._locate(img_index)
+        return shard[offset, y_min:y_max+1, x_min:x_max+1].transpose(2, 0, 1).astype(np.float32)
+
+
+class NpyImageDirectory:
+    """
+    The same interface as ImageStore, but reads the original directory of
+    {img_index}.npy files. Only the crop is read from each file, but every
+    call still has to open and parse the file.
+    """
+    def __init__(self, img_dir: str):
+        self.img_dir = img_dir
+
+    def get_image(self, img_index: int) -> np.ndarray:
+        return np.load(os.path.join(self.img_dir, f"{img_index}.npy")).astype(np.float32)
+
+    def crop(self, img_index: int, box: Tuple[int, int, int, int]) -> np.ndarray:
+        y_min, x_min, y_max, x_max = box
+        img = np.load(os.path.join(self.img_dir, f"{img_index}.npy"), mmap_mode='r')
+        return img[:, y_min:y_max+1, x_min:x_max+1].astype(np.float32)
+
+
+def _shard_path(store_dir: str, shard_index: int) -> str:
+    return os.path.join(store_dir, f"images_{shard_index:03d}.npy")
+
+
+def pack_images(img_dir: str, store_dir: str, num_images: Optional[int] = None,
+                images_per_shard: int = 10000, dtype: str = 'float32',
+                num_threads: int = 8) -> ImageStore:
+    """
+    Packs a directory of {img_index}.npy images of shape (C, H, W) into an
+    image store.
+
+    Args:
+        img_dir (str): The directory of the .npy images, numbered from 0.
+        store_dir (str): The directory of the store. Created if necessary.
+        num_images (int): The number of images. Defaults to the number of
+        .npy files in img_dir.
+        images_per_shard (int): The number of images per shard file.
+        dtype (str): The dtype of the stored pixels. float32 halves the size
+        of the original float64 images without a meaningful loss.
+        num_threads (int): The number of threads reading the .npy files.
+
+    Returns:
+        The image store.
+    """
+    if num_images is None:
+        num_images = len([f for f in os.listdir(img_dir) if f.endswith('.npy')])
+    image_shape = np.load(os.path.join(img_dir, "0.npy"), mmap_mode='r').shape
+    num_channels, height, width = image_shape
+    os.makedirs(store_dir, exist_ok=True)
+
+    def read_image(img_index):
+        img = np.load(os.path.join(img_dir, f"{img_index}.npy"))
+        if img.shape != image_shape:
+            raise ValueError(f"Image {img_index} has shape {img.shape}, but expected {image_shape}")
+        return img.transpose(1, 2, 0)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for shard_index, img_start in enumerate(range(0, num_images, images_per_shard)):
+            img_stop = min(img_start + images_per_shard, num_images)
+            shard = np.lib.format.open_memmap(_shard_path(store_dir, shard_index), mode='w+', dtype=dtype,
+                                              shape=(img_stop - img_start, height, width, num_channels))
+            # Read in small batches, so that at most a few images are held in
+            # memory at a time.
+            batch_size = num_threads * 4
+            for batch_start in tqdm(range(img_start, img_stop, batch_size),
+                                    desc=f"Packing shard {shard_index}"):
+                batch_stop = min(batch_start + batch_size, img_stop)
+                images = executor.map(read_image, range(batch_start, batch_stop))
+                for img_index, img in zip(range(batch_start, batch_stop), images):
+                    shard[img_index - img_start] = img
+            shard.flush()
+            del shard
+
+    # The metadata is written last, so that an interrupted packing does not
+    # leave a store that looks complete.
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'num_images': num_images, 'image_shape': list(image_shape),
+                   'dtype': dtype, 'images_per_shard': images_per_shard}, f)
+    return ImageStore(store_dir)
+
+
+def open_image_source(path: str) -> Union[ImageStore, NpyImageDirectory]:
+    """
+    Opens the ImageStore at path, or, if path is a directory of .npy images
+    that has not been packed, a NpyImageDirectory.
+    """
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return ImageStore(path)
+    return NpyImageDirectory(path)
@@ -0,0 +1,177 @@
+"""
+Fast writing of visualizations to image files. Encodes arrays directly with
+Pillow (no matplotlib figure per image), on background threads, so that the
+encoding overlaps with the gradient ascent of the next units.
+
+Example:
+    with ImageWriter() as writer:
+        for unit_index in range(num_units):
+            result = ...  # compute it
+            writer.write(os.path.join(layer_dir, f"{unit_index}.png"), process_tensor(result))
+
+"""
+
+import queue
+import threading
+from typing import Callable, Optional, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+__all__ = ['to_uint8', 'save_image', 'ImageWriter']
+
+
+def to_uint8(img: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+    """
+    Converts an image with values in [0.0, 1.0] (e.g., from process_tensor()
+    or normalize_img()) to uint8. Values outside of the range are clipped,
+    like matplotlib's imshow() does.
+
+    Args:
+        img: An array of shape (H, W, 3), (H, W), or (3, H, W).
+
+    Returns:
+        A uint8 array of shape (H, W, 3) or (H, W).
+    """
+    if isinstance(img, torch.Tensor):
+        img = img.detach().cpu().numpy()
+    img = np.squeeze(img)
+    if img.ndim == 3 and img.shape[0] == 3 and img.shape[2] != 3:
+        img = img.transpose(1, 2, 0)
+    if img.ndim not in (2, 3):
+        raise ValueError(f"img must have shape (H, W, 3), (H, W), or (3, H, W), but got {img.shape}")
+    if img.dtype == np.uint8:
+        return np.ascontiguousarray(img)
+    return (np.clip(img, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+
+
+def save_image(path: str, img: Union[np.ndarray, torch.Tensor],
+               size: Optional[int] = None, compress_level: int = 1) -> None:
+    """
+    Saves an image. The format (e.g., .png or .webp) is determined by the
+    file extension.
+
+    Args:
+        path (str): The output path.
+        img: See to_uint8().
+        size (int): If given, the image is upscaled to (size, size) with
+        nearest-neighbor interpolation, which keeps the pixels sharp.
+        compress_level (int): The zlib compression level of PNG files. Low
+        levels are much faster, and the files are only slightly larger.
+    """
+    pil_img = Image.fromarray(to_uint8(img))
+    if size is not None:
+        pil_img = pil_img.resize((size, size), resample=Image.NEAREST)
+    pil_img.save(path, compress_level=compress_level)
+
+
+class ImageWriter:
+    """
+    Saves images on background threads. The queue is bounded, so write()
+    blocks instead of letting unwritten images pile up in memory if the
+    encoding falls behind. Pillow releases the GIL while encoding, so threads
+    are enough.
+
+    After an image fails to save, the writer stops: the images still in the
+    queue are not saved, and every later call to write() or close() raises a
+    RuntimeError that lists the paths that were not saved (see
+    unsaved_paths). Work that must only count as done once its image is on
+    disk (e.g., marking a unit as written in a ResultStore) goes in the
+    on_saved callback of write(), so that it is skipped for these images.
+    """
+    def __init__(self, num_threads: int = 2, max_queue_size: int = 64,
+                 size: Optional[int] = None, compress_level: int = 1):
+        """
+        Args:
+            num_threads (int): The number of background threads.
+            max_queue_size (int): The maximum number of images waiting to be
+            written.
+            size, compress_level: See save_image().
+        """
+        self.size = size
+        self.compress_level = compress_level
+        self.unsaved_paths = []
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._error = None
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, img, on_saved = item
+                if self._error is None:
+                    try:
+                        save_image(path, img, size=self.size, compress_level=self.compress_level)
+                        if on_saved is not None:
+                            on_saved()
+                        continue
+                    except Exception as e:
+                        with self._lock:
+                            if self._error is None:
+                                self._error = e
+                with self._lock:
+                    self.unsaved_paths.append(path)
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            with self._lock:
+                unsaved_paths = sorted(self.unsaved_paths)
+            raise RuntimeError(f"Saving an image failed. These {len(unsaved_paths)} images were "
+                               f"not saved: {', '.join(unsaved_paths)}") from self._error
+
+    def write(self, path: str, img: Union[np.ndarray, torch.Tensor],
+              on_saved: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queues an image to be saved to path. The image is converted to uint8
+        right away, so the caller may modify img afterwards.
+
+        Args:
+            path (str): The output path.
+            img: See to_uint8().
+            on_saved (callable): If given, called without arguments on a
+            background thread once the image has been saved. It is not called
+            if the image is not saved.
+
+        Raises:
+            RuntimeError: If an earlier image failed to save. Nothing is
+            queued then.
+        """
+        self._raise_error()
+        if not self._threads:
+            raise RuntimeError("The ImageWriter is closed.")
+        self._queue.put((path, to_uint8(img), on_saved))
+
+    def close(self) -> None:
+        """
+        Waits until all queued images have been saved (or, after an error,
+        dropped), and raises the error, if any.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._raise_error()
+
+    def __enter__(self) -> 'ImageWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # Do not hide the original exception behind an error of a queued image
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,85 @@
+"""
+Writes the responses of every conv layer of a model to all 50,000 images into
+activation stores (see activation_store.py), so that later analyses read them
+instead of running the images through the model again. Optional: the stores
+are large (e.g., AlexNet conv1 takes 64 x 55 x 55 float16 values, about
+390 KB, per image, i.e., about 19 GB for the 50,000 images), so consider
+restricting LAYER_NAMES.
+
+The images are split into one shard per worker. Rerunning the script after
+an interruption only processes the images that have not been written yet.
+If a response overflows float16, the workers stop with an error: delete the
+stores and rerun with STORE_DTYPE = 'float32'.
+
+"""
+
+import os
+
+import torch
+
+from image_store import open_image_source
+from model_utils import ModelInfo, load_model, TruncationCache
+from activation_store import ActivationStore, create_activation_stores, store_activations
+from patch_ranking import make_image_shards
+from scheduler import run_shards, print_report
+
+# Please specify some model details here:
+MODEL_NAME = "alexnet"
+LAYER_NAMES = ['conv1', 'conv2', 'conv3', 'conv4', 'conv5']
+NUM_IMAGES = 50000
+IMG_SIZE = (227, 227)
+BATCH_SIZE = 64  # number of images per forward pass
+NUM_WORKERS = 4  # number of processes, each writing its own shard of the images
+IMAGES_PER_SHARD = 1000  # number of images per shard file of the stores
+STORE_DTYPE = 'float16'  # options: 'float16' (half the size) and 'float32' (if a response overflows float16)
+
+# Set the result directory
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'activations', MODEL_NAME)
+
+# The images packed by make_image_store.py. If they have not been packed, the
+# .npy files in IMG_DIR are read instead.
+IMG_DIR = '/Users/tonyfu/Desktop/Bair Lab/top_and_bottom_images/images'
+IMG_STORE_DIR = os.path.join(os.path.dirname(IMG_DIR), 'images_packed')
+
+########################### DON'T TOUCH CODE BELOW ############################
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+MODEL = load_model(MODEL_NAME, DEVICE)  # the weights are shared by all workers
+TRUNCATIONS = TruncationCache(MODEL)  # the model is traced once for all layers
+MODEL_INFO = ModelInfo()
+STORE_PATHS = {MODEL_INFO.get_layer_index(MODEL_NAME, layer_name):
+               os.path.join(RESULT_DIR, f"{layer_name}.acts") for layer_name in LAYER_NAMES}
+IMAGES = open_image_source(IMG_STORE_DIR if os.path.exists(IMG_STORE_DIR) else IMG_DIR)
+
+
+def store_shard(shard):
+    print(f"Storing the responses to images {shard.img_start}-{shard.img_stop - 1}...")
+    stores = {layer_index: ActivationStore(path, mode='r+') for layer_index, path in STORE_PATHS.items()}
+    store_activations(TRUNCATIONS, stores, IMAGES, shard.img_indices,
+                      batch_size=BATCH_SIZE, device=DEVICE)
+    for store in stores.values():
+        store.close()
+
+
+if __name__ == '__main__':
+    # Resume the stores of an interrupted run only if they hold STORE_DTYPE.
+    # Mixing dtypes would silently change the precision of some layers.
+    existing_paths = [path for path in STORE_PATHS.values() if os.path.exists(os.path.join(path, 'meta.json'))]
+    mismatched_paths = [path for path in existing_paths if ActivationStore(path).dtype != STORE_DTYPE]
+    if mismatched_paths:
+        raise ValueError(f"These stores do not have the dtype STORE_DTYPE = '{STORE_DTYPE}': "
+                         f"{', '.join(mismatched_paths)}. Delete them to recreate them, or change STORE_DTYPE.")
+
+    # Allocate the stores that do not exist from an interrupted run. The
+    # workers write their images into them.
+    missing_paths = {layer_index: path for layer_index, path in STORE_PATHS.items()
+                     if path not in existing_paths}
+    if missing_paths:
+        for store in create_activation_stores(TRUNCATIONS, missing_paths, NUM_IMAGES, IMG_SIZE,
+                                              dtype=STORE_DTYPE,
+                                              images_per_shard=IMAGES_PER_SHARD).values():
+            store.close()
+
+    _, report = run_shards(store_shard, make_image_shards(NUM_IMAGES, NUM_WORKERS), NUM_WORKERS)
+    print_report(report)
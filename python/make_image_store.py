@@ -0,0 +1,20 @@
+"""
+Packs the 50,000 .npy images used by the top-patch scripts into a memory-
+mapped image store (see image_store.py). Only needs to be run once.
+
+"""
+
+import os
+
+from image_store import pack_images
+
+# Please specify the image directories here:
+IMG_DIR = '/Users/tonyfu/Desktop/Bair Lab/top_and_bottom_images/images'
+IMG_STORE_DIR = os.path.join(os.path.dirname(IMG_DIR), 'images_packed')
+NUM_IMAGES = 50000
+IMAGES_PER_SHARD = 10000  # 10000 x 227 x 227 x 3 float32 = about 6 GB per shard
+
+if __name__ == '__main__':
+    store = pack_images(IMG_DIR, IMG_STORE_DIR, num_images=NUM_IMAGES,
+                        images_per_shard=IMAGES_PER_SHARD)
+    print(f"Packed {len(store)} images into {IMG_STORE_DIR}")
@@ -0,0 +1,181 @@
+"""
+Derives the rows of data/model_info.txt (layer_index, rf_size, xn, and
+num_units of every conv layer) for any torchvision model that torch.fx can
+trace and SpatialIndexConverter can project (e.g., not yet the concatenated
+branches of SqueezeNet), instead of profiling the model by hand.
+
+For every Conv2d layer (named conv1, conv2, ... in call order):
+    layer_index  the index of the layer, as used by get_truncated_model()
+    rf_size      the width of the receptive field of the center unit, in pixels
+    xn           the smallest image size that is more than 10% larger than
+                 rf_size and in which the receptive field of the center unit
+                 fits and is centered
+    num_units    the number of output channels
+
+The receptive fields are computed by the SpatialIndexConverter of the model
+truncated at that layer. Only the shapes matter, so the models are created
+without pretrained weights.
+
+Outputs (in RESULT_DIR):
+    model_info.txt   the rows of MODEL_NAMES, in the format of data/model_info.txt
+    rf_data.json     the same numbers in the format of rf_data in
+                     docs/js/playground.js and docs/js/gallery.js
+
+data/model_info.txt is not overwritten. Instead, the derived rows are compared
+with it, and the differences are printed (test_make_model_info.py checks that
+there are none).
+
+"""
+
+import os
+import json
+from typing import Dict, List, Tuple
+
+import torch.nn as nn
+from torchvision import models
+
+from model_utils import MODEL_INFO_FILE_PATH, ModelInfo, TruncationCache
+from spatial_utils import SpatialIndexConverter
+
+# Please specify the models here:
+MODEL_NAMES = ['alexnet', 'vgg16', 'resnet18']
+IMAGE_SHAPE = (227, 227)  # only used to find the conv layers and their indices
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'model_info')
+COLUMNS = ModelInfo.COLUMNS
+
+
+def get_center_box(model: nn.Module, layer_index: int, xn: int) -> Tuple[int, int, int, int]:
+    """
+    Returns the box (y_min, x_min, y_max, x_max) of pixels that the center
+    unit of the layer sees in an image of size xn x xn. The box is clipped
+    to the image.
+    """
+    converter = SpatialIndexConverter(model, (xn, xn), cache_dir=None)
+    _, height, width = converter.output_sizes[layer_index]
+    return converter.convert((height//2, width//2), layer_index, 0, is_forward=False)
+
+
+def get_rf_size(model: nn.Module, layer_index: int, xn: int) -> int:
+    """
+    Returns the receptive field size of the center unit of the layer. The
+    image size starts at xn and is doubled until the receptive field is no
+    longer clipped by the edges of the image.
+    """
+    while True:
+        y_min, _, y_max, _ = get_center_box(model, layer_index, xn)
+        if y_min > 0 and y_max < xn - 1:
+            return y_max - y_min + 1
+        xn *= 2
+
+
+def get_xn(model: nn.Module, layer_index: int, rf_size: int, max_margin: int = 128) -> int:
+    """
+    Returns the smallest image size that is more than 10% larger than rf_size
+    and whose center unit (of the layer) has an unclipped, centered receptive
+    field. This is the convention of data/model_info.txt, and the margin
+    around the receptive field grows with it.
+
+    Raises:
+        ValueError: If no such size is found within max_margin pixels of
+        margin on each side.
+    """
+    for xn in range(rf_size + 2, rf_size + 2 * max_margin + 1):
+        # Integer arithmetic, so that xn = 1.1 * rf_size is excluded exactly
+        if 10 * xn <= 11 * rf_size:
+            continue
+        try:
+            y_min, _, y_max, _ = get_center_box(model, layer_index, xn)
+        except RuntimeError:
+            # The image is too small for the downsampling of the model.
+            continue
+        if y_max - y_min + 1 == rf_size and y_min >= 1 and y_min + y_max == xn - 1:
+            return xn
+    raise ValueError(f"Could not find a centered image size for layer {layer_index} "
+                     f"with rf_size = {rf_size}.")
+
+
+def derive_model_info(model: nn.Module, model_name: str,
+                      image_shape: Tuple[int, int] = IMAGE_SHAPE) -> List[Dict]:
+    """
+    Derives the model info of every conv layer of the model.
+
+    Args:
+        model (nn.Module): The model. Only its architecture is used.
+        model_name (str): The name of the model, written in the "model" column.
+        image_shape (tuple of ints): The image size used to index the layers.
+
+    Returns:
+        A list of rows, one dictionary (with the keys COLUMNS) per conv layer.
+    """
+    converter = SpatialIndexConverter(model, image_shape, cache_dir=None)
+    conv_indices = [i for i, layer in enumerate(converter.layers) if isinstance(layer, nn.Conv2d)]
+
+    truncations = TruncationCache(model)
+    rows = []
+    for conv_i, layer_index in enumerate(conv_indices):
+        truncated_model = truncations.get(layer_index)
+        rf_size = get_rf_size(truncated_model, layer_index, image_shape[0])
+        rows.append({"model": model_name,
+                     "layer": f"conv{conv_i + 1}",
+                     "layer_index": layer_index,
+                     "rf_size": rf_size,
+                     "xn": get_xn(truncated_model, layer_index, rf_size),
+                     "num_units": converter.layers[layer_index].out_channels})
+    return rows
+
+
+def format_table(rows: List[Dict]) -> str:
+    """Formats the rows like data/model_info.txt."""
+    lines = [" ".join(COLUMNS)]
+    lines += [" ".join(str(row[column]) for column in COLUMNS) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+def to_rf_data(rows: List[Dict]) -> Dict[str, Dict[str, List[int]]]:
+    """Converts the rows to the rf_data object of the web app."""
+    rf_data = {}
+    for row in rows:
+        model_data = rf_data.setdefault(row["model"], {"layer_indices": [], "rf_sizes": [],
+                                                       "xn": [], "nums_units": []})
+        model_data["layer_indices"].append(row["layer_index"])
+        model_data["rf_sizes"].append(row["rf_size"])
+        model_data["xn"].append(row["xn"])
+        model_data["nums_units"].append(row["num_units"])
+    return rf_data
+
+
+def compare_with_table(rows: List[Dict], model_info: ModelInfo) -> List[str]:
+    """Returns one line per derived row that differs from the model info."""
+    differences = []
+    for row in rows:
+        try:
+            expected = model_info.get_layer_info(row["model"], row["layer"])._asdict()
+        except KeyError:
+            differences.append(f"{row['model']} {row['layer']}: not in the table")
+            continue
+        for column in COLUMNS[2:]:
+            if row[column] != expected[column]:
+                differences.append(f"{row['model']} {row['layer']}: {column} = {row[column]} "
+                                   f"(table: {expected[column]})")
+    return differences
+
+
+if __name__ == '__main__':
+    rows = []
+    for model_name in MODEL_NAMES:
+        print(f"Deriving the model info of {model_name}...")
+        rows += derive_model_info(getattr(models, model_name)(), model_name)
+
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    with open(os.path.join(RESULT_DIR, 'model_info.txt'), 'w') as f:
+        f.write(format_table(rows))
+    with open(os.path.join(RESULT_DIR, 'rf_data.json'), 'w') as f:
+        json.dump(to_rf_data(rows), f, indent=4)
+    print(f"Saved the model info to {RESULT_DIR}")
+
+    differences = compare_with_table(rows, ModelInfo())
+    print(f"{len(differences)} differences with {MODEL_INFO_FILE_PATH}")
+    for difference in differences:
+        print(f"    {difference}")
@@ -5,11 +5,11 @@ Script to plot the distribution of correlation coefficients of each layer.
 
 import os
 
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
 from model_utils import ModelInfo
+from correlation_utils import load_correlations
 
 # Please specify some details here:
 MODEL_NAME = "alexnet"
@@ -19,13 +19,14 @@ OPTIMIZATION_METHOD = 'SGD'
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 CORRELATION_PATH = os.path.join(CURRENT_DIR, os.pardir, 'results',
                                 OPTIMIZATION_METHOD, 'correlation',
-                                f"{MODEL_NAME}_zero_vs_top_patch.txt")
-CORRELATIONS = pd.read_csv(CORRELATION_PATH, delim_whitespace=True)
-CORRELATIONS.columns = ["layer_name", "unit_index", "correlation"]
+                                f"{MODEL_NAME}_zero_vs_top_patch.npz")
+CORRELATIONS = load_correlations(CORRELATION_PATH)
 
 # Define helper function
 def get_layer_correlations(layer_name):
-    return CORRELATIONS.loc[(CORRELATIONS["layer_name"] == layer_name), 'correlation']
+    # Units with a constant result have no correlation
+    layer_corr = CORRELATIONS[layer_name]
+    return layer_corr[~np.isnan(layer_corr)]
 
 # Get the name of layers
 MODEL_INFO = ModelInfo()
@@ -0,0 +1,53 @@
+"""
+Finds redundant units by correlating the gradient ascent result of every unit
+of a layer with every other (RUN_2 = None), or with every result of another
+run (e.g., SGD vs. Adam, or zero- vs. top-patch-initialized). Saves, for each
+layer, the full correlation matrix and the TOP_K most similar pairs of units
+(see correlation_utils.similarity_matrix()).
+
+"""
+
+import os
+
+from model_utils import ModelInfo
+from result_store import open_layer_results
+from correlation_utils import similarity_matrix, top_similar_pairs, save_similarity
+
+# Please specify some details here:
+MODEL_NAME = "alexnet"
+RUN_1 = ('SGD', 'zero_initialized')  # (optimization method, initialization)
+RUN_2 = None  # e.g., ('Adam', 'zero_initialized'). None compares RUN_1 with itself.
+TOP_K = 100  # number of most similar pairs saved per layer
+MAX_BYTES = 1024 ** 3  # memory budget of the normalized results
+
+# Locate the result directories
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results')
+RUN_NAME = "_vs_".join("_".join(run) for run in (RUN_1, RUN_2) if run is not None)
+OUTPUT_DIR = os.path.join(RESULT_DIR, 'similarity', MODEL_NAME, RUN_NAME)
+
+########################### DON'T TOUCH CODE BELOW ############################
+
+MODEL_INFO = ModelInfo()
+LAYER_TABLE = MODEL_INFO.get_layer_table(MODEL_NAME)
+
+
+def open_run_results(run, layer_name):
+    optimization_method, initialization = run
+    layer_dir = os.path.join(RESULT_DIR, optimization_method, initialization, MODEL_NAME, layer_name)
+    return open_layer_results(layer_dir, layer_name)
+
+
+if __name__ == '__main__':
+    for layer in LAYER_TABLE:
+        print(f"Computing the similarity matrix of {layer.layer}...")
+        padding = (layer.xn - layer.rf_size) // 2
+        results1 = open_run_results(RUN_1, layer.layer)
+        results2 = open_run_results(RUN_2, layer.layer) if RUN_2 is not None else None
+
+        matrix = similarity_matrix(results1, results2, padding, max_bytes=MAX_BYTES)
+        pairs = top_similar_pairs(matrix, TOP_K, symmetric=(RUN_2 is None))
+        save_similarity(os.path.join(OUTPUT_DIR, f"{layer.layer}.npz"), matrix, pairs)
+        for unit_i, unit_j, correlation in pairs[:5]:
+            print(f"    units {unit_i} and {unit_j}: {correlation:.4f}")
+    print(f"Saved the similarity matrices to {OUTPUT_DIR}")
@@ -27,47 +27,66 @@ else:
 
 
 import os
-import multiprocessing
-from typing import Tuple
+import functools
 
 import torch
 import numpy as np
-from torchvision import models
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
-from spatial_utils import SpatialIndexConverter
-from model_utils import ModelInfo, get_truncated_model
+from image_store import open_image_source
+from spatial_utils import SpatialIndexConverter, CenterConeModel
+from model_utils import ModelInfo, load_model, TruncationCache
 from tensor_utils import process_tensor
-from image_utils import normalize_img, one_sided_zero_pad
-from grad_ascent import GradientAscent
+from image_writer import ImageWriter
+from image_utils import normalize_img
+from patch_loader import make_patch_requests, PatchLoader
+from grad_ascent import run_gradient_ascent
+from result_cache import ResultCache, hash_model_weights
+from scheduler import make_shards, run_shards, print_report
+from result_store import ResultStore
 
 # Please specify some model details here:
 MODEL_NAME = "alexnet"
 
 # Specify optimization method
 OPTIMIZATION_METHOD = 'SGD'  # options: SGD and Adam
-NUM_ITER = 100
+NUM_ITER = 100  # number of iterations per unit (the maximum if a tolerance is set)
+REL_TOL = None  # e.g. 1e-3: stop a unit early when its response changes less than this (relative)
+GRAD_TOL = None  # e.g. 1e-6: stop a unit early when its gradient norm is at most this
 LR = 0.1
 MOMENTUM = False
+BATCH_SIZE = 64  # number of units optimized together in one forward/backward pass
+NUM_WORKERS = 4  # number of processes. Each layer is split into shards of similar cost.
+RESULT_DTYPE = 'float32'  # dtype of the stored results. Options: 'float32', 'float16' and 'uint8' (lossy)
+USE_CENTER_CONE = True  # only compute the part of each layer that feeds the center unit
 
 # Set the result directory
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results',
                           OPTIMIZATION_METHOD, 'top_patch_initialized', MODEL_NAME)
+CACHE_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'cache')
 
 ########################### DON'T TOUCH CODE BELOW ############################
 
 # Load model and related information
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL = getattr(models, MODEL_NAME)(pretrained=True).to(DEVICE)
+MODEL = load_model(MODEL_NAME, DEVICE)  # the weights are shared by all workers
+TRUNCATIONS = TruncationCache(MODEL)  # the model is traced once for all layers
 MODEL_INFO = ModelInfo()
 LAYER_NAMES = MODEL_INFO.get_layer_names(MODEL_NAME)
 
+# Finished units are cached as they complete, so that a rerun (or a crashed
+# run) only computes the units whose settings have changed.
+RESULT_CACHE = ResultCache(CACHE_DIR)
+MODEL_HASH = hash_model_weights(MODEL)
+
 # Get the image directory
 IMG_SIZE = (227, 227)
 TOP_1 = 0
 IMG_DIR = '/Users/tonyfu/Desktop/Bair Lab/top_and_bottom_images/images'
+# The images packed by make_image_store.py. If they have not been packed, the
+# .npy files in IMG_DIR are read instead.
+IMG_STORE_DIR = os.path.join(os.path.dirname(IMG_DIR), 'images_packed')
 """
 Obviously, I cannot upload the content of IMG_DIR to GitHub because it is too
 big. Here is some more information about the images at IMG_DIR so you can
@@ -103,84 +122,134 @@ I feel the need to explain what these spatial indices are all about. This was an
 # output layer to that of the input layer (i.e., pixel coordinates).
 converter = SpatialIndexConverter(MODEL, IMG_SIZE)
 
+# Only the receptive-field crops are read from the images
+IMAGES = open_image_source(IMG_STORE_DIR if os.path.exists(IMG_STORE_DIR) else IMG_DIR)
+
 
 ##################### Define a few small helper functions #####################
 
-def clip(x, min_value, max_value):
-    return max(min(x, max_value), min_value)
+def get_store_path(layer_name):
+    return os.path.join(RESULT_DIR, layer_name, f"{layer_name}.store")
 
-def pad_box(box: Tuple[int, int, int, int], padding: int):
-    """Makes sure box does not go beyond the image after padding."""
-    y_min, x_min, y_max, x_max = box
-    new_y_min = clip(y_min-padding, 0, IMG_SIZE[0])
-    new_x_min = clip(x_min-padding, 0, IMG_SIZE[1])
-    new_y_max = clip(y_max+padding, 0, IMG_SIZE[0])
-    new_x_max = clip(x_max+padding, 0, IMG_SIZE[1])
-    return new_y_min, new_x_min, new_y_max, new_x_max
+def get_layer_settings(layer_name):
+    # Every setting that can change a result, even only by rounding (e.g.,
+    # the batch size, or the center cone), is part of the keys.
+    return dict(model=MODEL_HASH, layer=layer_name, xn=MODEL_INFO.get_xn(MODEL_NAME, layer_name),
+                optimizer=OPTIMIZATION_METHOD, lr=LR, momentum=MOMENTUM,
+                max_iter=NUM_ITER, rel_tol=REL_TOL, grad_tol=GRAD_TOL,
+                img_size=IMG_SIZE, batch_size=BATCH_SIZE,
+                center_cone=USE_CENTER_CONE, device=DEVICE.type)
+
+def get_cache_key(layer_name, request):
+    return RESULT_CACHE.make_key(unit_index=request.unit_index,
+                                 init=f'top_patch {TOP_1} {request.img_index} {request.patch_index}',
+                                 **get_layer_settings(layer_name))
 
 ###############################################################################
 
-def create_visualizations_for_layer(layer_name):
+def create_visualizations_for_shard(shard):
     # Determine layer-specific information
-    num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+    layer_name = shard.layer_name
     layer_index = MODEL_INFO.get_layer_index(MODEL_NAME, layer_name)
     xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
     rf_size = MODEL_INFO.get_rf_size(MODEL_NAME, layer_name)
     padding = (xn - rf_size) // 2
     
     # Use the truncated model to save time
-    truncated_model = get_truncated_model(MODEL, layer_index)
+    truncated_model = TRUNCATIONS.get(layer_index)
+    if USE_CENTER_CONE:
+        truncated_model = CenterConeModel(truncated_model, (xn, xn))
 
     # Define the output directory, create it if necessary
     layer_dir = os.path.join(RESULT_DIR, layer_name)
-    if not os.path.exists(layer_dir):
-        os.makedirs(layer_dir)
+    os.makedirs(layer_dir, exist_ok=True)
 
     # Find the top- and bottom-100 image patches ranking of the layer
     max_min_indicies = get_max_min_indicies(layer_name)
     
-    # We will also store the results in a numpy array
-    result_array = np.zeros((num_units, xn, xn, 3))
-    
-    for unit_index in tqdm(range(num_units)):
-        # Get top and bottom image indices and patch spatial indices
-        max_n_img_index   = max_min_indicies[unit_index, TOP_1, 0]
-        max_n_patch_index = max_min_indicies[unit_index, TOP_1, 1]
-
-        # Convert from output spatial index to pixel coordinate
-        box = converter.convert(max_n_patch_index, layer_index, 0, is_forward=False)
-        
-        # Prevent indexing out of range
-        y_min, x_min, y_max, x_max = pad_box(box, padding)
-        
-        # Load the image
-        img_path = os.path.join(IMG_DIR, f"{max_n_img_index}.npy")
-        img_numpy = np.load(img_path)[:, y_min:y_max+1, x_min:x_max+1]
-        
-        # Pad it to (3, xn, xn) if necessary
-        img_numpy = one_sided_zero_pad(img_numpy, xn, (y_min, x_min, y_max, x_max))
-        
-        # Convert to tensor
-        img = torch.from_numpy(img_numpy).type('torch.FloatTensor').unsqueeze(0)
-        img.requires_grad = True
-        img.to(DEVICE)
-        
-        # Computer gradient ascent
-        ga = GradientAscent(truncated_model, unit_index, img, lr=LR,
-                            optimizer=OPTIMIZATION_METHOD, momentum=MOMENTUM)
-        for i in range(NUM_ITER - 1):
-            ga.step()
-        result = ga.step()
-        
-        # Save result to an image
-        result_array[unit_index] = normalize_img(process_tensor(result, normalize=False) - img_numpy.transpose(1, 2, 0))
-        plt.imshow(result_array[unit_index])
-        plt.axis('off')
-        plt.savefig(os.path.join(layer_dir, f"{unit_index}.png"))
-        plt.close()
-        
-    np.save(os.path.join(layer_dir, f"{layer_name}.npy"), result_array)
+    # The results are written to the store of the layer unit by unit, and the
+    # images are encoded on background threads while the ascent goes on. Both
+    # are closed even if the ascent fails.
+    with ResultStore(get_store_path(layer_name), mode='r+') as store, ImageWriter() as writer:
+        # Skip the units written by an earlier (interrupted) run
+        unit_indices = [unit_index for unit_index in shard.unit_indices if not store.is_written(unit_index)]
+        if len(unit_indices) < len(shard.unit_indices):
+            print(f"{MODEL_NAME} {layer_name}: {len(shard.unit_indices) - len(unit_indices)} units already done.")
+
+        # The patches are loaded in batches on a background thread, and each
+        # image is read only once. A patch is kept until the result of its
+        # unit has been saved.
+        requests = make_patch_requests(max_min_indicies, converter, layer_index,
+                                       unit_indices, padding, IMG_SIZE, rank=TOP_1)
+        unit_requests = {request.unit_index: request for request in requests}
+        patch_loader = PatchLoader(IMAGES, requests, xn, batch_size=BATCH_SIZE)
+        patch_batches = iter(patch_loader)
+        unit_patches = {}
+
+        def save_result(unit_index, result):
+            # Save result to an image and to the result store. The unit is
+            # marked as written only once its image has been saved, so that
+            # the images lost by a killed run are made again when resuming.
+            img_numpy = unit_patches.pop(unit_index)
+            unit_result = normalize_img(process_tensor(result, normalize=False) - img_numpy.transpose(1, 2, 0))
+            writer.write(os.path.join(layer_dir, f"{unit_index}.png"), unit_result,
+                         on_saved=functools.partial(store.write, unit_index, unit_result))
+
+        # Reuse the cached results. They are saved as soon as their patches
+        # are loaded.
+        cached_units = {request.unit_index for request in requests
+                        if get_cache_key(layer_name, request) in RESULT_CACHE}
+        if cached_units:
+            print(f"{MODEL_NAME} {layer_name}: {len(cached_units)} units loaded from cache.")
+
+        def load_next_batch():
+            batch = next(patch_batches, None)
+            if batch is None:
+                return False
+            for request, patch in zip(*batch):
+                unit_patches[request.unit_index] = patch
+                if request.unit_index in cached_units:
+                    cached_result = RESULT_CACHE.get(get_cache_key(layer_name, request))
+                    save_result(request.unit_index, torch.from_numpy(cached_result))
+            return True
+
+        # The units start from their top patches, which are pulled from the
+        # loader as the units join the batch.
+        def init_img_fn(unit_index):
+            while unit_index not in unit_patches:
+                if not load_next_batch():
+                    raise KeyError(f"The loader has no patch for unit {unit_index}.")
+            return torch.from_numpy(unit_patches[unit_index]).unsqueeze(0).to(DEVICE)
+
+        # Computer gradient ascent. Up to BATCH_SIZE units are optimized at
+        # once, in the order of the loader, and a unit that stops early gives
+        # its place to the next one.
+        pending_units = [request.unit_index for request in patch_loader.requests
+                         if request.unit_index not in cached_units]
+        results = run_gradient_ascent(truncated_model, pending_units, init_img_fn,
+                                      batch_size=BATCH_SIZE, lr=LR, optimizer=OPTIMIZATION_METHOD,
+                                      momentum=MOMENTUM, max_iter=NUM_ITER, rel_tol=REL_TOL,
+                                      grad_tol=GRAD_TOL)
+        for unit_index, result, _ in tqdm(results, total=len(pending_units)):
+            RESULT_CACHE.put(get_cache_key(layer_name, unit_requests[unit_index]), result)
+            save_result(unit_index, result)
+
+        # Save the cached results of the patches that have not been loaded yet
+        while load_next_batch():
+            pass
 
 if __name__ == '__main__':
-    with multiprocessing.Pool(processes=len(LAYER_NAMES)) as pool:
-        pool.map(create_visualizations_for_layer, LAYER_NAMES)
+    shards = make_shards(MODEL_NAME, MODEL_INFO, num_workers=NUM_WORKERS)
+
+    # Allocate the result store of each layer, or reopen it if an earlier
+    # run with the same settings was interrupted. The workers write their
+    # units into it as soon as they are done.
+    for layer_name in LAYER_NAMES:
+        num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+        xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
+        store_key = RESULT_CACHE.make_key(init=f'top_patch {TOP_1}', **get_layer_settings(layer_name))
+        ResultStore.open_or_create(get_store_path(layer_name), num_units, (xn, xn, 3),
+                                   dtype=RESULT_DTYPE, key=store_key).close()
+
+    _, report = run_shards(create_visualizations_for_shard, shards, NUM_WORKERS)
+    print_report(report)
@@ -26,18 +26,18 @@ else:
 
 
 import os
-import multiprocessing
-from typing import Tuple
 
 import torch
 import numpy as np
-from torchvision import models
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
+from image_store import open_image_source
 from spatial_utils import SpatialIndexConverter
-from model_utils import ModelInfo
-from image_utils import one_sided_zero_pad, normalize_img
+from model_utils import ModelInfo, load_model
+from image_utils import normalize_img
+from patch_loader import make_patch_requests, PatchLoader
+from image_writer import ImageWriter
+from scheduler import make_shards, run_shards, print_report
 
 # Please specify some model details here:
 MODEL_NAME = "alexnet"
@@ -45,12 +45,14 @@ MODEL_NAME = "alexnet"
 # Set the result directory
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'top_patch', MODEL_NAME)
+NUM_WORKERS = 4  # number of processes. Each layer is split into shards of similar cost.
+BATCH_SIZE = 64  # number of patches loaded at a time
 
 ########################### DON'T TOUCH CODE BELOW ############################
 
 # Load model and related information
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL = getattr(models, MODEL_NAME)(pretrained=True).to(DEVICE)
+MODEL = load_model(MODEL_NAME, DEVICE)  # the weights are shared by all workers
 MODEL_INFO = ModelInfo()
 LAYER_NAMES = MODEL_INFO.get_layer_names(MODEL_NAME)
 
@@ -58,6 +60,9 @@ LAYER_NAMES = MODEL_INFO.get_layer_names(MODEL_NAME)
 IMG_SIZE = (227, 227)
 TOP_1 = 0
 IMG_DIR = '/Users/tonyfu/Desktop/Bair Lab/top_and_bottom_images/images'
+# The images packed by make_image_store.py. If they have not been packed, the
+# .npy files in IMG_DIR are read instead.
+IMG_STORE_DIR = os.path.join(os.path.dirname(IMG_DIR), 'images_packed')
 """
 Obviously, I cannot upload the content of IMG_DIR to GitHub because it is too
 big. Here is some more information about the images at IMG_DIR so you can
@@ -94,26 +99,15 @@ I feel the need to explain what these spatial indices are all about. This was an
 # output layer to that of the input layer (i.e., pixel coordinates).
 converter = SpatialIndexConverter(MODEL, IMG_SIZE)
 
+# Only the receptive-field crops are read from the images
+IMAGES = open_image_source(IMG_STORE_DIR if os.path.exists(IMG_STORE_DIR) else IMG_DIR)
 
-##################### Define a few small helper functions #####################
-
-def clip(x, min_value, max_value):
-    return max(min(x, max_value), min_value)
-
-def pad_box(box: Tuple[int, int, int, int], padding: int):
-    """Makes sure box does not go beyond the image after padding."""
-    y_min, x_min, y_max, x_max = box
-    new_y_min = clip(y_min-padding, 0, IMG_SIZE[0])
-    new_x_min = clip(x_min-padding, 0, IMG_SIZE[1])
-    new_y_max = clip(y_max+padding, 0, IMG_SIZE[0])
-    new_x_max = clip(x_max+padding, 0, IMG_SIZE[1])
-    return new_y_min, new_x_min, new_y_max, new_x_max
 
 ###############################################################################
 
-def save_image_patch_for_layer(layer_name):
+def save_image_patch_for_shard(shard):
     # Determine layer-specific information
-    num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+    layer_name = shard.layer_name
     layer_index = MODEL_INFO.get_layer_index(MODEL_NAME, layer_name)
     xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
     rf_size = MODEL_INFO.get_rf_size(MODEL_NAME, layer_name)
@@ -122,37 +116,28 @@ def save_image_patch_for_layer(layer_name):
 
     # Define the output directory, create it if necessary
     layer_dir = os.path.join(RESULT_DIR, layer_name)
-    if not os.path.exists(layer_dir):
-        os.makedirs(layer_dir)
+    os.makedirs(layer_dir, exist_ok=True)
 
     # Find the top- and bottom-100 image patches ranking of the layer
     max_min_indicies = get_max_min_indicies(layer_name)
 
-    
-    for unit_index in tqdm(range(num_units)):
-        # Get top and bottom image indices and patch spatial indices
-        max_n_img_index   = max_min_indicies[unit_index, TOP_1, 0]
-        max_n_patch_index = max_min_indicies[unit_index, TOP_1, 1]
-
-        # Convert from output spatial index to pixel coordinate
-        box = converter.convert(max_n_patch_index, layer_index, 0, is_forward=False)
-        
-        # Prevent indexing out of range
-        y_min, x_min, y_max, x_max = pad_box(box, padding)
-        
-        # Load the image
-        img_path = os.path.join(IMG_DIR, f"{max_n_img_index}.npy")
-        img_numpy = np.load(img_path)[:, y_min:y_max+1, x_min:x_max+1]
-        
-        # Pad it to (3, xn, xn) if necessary
-        img_numpy = one_sided_zero_pad(img_numpy, xn, (y_min, x_min, y_max, x_max))
-        img_numpy = normalize_img(img_numpy)
-        
-        plt.imshow(img_numpy.transpose(1, 2, 0))
-        plt.axis('off')
-        plt.savefig(os.path.join(layer_dir, f"{unit_index}.png"))
-        plt.close()
+    # The patches are loaded in batches on a background thread, and each image
+    # is read only once
+    requests = make_patch_requests(max_min_indicies, converter, layer_index,
+                                   shard.unit_indices, padding, IMG_SIZE, rank=TOP_1)
+    patch_loader = PatchLoader(IMAGES, requests, xn, batch_size=BATCH_SIZE)
+
+    # The images are encoded on background threads while the next patches load
+    with ImageWriter() as writer:
+        for batch_requests, patches in tqdm(patch_loader):
+            for request, img_numpy in zip(batch_requests, patches):
+                img_numpy = normalize_img(img_numpy)
+                writer.write(os.path.join(layer_dir, f"{request.unit_index}.png"), img_numpy.transpose(1, 2, 0))
 
 if __name__ == '__main__':
-    with multiprocessing.Pool(processes=len(LAYER_NAMES)) as pool:
-        pool.map(save_image_patch_for_layer, LAYER_NAMES)
+    # No gradient ascent here, so the cost of a unit does not depend much on
+    # the layer
+    shards = make_shards(MODEL_NAME, MODEL_INFO, num_workers=NUM_WORKERS,
+                         cost_fn=lambda xn, layer_index: xn ** 2)
+    _, report = run_shards(save_image_patch_for_shard, shards, NUM_WORKERS)
+    print_report(report)
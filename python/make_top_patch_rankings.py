@@ -0,0 +1,84 @@
+"""
+Ranks the top- and bottom-100 image patches of every unit of a model over the
+50,000 images, i.e., regenerates the data/top_100_image_patches/<model>
+arrays read by the top-patch scripts (see patch_ranking.py for the format).
+
+The images are split into one shard per worker. Every worker ranks all conv
+layers of its shard in one pass and checkpoints its progress, so a rerun
+after an interruption resumes where it stopped. The rankings of the shards
+are merged at the end. Copy the results to data/top_100_image_patches to use
+them in the top-patch scripts.
+
+"""
+
+import os
+
+import numpy as np
+import torch
+
+from image_store import open_image_source
+from model_utils import ModelInfo, load_model, TruncationCache
+from patch_ranking import make_image_shards, rank_images, load_rankers
+from scheduler import run_shards, print_report
+
+# Please specify some model details here:
+MODEL_NAME = "alexnet"
+NUM_IMAGES = 50000
+TOP_K = 100  # number of patches kept per unit and direction
+BATCH_SIZE = 64  # number of images per forward pass
+NUM_WORKERS = 4  # number of processes, each ranking its own shard of the images
+CHECKPOINT_EVERY = 50  # number of batches between checkpoints
+
+# Set the result directory
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'top_100_image_patches', MODEL_NAME)
+CHECKPOINT_DIR = os.path.join(RESULT_DIR, 'checkpoints')
+
+# The images packed by make_image_store.py. If they have not been packed, the
+# .npy files in IMG_DIR are read instead.
+IMG_DIR = '/Users/tonyfu/Desktop/Bair Lab/top_and_bottom_images/images'
+IMG_STORE_DIR = os.path.join(os.path.dirname(IMG_DIR), 'images_packed')
+
+########################### DON'T TOUCH CODE BELOW ############################
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+MODEL = load_model(MODEL_NAME, DEVICE)  # the weights are shared by all workers
+TRUNCATIONS = TruncationCache(MODEL)  # the model is traced once for all layers
+MODEL_INFO = ModelInfo()
+LAYER_TABLE = MODEL_INFO.get_layer_table(MODEL_NAME)
+IMAGES = open_image_source(IMG_STORE_DIR if os.path.exists(IMG_STORE_DIR) else IMG_DIR)
+
+
+def get_checkpoint_path(shard):
+    return os.path.join(CHECKPOINT_DIR, f"shard_{shard.shard_index:03d}.npz")
+
+
+def rank_shard(shard):
+    print(f"Ranking images {shard.img_start}-{shard.img_stop - 1}...")
+    rank_images(TRUNCATIONS, [layer.layer_index for layer in LAYER_TABLE], IMAGES,
+                shard.img_indices, k=TOP_K, batch_size=BATCH_SIZE, device=DEVICE,
+                checkpoint_path=get_checkpoint_path(shard), checkpoint_every=CHECKPOINT_EVERY)
+    return get_checkpoint_path(shard)
+
+
+if __name__ == '__main__':
+    shards = make_image_shards(NUM_IMAGES, NUM_WORKERS)
+
+    # Merge the top-k of every shard as soon as it is done, so that only the
+    # merged rankers are held in memory
+    rankers = {}
+
+    def merge_shard(shard, checkpoint_path):
+        for layer_index, ranker in load_rankers(checkpoint_path)[0].items():
+            if layer_index in rankers:
+                rankers[layer_index].merge(ranker)
+            else:
+                rankers[layer_index] = ranker
+
+    _, report = run_shards(rank_shard, shards, NUM_WORKERS, result_fn=merge_shard)
+    print_report(report)
+
+    for layer in LAYER_TABLE:
+        np.save(os.path.join(RESULT_DIR, f"{layer.layer}.npy"),
+                rankers[layer.layer_index].get_ranking())
+    print(f"Saved the rankings to {RESULT_DIR}")
@@ -27,18 +27,21 @@ Tony Fu, Bair Lab, March 2023
 
 
 import os
-import multiprocessing
+import functools
 
 import torch
-import torchvision.models as models
-import numpy as np
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 # Custom modules
-from model_utils import ModelInfo, get_truncated_model
+from model_utils import ModelInfo, load_model, TruncationCache, prune_output_channels
+from spatial_utils import CenterConeModel
 from tensor_utils import process_tensor
-from grad_ascent import GradientAscent
+from image_writer import ImageWriter
+from grad_ascent import run_gradient_ascent, precision_fidelity_report
+from compile_utils import get_compiled_model
+from result_cache import ResultCache, hash_model_weights
+from scheduler import make_shards, run_shards, print_report
+from result_store import ResultStore
 
 # Specify the model and optimization method of interest
 MODEL_NAME = 'alexnet'
@@ -46,54 +49,219 @@ OPTIMIZATION_METHOD = 'SGD'  # options: SGD and Adam
 
 # Setting up
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL = getattr(models, MODEL_NAME)(pretrained=True).to(DEVICE)
+MODEL = load_model(MODEL_NAME, DEVICE)  # the weights are shared by all workers
+TRUNCATIONS = TruncationCache(MODEL)  # the model is traced once for all layers
 MODEL_INFO = ModelInfo()
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 RESULT_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results',
                           OPTIMIZATION_METHOD, 'zero_initialized', MODEL_NAME)
+CACHE_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'cache')
 
 # Compute Gradient Ascent visualizations and save them to .png
-NUM_ITER = 100
+NUM_ITER = 100  # number of iterations per unit (the maximum if a tolerance is set)
+REL_TOL = None  # e.g. 1e-3: stop a unit early when its response changes less than this (relative)
+GRAD_TOL = None  # e.g. 1e-6: stop a unit early when its gradient norm is at most this
 LR = 0.1
 MOMENTUM = False
+BATCH_SIZE = 64  # number of units optimized together in one forward/backward pass
+USE_CENTER_CONE = True  # only compute the part of each layer that feeds the center unit
+PRUNE_OUTPUT_CHANNELS = True  # only compute the channels of the units in the batch
+DEAD_UNITS = 'skip'  # units with zero gradient at the zero image. Options: None, 'skip', 'restart'
+RESTART_SEED = 0  # seed of the noise of the restarted dead units. None: unseeded (and not cached)
+COMPILE_BACKEND = None  # None (eager), 'fuse', 'torchscript', or 'inductor'. See compile_utils.py
+PRECISION = 'float32'  # options: 'float32' and 'bfloat16'
+FIDELITY_SAMPLES = 8  # number of units per layer compared against float32 if PRECISION is reduced
+FIDELITY_MIN_CORRELATION = 0.99  # minimum correlation of the float32 and reduced precision results
+FIDELITY_MAX_RESPONSE_DELTA = 0.02  # maximum relative change of the response
+FIDELITY_FAILURE = 'fallback'  # if a layer fails the check. Options: 'fallback' (use float32) and 'raise'
+NUM_WORKERS = 4  # number of processes. Each layer is split into shards of similar cost.
+RESULT_DTYPE = 'float32'  # dtype of the stored results. Options: 'float32', 'float16' and 'uint8' (lossy)
 LAYER_NAMES = MODEL_INFO.get_layer_names(MODEL_NAME)
 
+# Finished units are cached as they complete, so that a rerun (or a crashed
+# run) only computes the units whose settings have changed.
+RESULT_CACHE = ResultCache(CACHE_DIR)
+MODEL_HASH = hash_model_weights(MODEL)
+# Unseeded restarts are random, so their results cannot be reused.
+USE_CACHE = not (DEAD_UNITS == 'restart' and RESTART_SEED is None)
 
-def create_visualizations_for_layer(layer_name):
-    # Get layer-specific information
-    num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+
+def get_layer_settings(layer_name, precision):
+    # Every setting that can change a result, even only by rounding (e.g.,
+    # the batch size, or the center cone), is part of the keys.
+    return dict(model=MODEL_HASH, layer=layer_name, xn=MODEL_INFO.get_xn(MODEL_NAME, layer_name),
+                optimizer=OPTIMIZATION_METHOD, lr=LR, momentum=MOMENTUM,
+                max_iter=NUM_ITER, rel_tol=REL_TOL, grad_tol=GRAD_TOL, init='zero',
+                dead_units=DEAD_UNITS,
+                restart_seed=RESTART_SEED if DEAD_UNITS == 'restart' else None,
+                precision=precision, batch_size=BATCH_SIZE, center_cone=USE_CENTER_CONE,
+                prune_output_channels=PRUNE_OUTPUT_CHANNELS and COMPILE_BACKEND is None,
+                compile_backend=COMPILE_BACKEND, device=DEVICE.type)
+
+
+def get_cache_key(layer_name, unit_index, precision):
+    return RESULT_CACHE.make_key(unit_index=unit_index, **get_layer_settings(layer_name, precision))
+
+
+def get_store_path(layer_name):
+    return os.path.join(RESULT_DIR, layer_name, f"{layer_name}.store")
+
+
+def get_layer_models(layer_name):
+    """Returns the truncated model of the layer, and the function that builds the model of a batch."""
     xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
     layer_index = MODEL_INFO.get_layer_index(MODEL_NAME, layer_name)
-    truncated_model = get_truncated_model(MODEL, layer_index)
-    print(f"Creating Gradient Ascent visualizations for {MODEL_NAME} {layer_name}...")
+    truncated_model = TRUNCATIONS.get(layer_index)
+
+    if COMPILE_BACKEND is not None:
+        # The compiled model is not pruned, because it would have to be
+        # recompiled every time the units in the batch change.
+        truncated_model = get_compiled_model(TRUNCATIONS, layer_index, (xn, xn),
+                                             backend=COMPILE_BACKEND,
+                                             center_cone=USE_CENTER_CONE,
+                                             model_name=MODEL_NAME)
+        return truncated_model, None
+
+    if USE_CENTER_CONE:
+        cone_model = CenterConeModel(truncated_model, (xn, xn))
+
+    # Only compute the channels of the units in the batch (and of the next
+    # units to join it)
+    def get_batch_model(unit_indices):
+        batch_model = truncated_model
+        if PRUNE_OUTPUT_CHANNELS:
+            batch_model = prune_output_channels(truncated_model, unit_indices)
+        if USE_CENTER_CONE:
+            batch_model = cone_model.rebind(batch_model)
+        return batch_model
+
+    return truncated_model, get_batch_model
+
+
+def get_ascent_kwargs(get_batch_model):
+    return dict(batch_size=BATCH_SIZE, lr=LR, optimizer=OPTIMIZATION_METHOD,
+                momentum=MOMENTUM, max_iter=NUM_ITER, rel_tol=REL_TOL, grad_tol=GRAD_TOL,
+                model_fn=get_batch_model)
+
+
+def check_precision(layer_name):
+    """
+    Compares PRECISION with float32 on a sample of the units of the layer, and
+    returns the precision to use for the layer.
+    """
+    xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
+    num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+    truncated_model, get_batch_model = get_layer_models(layer_name)
+
+    def init_img_fn(unit_index):
+        return torch.zeros(1, 3, xn, xn, device=DEVICE)
+
+    report = precision_fidelity_report(truncated_model, range(num_units), init_img_fn,
+                                       precision=PRECISION, num_samples=FIDELITY_SAMPLES,
+                                       min_correlation=FIDELITY_MIN_CORRELATION,
+                                       max_response_delta=FIDELITY_MAX_RESPONSE_DELTA,
+                                       **get_ascent_kwargs(get_batch_model))
+    layer_dir = os.path.join(RESULT_DIR, layer_name)
+    os.makedirs(layer_dir, exist_ok=True)
+    with open(os.path.join(layer_dir, f"{PRECISION}_fidelity.txt"), "w") as f:
+        f.write("unit_index correlation response_float32 response_reduced response_delta "
+                "relative_delta passed\n")
+        for row in report:
+            f.write(f"{row['unit_index']} {row['correlation']:.4f} {row['response_float32']:.4f} "
+                    f"{row['response_reduced']:.4f} {row['response_delta']:.4f} "
+                    f"{row['relative_delta']:.4f} {row['passed']}\n")
+
+    if all(row['passed'] for row in report):
+        return PRECISION
+    message = (f"{MODEL_NAME} {layer_name}: {PRECISION} does not reproduce the float32 results "
+               f"(see {PRECISION}_fidelity.txt)")
+    if FIDELITY_FAILURE == 'raise':
+        raise RuntimeError(message)
+    print(f"{message}. Using float32 for this layer.")
+    return 'float32'
+
+
+def create_visualizations_for_shard(shard, layer_precisions):
+    # Get layer-specific information
+    layer_name = shard.layer_name
+    unit_indices = list(shard.unit_indices)
+    xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
+    precision = layer_precisions[layer_name]
+    print(f"Creating Gradient Ascent visualizations for {MODEL_NAME} {layer_name} "
+          f"units {shard.unit_start}-{shard.unit_stop - 1}...")
     
     # Create directory to store results
     layer_dir = os.path.join(RESULT_DIR, layer_name)
-    if not os.path.exists(layer_dir):
-        os.makedirs(layer_dir)
+    os.makedirs(layer_dir, exist_ok=True)
     
-    # We will also store the results in a numpy array
-    result_array = np.zeros((num_units, xn, xn, 3))
-
-    for unit_index in tqdm(range(num_units)):
-        # Computer gradient ascent
-        img = torch.zeros(1, 3, xn, xn, requires_grad=True, device=DEVICE)
-        ga = GradientAscent(truncated_model, unit_index, img, lr=LR,
-                            optimizer=OPTIMIZATION_METHOD, momentum=MOMENTUM)
-        for i in range(NUM_ITER - 1):
-            ga.step()
-        result = ga.step()
-        
-        # Save result to an image
-        result_array[unit_index] = process_tensor(result)
-        plt.imshow(result_array[unit_index])
-        plt.axis('off')
-        plt.savefig(os.path.join(layer_dir, f"{unit_index}.png"))
-        plt.close()
-    
-    np.save(os.path.join(layer_dir, f"{layer_name}.npy"), result_array)
+    truncated_model, get_batch_model = get_layer_models(layer_name)
+
+    def init_img_fn(unit_index):
+        return torch.zeros(1, 3, xn, xn, device=DEVICE)
+
+    # The results are written to the store of the layer unit by unit, and the
+    # images are encoded on background threads while the ascent goes on. Both
+    # are closed even if the ascent fails.
+    with ResultStore(get_store_path(layer_name), mode='r+') as store, ImageWriter() as writer:
+        # Skip the units written by an earlier (interrupted) run
+        unit_indices = [unit_index for unit_index in unit_indices if not store.is_written(unit_index)]
+        if len(unit_indices) < len(shard.unit_indices):
+            print(f"{MODEL_NAME} {layer_name}: {len(shard.unit_indices) - len(unit_indices)} units already done.")
+
+        def save_result(unit_index, result):
+            # Save result to an image and to the result store. The unit is
+            # marked as written only once its image has been saved, so that
+            # the images lost by a killed run are made again when resuming.
+            unit_result = process_tensor(result)
+            writer.write(os.path.join(layer_dir, f"{unit_index}.png"), unit_result,
+                         on_saved=functools.partial(store.write, unit_index, unit_result))
+
+        # Reuse the cached results
+        pending_units = []
+        for unit_index in unit_indices:
+            cached_result = None
+            if USE_CACHE:
+                cached_result = RESULT_CACHE.get(get_cache_key(layer_name, unit_index, precision))
+            if cached_result is None:
+                pending_units.append(unit_index)
+            else:
+                save_result(unit_index, torch.from_numpy(cached_result))
+        if len(pending_units) < len(unit_indices):
+            print(f"{MODEL_NAME} {layer_name}: {len(unit_indices) - len(pending_units)} units loaded from cache.")
+
+        # Computer gradient ascent. Up to BATCH_SIZE units are optimized at once,
+        # and a unit that stops early gives its place to the next one.
+        results = run_gradient_ascent(truncated_model, pending_units, init_img_fn,
+                                      dead_units=DEAD_UNITS, seed=RESTART_SEED, precision=precision,
+                                      **get_ascent_kwargs(get_batch_model))
+        for unit_index, result, stats in tqdm(results, total=len(pending_units)):
+            if stats.status == 'dead':
+                print(f"{MODEL_NAME} {layer_name} unit {unit_index} has no gradient at the zero image.")
+            if USE_CACHE:
+                RESULT_CACHE.put(get_cache_key(layer_name, unit_index, precision), result)
+            save_result(unit_index, result)
 
 
 if __name__ == '__main__':
-    with multiprocessing.Pool(processes=len(LAYER_NAMES)) as pool:
-        pool.map(create_visualizations_for_layer, LAYER_NAMES)
+    shards = make_shards(MODEL_NAME, MODEL_INFO, num_workers=NUM_WORKERS, min_units=BATCH_SIZE)
+
+    # Check the reduced precision once per layer, before any work is handed
+    # out, and fall back to float32 for the layers where it fails.
+    layer_precisions = {layer_name: PRECISION for layer_name in LAYER_NAMES}
+    if PRECISION != 'float32':
+        for layer_name in LAYER_NAMES:
+            layer_precisions[layer_name] = check_precision(layer_name)
+
+    # Allocate the result store of each layer, or reopen it if an earlier
+    # run with the same settings was interrupted. The workers write their
+    # units into it as soon as they are done.
+    for layer_name in LAYER_NAMES:
+        num_units = MODEL_INFO.get_num_units(MODEL_NAME, layer_name)
+        xn = MODEL_INFO.get_xn(MODEL_NAME, layer_name)
+        store_key = RESULT_CACHE.make_key(**get_layer_settings(layer_name, layer_precisions[layer_name]))
+        ResultStore.open_or_create(get_store_path(layer_name), num_units, (xn, xn, 3),
+                                   dtype=RESULT_DTYPE, key=store_key).close()
+
+    shard_fn = functools.partial(create_visualizations_for_shard, layer_precisions=layer_precisions)
+    _, report = run_shards(shard_fn, shards, NUM_WORKERS)
+    print_report(report)
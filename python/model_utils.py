@@ -7,50 +7,127 @@ Tony Fu, Bair Lab, Feb 2023
 
 import os
 import copy
+import inspect
+import itertools
+import operator
+import tempfile
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
-import pandas as pd
+import torch
 import torch.fx as fx
 import torch.nn as nn
+from torchvision import models
 
-__all__ = ['ModelInfo', 'get_truncated_model']
+__all__ = ['LayerInfo', 'ModelInfo', 'load_model', 'copy_module_structure',
+           'TruncationCache', 'get_truncated_model', 'get_multi_output_model',
+           'prune_output_channels']
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 MODEL_INFO_FILE_PATH = os.path.join(CURRENT_DIR, os.pardir, "data", "model_info.txt")
+WEIGHTS_DIR = os.path.join(CURRENT_DIR, os.pardir, "results", "weights")
+
+
+class LayerInfo(NamedTuple):
+    """One row of the model information file."""
+    layer: str
+    layer_index: int
+    rf_size: int
+    xn: int
+    num_units: int
 
 
 class ModelInfo:
     """
-    A class for loading and accessing model information from a CSV file.
+    A class for loading and accessing model information from a text file
+    (data/model_info.txt by default).
+
+    The rows are indexed by model and layer name when the file is loaded, so
+    every lookup takes constant time. pandas is only imported by
+    to_dataframe().
 
     Attributes:
-        model_info (pandas.DataFrame): The model information, loaded from the
-        CSV file.
+        model_info (dict): {model_name: {layer_name: LayerInfo}}, with the
+        layers in the order of the file.
 
     """
-    def __init__(self):
+    COLUMNS = ["model", "layer", "layer_index", "rf_size", "xn", "num_units"]
+
+    def __init__(self, model_info_file_path: str = MODEL_INFO_FILE_PATH):
         """
         Initializes a new instance of the ModelInfo class.
 
+        Args:
+            model_info_file_path (str): The path to the file containing the
+            model information.
+
         """
-        self.model_info = self._load_model_info(MODEL_INFO_FILE_PATH)
+        self.model_info = self._load_model_info(model_info_file_path)
 
-    def _load_model_info(self, model_info_file_path: str) -> pd.DataFrame:
+    def _load_model_info(self, model_info_file_path: str) -> Dict[str, Dict[str, LayerInfo]]:
         """
-        Loads the model info from the specified CSV file.
+        Loads the model info from the specified whitespace-separated file.
 
         Args:
-            model_info_file_path (str): The path to the CSV file containing the
-            model information.
+            model_info_file_path (str): The path to the file containing the
+            model information. The first line is the header.
 
         Returns:
-            pandas.DataFrame: The model information, loaded from the CSV file.
+            dict: {model_name: {layer_name: LayerInfo}}.
 
         """
-        model_info = pd.read_csv(model_info_file_path, delim_whitespace=True)
-        model_info.columns = ["model", "layer", "layer_index", "rf_size", "xn", "num_units"]
+        model_info = {}
+        with open(model_info_file_path) as f:
+            lines = [line.split() for line in f if line.strip()]
+        for values in lines[1:]:
+            if len(values) != len(self.COLUMNS):
+                raise ValueError(f"Expected the columns {self.COLUMNS} in "
+                                 f"{model_info_file_path}, but got the row {values}")
+            model_name, layer_name, *numbers = values
+            model_info.setdefault(model_name, {})[layer_name] = \
+                LayerInfo(layer_name, *(int(number) for number in numbers))
         return model_info
 
-    def get_layer_names(self, model_name: str) -> int:
+    def _get_layers(self, model_name: str) -> Dict[str, LayerInfo]:
+        try:
+            return self.model_info[model_name]
+        except KeyError:
+            raise KeyError(f"Model '{model_name}' not found. "
+                           f"Options: {list(self.model_info)}") from None
+
+    def get_layer_info(self, model_name: str, layer_name: str) -> LayerInfo:
+        """
+        Returns all information about the specified layer.
+
+        Args:
+            model_name (str): The name of the model.
+            layer_name (str): The name of the layer.
+
+        Returns:
+            LayerInfo: The row of the layer.
+
+        """
+        layers = self._get_layers(model_name)
+        try:
+            return layers[layer_name]
+        except KeyError:
+            raise KeyError(f"Layer '{layer_name}' not found in {model_name}. "
+                           f"Options: {list(layers)}") from None
+
+    def get_layer_table(self, model_name: str) -> List[LayerInfo]:
+        """
+        Returns the information about all conv layers of the specified model
+        at once, in the order of the file.
+
+        Args:
+            model_name (str): The name of the model.
+
+        Returns:
+            list of LayerInfo: One row per layer.
+
+        """
+        return list(self._get_layers(model_name).values())
+
+    def get_layer_names(self, model_name: str) -> List[str]:
         """
         Returns the names of all conv layers of the specified model.
 
@@ -61,8 +138,7 @@ class ModelInfo:
             list of string: The names of layers in the model.
 
         """
-        return self.model_info.loc[(self.model_info['model'] == model_name)
-                                   , 'layer']
+        return list(self._get_layers(model_name))
 
     def get_layer_index(self, model_name: str, layer_name: str) -> int:
         """
@@ -76,8 +152,7 @@ class ModelInfo:
             int: The index of the specified layer in the model.
 
         """
-        return self.model_info.loc[(self.model_info['model'] == model_name) &
-                                   (self.model_info['layer'] == layer_name), 'layer_index'].iloc[0]
+        return self.get_layer_info(model_name, layer_name).layer_index
 
     def get_num_units(self, model_name: str, layer_name: str) -> int:
         """
@@ -91,8 +166,7 @@ class ModelInfo:
             int: The number of units in the specified layer.
 
         """
-        return self.model_info.loc[(self.model_info['model'] == model_name) &
-                                   (self.model_info['layer'] == layer_name), 'num_units'].iloc[0]
+        return self.get_layer_info(model_name, layer_name).num_units
 
     def get_rf_size(self, model_name: str, layer_name: str) -> int:
         """
@@ -107,8 +181,7 @@ class ModelInfo:
             int: The receptive field size of the specified layer.
 
         """
-        return self.model_info.loc[(self.model_info['model'] == model_name) &
-                                   (self.model_info['layer'] == layer_name), 'rf_size'].iloc[0]
+        return self.get_layer_info(model_name, layer_name).rf_size
 
     def get_xn(self, model_name: str, layer_name: str) -> int:
         """
@@ -123,67 +196,393 @@ class ModelInfo:
             int: The receptive field size of the specified layer.
 
         """
-        return self.model_info.loc[(self.model_info['model'] == model_name) &
-                                   (self.model_info['layer'] == layer_name), 'xn'].iloc[0]
+        return self.get_layer_info(model_name, layer_name).xn
+
+    def to_dataframe(self):
+        """
+        Returns all the model information as a pandas.DataFrame with the
+        columns COLUMNS. pandas is imported here, and only here.
+
+        """
+        import pandas as pd
+        return pd.DataFrame([(model_name, *layer_info)
+                             for model_name, layers in self.model_info.items()
+                             for layer_info in layers.values()], columns=self.COLUMNS)
 
 
-def get_truncated_model(model: nn.Module, layer_index: int) -> nn.Module:
+def load_model(model_name: str, device: Optional[Union[str, torch.device]] = None,
+               weights_dir: str = WEIGHTS_DIR) -> nn.Module:
+    """
+    Loads a pretrained torchvision model in evaluation mode, with weights that
+    all processes can share.
+
+    The first call saves the pretrained model to weights_dir. After that, the
+    model is loaded by memory-mapping that file (torch >= 2.1), so every
+    worker process references the same physical pages of the OS page cache
+    instead of holding its own copy. On older torch versions, the tensors are
+    moved to shared memory instead, which is inherited by forked workers.
+
+    The parameters do not require gradients, since gradient ascent only
+    differentiates with respect to the input image. This also prevents every
+    worker from allocating its own .grad buffers.
+
+    Args:
+        model_name (str): The name of the torchvision model, e.g., 'alexnet'.
+        device (str or torch.device): The device to move the model to. Moving
+        to a GPU copies the weights, so they are only shared on the CPU.
+        weights_dir (str): The directory of the saved models.
+
+    Returns:
+        The pretrained model.
+
+    Example:
+        model = load_model('vgg16')
+        model_to_conv2 = get_truncated_model(model, 2)  # shares the weights
+    """
+    weights_path = os.path.join(weights_dir, f"{model_name}.pt")
+    if not os.path.exists(weights_path):
+        os.makedirs(weights_dir, exist_ok=True)
+        model = getattr(models, model_name)(pretrained=True)
+        # Write atomically, so that concurrent processes never load a
+        # partially written file.
+        fd, tmp_path = tempfile.mkstemp(dir=weights_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(model, f)
+            os.replace(tmp_path, weights_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    # The file contains the whole module (not just a state_dict), because
+    # some architectures differ between their pretrained and default
+    # constructors (e.g., GoogLeNet's transform_input).
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        model = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=False)
+    else:
+        model = torch.load(weights_path, map_location='cpu')
+        model.share_memory()
+
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    if device is not None:
+        model.to(device)
+    return model
+
+
+def copy_module_structure(model: nn.Module,
+                          device: Optional[Union[str, torch.device]] = None) -> nn.Module:
+    """
+    Copies the modules of a model, but not its parameters and buffers: the
+    copy references the same tensors as the original. Use this instead of
+    copy.deepcopy() when only the structure is modified (e.g., truncating,
+    registering hooks, or switching to evaluation mode).
+
+    Args:
+        model (nn.Module): The model to copy.
+        device (str or torch.device): If given and the model has tensors on
+        another device, the model is deep-copied and moved to this device
+        instead, because moving shared parameters would move them for the
+        original model as well. The 'meta' device is special: the copy gets
+        new meta tensors of the same shapes, which hold no data, so it can
+        only be used to infer shapes.
+
+    Returns:
+        The copy of the model.
+    """
+    tensors = list(itertools.chain(model.parameters(), model.buffers()))
+    if device is not None and torch.device(device).type == 'meta':
+        memo = {}
+        for t in tensors:
+            meta_tensor = torch.empty_like(t, device='meta')
+            if isinstance(t, nn.Parameter):
+                meta_tensor = nn.Parameter(meta_tensor, requires_grad=t.requires_grad)
+            memo[id(t)] = meta_tensor
+        return copy.deepcopy(model, memo)
+    if device is not None and any(t.device != torch.device(device) for t in tensors):
+        return copy.deepcopy(model).to(device)
+    memo = {id(t): t for t in tensors}
+    return copy.deepcopy(model, memo)
+
+
+class TruncationCache:
+    """
+    Truncated versions of one model for any layer index, built from a single
+    trace. The model is traced once, and every truncated model is a prefix of
+    the traced graph. All truncated models reference the same layer objects,
+    so they share the parameters of the original model (see
+    copy_module_structure()) and cost no extra weight memory.
+
+    Because the layers are shared, do not modify the layers of a truncated
+    model in place (e.g., move it to another device or switch it to training
+    mode): the change would apply to all truncated models of the cache. Use
+    prune_output_channels() to change the last layer instead.
+
+    Example:
+        truncations = TruncationCache(model)
+        model_to_conv2 = truncations.get(3)
+        model_to_conv3 = truncations.get(6)  # no new trace
+    """
+    def __init__(self, model: nn.Module):
+        """
+        Args:
+            model (nn.Module): The neural network to be truncated.
+        """
+        self.model = copy_module_structure(model)
+
+        # IMPORTANT!! Set the model to evaluation mode to ensure that the traced
+        # graph matches the behavior of the original model
+        self.model.eval()
+
+        # Trace the model using the FX framework
+        self.graph = fx.Tracer().trace(self.model)
+        self.nodes = list(self.graph.nodes)
+
+        # The position in self.nodes of every layer (i.e., every call of a
+        # module, as opposed to a container "layer" or a function)
+        self.layer_positions = [i for i, node in enumerate(self.nodes)
+                                if node.op == 'call_module']
+        self._truncated_models = {}
+        self._multi_output_models = {}
+
+    def __len__(self) -> int:
+        """Returns the number of layers, i.e., of valid layer indices."""
+        return len(self.layer_positions)
+
+    def get(self, layer_index: int,
+            unit_indices: Optional[Sequence[int]] = None) -> fx.GraphModule:
+        """
+        Returns the truncated model up to the specified layer.
+
+        Args:
+            layer_index (int): The index of the last layer (inclusive) to be
+            included in the truncated model.
+            unit_indices (list of int): If given, the last layer only computes
+            the output channels of these units. See prune_output_channels().
+
+        Returns:
+            The truncated model. It is built only once per layer index.
+        """
+        if not 0 <= layer_index < len(self.layer_positions):
+            raise IndexError(f"layer index {layer_index} out of range for a model "
+                             f"with {len(self.layer_positions)} layers")
+        if layer_index not in self._truncated_models:
+            self._truncated_models[layer_index] = self._truncate((layer_index,))
+        truncated_model = self._truncated_models[layer_index]
+        if unit_indices is not None:
+            truncated_model = prune_output_channels(truncated_model, unit_indices)
+        return truncated_model
+
+    def get_multi_output(self, layer_indices: Sequence[int]) -> fx.GraphModule:
+        """
+        Returns a truncated model that outputs the responses of several
+        layers from a single forward pass. It stops after the deepest layer.
+
+        Args:
+            layer_indices (list of int): The indices of the layers.
+
+        Returns:
+            The truncated model. Its output is a dictionary
+            {layer_index: response}. It is built only once per set of layer
+            indices.
+        """
+        layer_indices = tuple(sorted(set(layer_indices)))
+        if not layer_indices:
+            raise ValueError("At least one layer index is required.")
+        for layer_index in layer_indices:
+            if not 0 <= layer_index < len(self.layer_positions):
+                raise IndexError(f"layer index {layer_index} out of range for a model "
+                                 f"with {len(self.layer_positions)} layers")
+        if layer_indices not in self._multi_output_models:
+            self._multi_output_models[layer_indices] = self._truncate(layer_indices,
+                                                                      multi_output=True)
+        return self._multi_output_models[layer_indices]
+
+    def _is_inplace(self, node: fx.node.Node, arg: fx.node.Node) -> bool:
+        """Whether the operation of the node modifies arg in place."""
+        if not (node.args and node.args[0] is arg):
+            return False
+        if node.op == 'call_module':
+            return getattr(self.model.get_submodule(node.target), 'inplace', False)
+        if node.op == 'call_function':
+            return (node.kwargs.get('inplace', False) or
+                    node.target in (operator.iadd, operator.isub, operator.imul, operator.itruediv))
+        if node.op == 'call_method':
+            return node.target.endswith('_')
+        return False
+
+    def _truncate(self, layer_indices: Tuple[int, ...],
+                  multi_output: bool = False) -> fx.GraphModule:
+        # Copy the nodes up to (and including) the deepest layer to a new graph
+        new_graph = fx.Graph()
+        value_remap = {}
+        for node in self.nodes[:self.layer_positions[max(layer_indices)] + 1]:
+            value_remap[node] = new_graph.node_copy(node, lambda n: value_remap[n])
+
+        if not multi_output:
+            # The output must reference the copy of the last node in
+            # new_graph, not the node of the traced graph. The original
+            # get_truncated_model() passed the traced node, which belongs to
+            # another graph: newer torch.fx versions drop such a value, and
+            # the truncated model returned None.
+            new_graph.output(value_remap[node])
+        else:
+            outputs = {}
+            for layer_index in layer_indices:
+                layer_node = self.nodes[self.layer_positions[layer_index]]
+                outputs[layer_index] = value_remap[layer_node]
+                # A later in-place operation (e.g., ReLU(inplace=True)) would
+                # overwrite the response, so return a copy of it instead.
+                if any(user in value_remap and self._is_inplace(user, layer_node)
+                       for user in layer_node.users):
+                    with new_graph.inserting_after(value_remap[layer_node]):
+                        outputs[layer_index] = new_graph.call_method('clone', (value_remap[layer_node],))
+            new_graph.output(outputs)
+
+        # Only the layers used by the new graph are copied to the GraphModule,
+        # and they are the same objects as the layers of self.model.
+        return fx.GraphModule(self.model, new_graph)
+
+
+def get_truncated_model(model: nn.Module, layer_index: int,
+                        unit_indices: Optional[Sequence[int]] = None) -> nn.Module:
     """
     Creates a truncated version of a neural network. Helps saves computation
     time if we just working with the first few layers.
 
+    Every call traces the model again. To truncate the same model at several
+    layers, use a TruncationCache instead.
+
     Args:
         model (nn.Module): The neural network to be truncated.
         layer_index (int): The index of the last layer (inclusive) to be
         included in the truncated model.
+        unit_indices (list of int): If given, the last layer only computes
+        the output channels of these units. See prune_output_channels().
 
     Returns:
-        A truncated version of the neural network.
+        A truncated version of the neural network. It shares the parameters
+        of the original model (see copy_module_structure()).
 
     Example:
         model = models.alexnet(pretrained=True)
         model_to_conv2 = get_truncated_model(model, 3)
         y = model(torch.ones(1, 3, 200, 200))
     """
-    model = copy.deepcopy(model)
+    return TruncationCache(model).get(layer_index, unit_indices)
 
-    # IMPORTANT!! Set the model to evaluation mode to ensure that the traced
-    # graph matches the behavior of the original model
-    model.eval()
 
-    # Trace the model using the FX framework
-    graph = fx.Tracer().trace(model)
+def get_multi_output_model(model: nn.Module, layer_indices: Sequence[int]) -> fx.GraphModule:
+    """
+    Creates a truncated version of a neural network that outputs the
+    responses of several layers from a single forward pass, so that the
+    early layers they share are only computed once.
 
-    # Create a new graph to hold the truncated version of the model
-    new_graph = fx.Graph()
+    Args:
+        model (nn.Module): The neural network to be truncated.
+        layer_indices (list of int): The indices of the layers. The model
+        stops after the deepest one.
 
-    # Keep track of the number of layers processed so far
-    layer_counter = 0
+    Returns:
+        A truncated version of the neural network, whose output is a
+        dictionary {layer_index: response}. It shares the parameters of the
+        original model (see copy_module_structure()).
 
-    # Create a dictionary to map values in the original graph to values in the
-    # new graph
-    value_remap = {}
+    Example:
+        model = models.alexnet(pretrained=True)
+        model_to_conv5 = get_multi_output_model(model, [0, 3, 6, 8, 10])
+        responses = model_to_conv5(torch.ones(1, 3, 227, 227))
+        conv2_responses = responses[3]
+    """
+    return TruncationCache(model).get_multi_output(layer_indices)
 
-    # Iterate over the nodes in the original graph
-    for node in graph.nodes:
-        # Copy the node to the new graph and add it to the value remapping dictionary
-        value_remap[node] = new_graph.node_copy(node, lambda n: value_remap[n])
 
-        # If the node represents a module (i.e., a layer as oppposed to a
-        # container "layer")...
-        if node.op == 'call_module':
-            # ...get the layer object
-            layer = model
-            for level in node.target.split('.'):
-                layer = getattr(layer, level)
+def prune_output_channels(truncated_model: fx.GraphModule,
+                          unit_indices: Sequence[int]) -> fx.GraphModule:
+    """
+    Rebuilds the last conv layer of a truncated model (and any BatchNorm/ReLU
+    layers that follow it) so that it only computes the output channels of
+    the specified units. Gradient ascent only looks at a few units at a time,
+    so this removes most of the last layer's forward and backward cost.
 
-            # If we've reached the desired layer index...
-            if layer_counter == layer_index:
-                new_graph.output(node)
-                break
+    The k-th output channel of the pruned model is the unit unit_indices[k].
+    The unit indices are stored in the "unit_indices" attribute of the
+    returned model, which GradientAscent uses to find the channel of a unit.
+    All other layers share their weights with truncated_model.
 
-            layer_counter += 1
+    Args:
+        truncated_model (fx.GraphModule): The truncated model, as returned
+        by get_truncated_model().
+        unit_indices (list of int): The units to keep.
+
+    Returns:
+        The pruned version of the truncated model.
 
-    # Create a new GraphModule that combines the original model with the
-    # truncated graph
-    return fx.GraphModule(model, new_graph)
+    Example:
+        model_to_conv3 = get_truncated_model(model, 6)
+        model_to_conv3_units = prune_output_channels(model_to_conv3, [2, 5])
+        y = model_to_conv3_units(torch.ones(1, 3, 127, 127))  # 2 channels
+    """
+    # The new GraphModule references the same layer objects as the original
+    # one, but has its own containers. Replacing a layer below therefore
+    # does not affect the original truncated model.
+    pruned_model = fx.GraphModule(truncated_model, copy.deepcopy(truncated_model.graph))
+    index = torch.as_tensor(list(unit_indices), dtype=torch.long)
+
+    # Walk backward from the output through the layers that act on each
+    # channel independently, until the conv layer is found.
+    output_node = [node for node in pruned_model.graph.nodes if node.op == 'output'][0]
+    node = output_node.args[0]
+    while True:
+        if not (isinstance(node, fx.node.Node) and node.op == 'call_module'):
+            raise ValueError("The last layers of the truncated model must be a conv layer "
+                             "followed by BatchNorm/ReLU layers.")
+        layer = pruned_model.get_submodule(node.target)
+        if isinstance(layer, nn.Conv2d):
+            _replace_layer(pruned_model, node.target, _prune_conv(layer, index))
+            break
+        elif isinstance(layer, nn.BatchNorm2d):
+            _replace_layer(pruned_model, node.target, _prune_batch_norm(layer, index))
+        elif not isinstance(layer, (nn.ReLU, nn.Dropout, nn.Dropout2d, nn.Identity)):
+            raise ValueError(f"Cannot prune the output channels of {type(layer)}.")
+        node = node.args[0]
+
+    pruned_model.unit_indices = list(unit_indices)
+    return pruned_model
+
+
+def _replace_layer(model: nn.Module, target: str, new_layer: nn.Module) -> None:
+    """Replaces the layer at the (dotted) target path of the model."""
+    *parent_path, name = target.split('.')
+    parent = model
+    for level in parent_path:
+        parent = getattr(parent, level)
+    setattr(parent, name, new_layer)
+
+
+def _prune_conv(conv: nn.Conv2d, index: torch.Tensor) -> nn.Conv2d:
+    """Returns a copy of the conv layer with only the selected output channels."""
+    if conv.groups != 1:
+        raise ValueError("Cannot prune the output channels of a grouped convolution.")
+    pruned_conv = nn.Conv2d(conv.in_channels, len(index), conv.kernel_size,
+                            stride=conv.stride, padding=conv.padding,
+                            dilation=conv.dilation, bias=(conv.bias is not None),
+                            padding_mode=conv.padding_mode)
+    pruned_conv.weight = nn.Parameter(conv.weight.detach()[index.to(conv.weight.device)].clone())
+    if conv.bias is not None:
+        pruned_conv.bias = nn.Parameter(conv.bias.detach()[index.to(conv.bias.device)].clone())
+    return pruned_conv.train(conv.training)
+
+
+def _prune_batch_norm(bn: nn.BatchNorm2d, index: torch.Tensor) -> nn.BatchNorm2d:
+    """Returns a copy of the BatchNorm layer with only the selected channels."""
+    pruned_bn = copy.deepcopy(bn)
+    pruned_bn.num_features = len(index)
+    for name, tensor in list(bn.named_parameters(recurse=False)) + list(bn.named_buffers(recurse=False)):
+        if tensor is not None and tensor.dim() == 1:
+            sliced = tensor.detach()[index.to(tensor.device)].clone()
+            if isinstance(tensor, nn.Parameter):
+                sliced = nn.Parameter(sliced)
+            setattr(pruned_bn, name, sliced)
+    return pruned_bn
@@ -0,0 +1,182 @@
+"""
+Loading of the top image patches of many units. The requests of a layer are
+prepared up front from its ranking array, grouped by image so that every
+image is read only once, and loaded on a background thread into float32
+batches while the previous batch is being optimized.
+
+Example:
+    requests = make_patch_requests(ranking, converter, layer_index, range(num_units),
+                                   padding, IMG_SIZE)
+    for batch_requests, patches in PatchLoader(images, requests, xn, batch_size=64):
+        ...  # patches has shape (len(batch_requests), 3, xn, xn)
+
+"""
+
+import queue
+import threading
+from itertools import groupby
+from typing import Iterator, List, NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+from image_store import ImageStore, NpyImageDirectory
+from image_utils import one_sided_zero_pad
+from spatial_utils import SpatialIndexConverter
+
+__all__ = ['PatchRequest', 'pad_box', 'make_patch_requests', 'load_patches', 'PatchLoader']
+
+
+class PatchRequest(NamedTuple):
+    """The image patch of a unit: box (y_min, x_min, y_max, x_max) of image img_index."""
+    unit_index: int
+    img_index: int
+    patch_index: int
+    box: Tuple[int, int, int, int]
+
+
+def clip(x: int, min_value: int, max_value: int) -> int:
+    return max(min(x, max_value), min_value)
+
+
+def pad_box(box: Tuple[int, int, int, int], padding: int,
+            img_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Makes sure box does not go beyond the image after padding."""
+    y_min, x_min, y_max, x_max = box
+    new_y_min = clip(y_min-padding, 0, img_size[0])
+    new_x_min = clip(x_min-padding, 0, img_size[1])
+    new_y_max = clip(y_max+padding, 0, img_size[0])
+    new_x_max = clip(x_max+padding, 0, img_size[1])
+    return new_y_min, new_x_min, new_y_max, new_x_max
+
+
+def make_patch_requests(ranking: np.ndarray, converter: SpatialIndexConverter,
+                        layer_index: int, unit_indices: Sequence[int], padding: int,
+                        img_size: Tuple[int, int], rank: int = 0,
+                        column: int = 0) -> List[PatchRequest]:
+    """
+    Prepares the patch requests of the units of a layer.
+
+    Args:
+        ranking (numpy.ndarray): The [num_units, 100, 4] ranking array of the
+        layer (see the top-patch scripts).
+        converter (SpatialIndexConverter): Converts the spatial index of the
+        layer to a box of pixels.
+        layer_index (int): The index of the layer.
+        unit_indices (list of int): The units.
+        padding (int): The padding added around the receptive field, i.e.,
+        (xn - rf_size) // 2.
+        img_size (tuple of ints): The (height, width) of the images.
+        rank (int): The rank of the patch, e.g., 0 for the top-1 patch.
+        column (int): 0 for the most positive patches, or 2 for the most
+        negative patches.
+
+    Returns:
+        One request per unit.
+    """
+    unit_indices = np.asarray(list(unit_indices), dtype=np.int64)
+    img_indices = ranking[unit_indices, rank, column].astype(np.int64)
+    patch_indices = ranking[unit_indices, rank, column + 1].astype(np.int64)
+    boxes = converter.convert_many(patch_indices, layer_index, 0, is_forward=False)
+
+    requests = []
+    for unit_index, img_index, patch_index, box in zip(unit_indices.tolist(), img_indices.tolist(),
+                                                       patch_indices.tolist(), boxes.tolist()):
+        requests.append(PatchRequest(unit_index, img_index, patch_index,
+                                     pad_box(box, padding, img_size)))
+    return requests
+
+
+def load_patches(images: Union[ImageStore, NpyImageDirectory],
+                 requests: Sequence[PatchRequest], xn: int) -> np.ndarray:
+    """
+    Loads the patches of the requests. An image needed by several requests is
+    read only once.
+
+    Returns:
+        A float32 array of shape (len(requests), 3, xn, xn). Patches cut off
+        by the edge of the image are zero-padded (see one_sided_zero_pad()).
+    """
+    patches = np.empty((len(requests), 3, xn, xn), dtype=np.float32)
+    order = sorted(range(len(requests)), key=lambda i: requests[i].img_index)
+    for img_index, group in groupby(order, key=lambda i: requests[i].img_index):
+        group = list(group)
+        img = images.get_image(img_index) if len(group) > 1 else None
+        for i in group:
+            y_min, x_min, y_max, x_max = box = requests[i].box
+            if img is None:
+                patch = images.crop(img_index, box)
+            else:
+                patch = img[:, y_min:y_max+1, x_min:x_max+1]
+            patches[i] = one_sided_zero_pad(patch, xn, box)
+    return patches
+
+
+class PatchLoader:
+    """
+    Iterates over the patches of the requests in batches. The requests are
+    reordered by image, so that units that share an image end up in the same
+    batch, and the next batches are loaded on a background thread while the
+    current one is being used.
+
+    Yields:
+        (batch_requests, patches): the requests of the batch and their
+        patches, a float32 array of shape (len(batch_requests), 3, xn, xn).
+    """
+    def __init__(self, images: Union[ImageStore, NpyImageDirectory],
+                 requests: Sequence[PatchRequest], xn: int, batch_size: int = 64,
+                 num_prefetch: int = 2):
+        """
+        Args:
+            images: Where to read the images from (see
+            image_store.open_image_source()).
+            requests (list of PatchRequest): The patches to load.
+            xn (int): The size of the patches.
+            batch_size (int): The number of patches per batch.
+            num_prefetch (int): The number of batches loaded ahead.
+        """
+        self.images = images
+        self.requests = sorted(requests, key=lambda request: request.img_index)
+        self.xn = xn
+        self.batch_size = batch_size
+        self.num_prefetch = num_prefetch
+
+    def __len__(self) -> int:
+        return -(-len(self.requests) // self.batch_size)
+
+    def _load(self, batches: queue.Queue, stop: threading.Event) -> None:
+        def put(item) -> bool:
+            # Give up if the consumer has stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch_start in range(0, len(self.requests), self.batch_size):
+                batch_requests = self.requests[batch_start:batch_start + self.batch_size]
+                if not put((batch_requests, load_patches(self.images, batch_requests, self.xn))):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def __iter__(self) -> Iterator[Tuple[List[PatchRequest], np.ndarray]]:
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._load, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,287 @@
+"""
+Ranking of the image patches that give the most positive and most negative
+responses of every unit, i.e., the data/top_100_image_patches arrays read by
+the top-patch scripts.
+
+The corpus is streamed through a multi-output truncated model (see
+model_utils.TruncationCache.get_multi_output()) in batches, so that all
+layers are ranked in one pass. Every image contributes its spatial maximum
+(and minimum) to the ranking of every unit. The running top-k and bottom-k of
+each unit are merged with the responses of a batch by one vectorized topk(),
+so memory stays bounded by num_units x (k + batch_size), whatever the size of
+the corpus.
+
+The ranking can be checkpointed mid-corpus and resumed, and the corpus can be
+split into shards that are ranked by different processes and merged at the
+end (see make_top_patch_rankings.py).
+
+Format of a ranking array (see make_top_patch_png.py), [num_units, k, 4]:
+    [:, :, 0]   max_img_idx: the image of the k-th most positive response
+    [:, :, 1]   max_spatial_idx: its spatial index, y * output_width + x
+    [:, :, 2]   min_img_idx: the image of the k-th most negative response
+    [:, :, 3]   min_spatial_idx: its spatial index
+
+Example:
+    rankers = rank_images(TruncationCache(model), [0, 3, 6, 8, 10], images,
+                          range(50000), checkpoint_path='ranking.npz')
+    np.save('conv2.npy', rankers[3].get_ranking())
+
+"""
+
+import os
+import tempfile
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from image_store import ImageStore, NpyImageDirectory
+from model_utils import TruncationCache
+
+__all__ = ['PatchRanker', 'ImageShard', 'make_image_shards', 'save_rankers',
+           'load_rankers', 'merge_rankers', 'rank_images']
+
+STATE_KEYS = ('max_responses', 'max_img_indices', 'max_spatial_indices',
+              'min_responses', 'min_img_indices', 'min_spatial_indices')
+
+
+class PatchRanker:
+    """
+    The running top-k (most positive) and bottom-k (most negative) responses
+    of all units of a layer, with their images and spatial indices.
+    """
+    def __init__(self, num_units: int, k: int = 100):
+        """
+        Args:
+            num_units (int): The number of units of the layer.
+            k (int): The number of patches kept per unit and direction.
+        """
+        self.num_units = num_units
+        self.k = k
+        self.max_responses = torch.empty((num_units, 0))
+        self.max_img_indices = torch.empty((num_units, 0), dtype=torch.long)
+        self.max_spatial_indices = torch.empty((num_units, 0), dtype=torch.long)
+        self.min_responses = torch.empty((num_units, 0))
+        self.min_img_indices = torch.empty((num_units, 0), dtype=torch.long)
+        self.min_spatial_indices = torch.empty((num_units, 0), dtype=torch.long)
+
+    def _merge(self, responses: torch.Tensor, img_indices: torch.Tensor,
+               spatial_indices: torch.Tensor, largest: bool) -> None:
+        prefix = 'max' if largest else 'min'
+        responses = torch.cat([getattr(self, f"{prefix}_responses"), responses], dim=1)
+        img_indices = torch.cat([getattr(self, f"{prefix}_img_indices"), img_indices], dim=1)
+        spatial_indices = torch.cat([getattr(self, f"{prefix}_spatial_indices"), spatial_indices], dim=1)
+
+        k = min(self.k, responses.shape[1])
+        responses, order = responses.topk(k, dim=1, largest=largest, sorted=True)
+        setattr(self, f"{prefix}_responses", responses)
+        setattr(self, f"{prefix}_img_indices", img_indices.gather(1, order))
+        setattr(self, f"{prefix}_spatial_indices", spatial_indices.gather(1, order))
+
+    def update(self, responses: torch.Tensor, img_indices: Sequence[int]) -> None:
+        """
+        Adds the responses of a batch of images to the ranking.
+
+        Args:
+            responses (torch.Tensor): The responses of the layer, with shape
+            (num_images, num_units, height, width).
+            img_indices (list of int): The index of every image in the corpus.
+        """
+        num_images, num_units = responses.shape[:2]
+        if num_units != self.num_units:
+            raise ValueError(f"Expected {self.num_units} units, but got {num_units}")
+        # (num_units, num_images, height * width), on the CPU
+        responses = responses.detach().flatten(2).transpose(0, 1).float().cpu()
+        img_indices = torch.as_tensor(img_indices, dtype=torch.long).expand(num_units, num_images)
+
+        max_responses, max_spatial_indices = responses.max(dim=2)
+        self._merge(max_responses, img_indices, max_spatial_indices, largest=True)
+        min_responses, min_spatial_indices = responses.min(dim=2)
+        self._merge(min_responses, img_indices, min_spatial_indices, largest=False)
+
+    def merge(self, other: 'PatchRanker') -> 'PatchRanker':
+        """Merges the ranking of another part of the corpus into this one."""
+        if other.num_units != self.num_units:
+            raise ValueError(f"Cannot merge a ranking of {other.num_units} units "
+                             f"into one of {self.num_units} units")
+        self._merge(other.max_responses, other.max_img_indices,
+                    other.max_spatial_indices, largest=True)
+        self._merge(other.min_responses, other.min_img_indices,
+                    other.min_spatial_indices, largest=False)
+        return self
+
+    def get_ranking(self) -> np.ndarray:
+        """
+        Returns the ranking array of the layer, with shape [num_units, k, 4]
+        (see the module docstring). If fewer than k images were ranked, the
+        second dimension is the number of images instead.
+        """
+        return np.stack([self.max_img_indices.numpy(), self.max_spatial_indices.numpy(),
+                         self.min_img_indices.numpy(), self.min_spatial_indices.numpy()], axis=-1)
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        """Returns the state of the ranker as numpy arrays (see from_state_dict())."""
+        state = {key: getattr(self, key).numpy() for key in STATE_KEYS}
+        state['k'] = np.array(self.k)
+        return state
+
+    @classmethod
+    def from_state_dict(cls, state: Dict[str, np.ndarray]) -> 'PatchRanker':
+        """Recreates a ranker from its state_dict()."""
+        ranker = cls(len(state['max_responses']), int(state['k']))
+        for key in STATE_KEYS:
+            setattr(ranker, key, torch.from_numpy(np.array(state[key])))
+        return ranker
+
+
+class ImageShard(NamedTuple):
+    """The images [img_start, img_stop) of the corpus, ranked by one process."""
+    shard_index: int
+    img_start: int
+    img_stop: int
+
+    @property
+    def img_indices(self) -> range:
+        return range(self.img_start, self.img_stop)
+
+
+def make_image_shards(num_images: int, num_shards: int) -> List[ImageShard]:
+    """Splits the images [0, num_images) into num_shards contiguous shards."""
+    bounds = np.linspace(0, num_images, num_shards + 1).round().astype(int)
+    return [ImageShard(i, int(bounds[i]), int(bounds[i + 1])) for i in range(num_shards)]
+
+
+def save_rankers(path: str, rankers: Dict[int, PatchRanker], img_indices: Sequence[int],
+                 num_done: int) -> None:
+    """
+    Saves the rankers of several layers as a checkpoint (.npz), atomically.
+
+    Args:
+        path (str): The path of the checkpoint.
+        rankers (dict): {layer_index: PatchRanker}.
+        img_indices (list of int): All the images to be ranked.
+        num_done (int): The number of images of img_indices that have been
+        ranked so far.
+    """
+    arrays = {'img_indices': np.asarray(img_indices, dtype=np.int64),
+              'num_done': np.array(num_done),
+              'layer_indices': np.array(sorted(rankers), dtype=np.int64)}
+    for layer_index, ranker in rankers.items():
+        for key, value in ranker.state_dict().items():
+            arrays[f"{layer_index}/{key}"] = value
+
+    # Write atomically, so that an interruption never leaves a partially
+    # written checkpoint.
+    checkpoint_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=checkpoint_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_rankers(path: str) -> Tuple[Dict[int, PatchRanker], np.ndarray, int]:
+    """
+    Loads a checkpoint saved by save_rankers().
+
+    Returns:
+        rankers: {layer_index: PatchRanker}.
+        img_indices: All the images to be ranked.
+        num_done: The number of images of img_indices ranked so far.
+    """
+    with np.load(path) as arrays:
+        rankers = {}
+        for layer_index in arrays['layer_indices'].tolist():
+            state = {key: arrays[f"{layer_index}/{key}"] for key in STATE_KEYS + ('k',)}
+            rankers[layer_index] = PatchRanker.from_state_dict(state)
+        return rankers, arrays['img_indices'], int(arrays['num_done'])
+
+
+def merge_rankers(rankers_list: Sequence[Dict[int, PatchRanker]]) -> Dict[int, PatchRanker]:
+    """Merges the rankers of several shards of the corpus, layer by layer."""
+    merged = {}
+    for rankers in rankers_list:
+        for layer_index, ranker in rankers.items():
+            if layer_index in merged:
+                merged[layer_index].merge(ranker)
+            else:
+                merged[layer_index] = PatchRanker.from_state_dict(ranker.state_dict())
+    return merged
+
+
+def _iter_image_batches(images: Union[ImageStore, NpyImageDirectory], img_indices: Sequence[int],
+                        batch_size: int) -> Iterator[Tuple[Sequence[int], torch.Tensor]]:
+    for batch_start in range(0, len(img_indices), batch_size):
+        batch_indices = img_indices[batch_start:batch_start + batch_size]
+        batch = np.stack([images.get_image(img_index) for img_index in batch_indices])
+        yield batch_indices, torch.from_numpy(batch.astype(np.float32, copy=False))
+
+
+def rank_images(model: Union[nn.Module, TruncationCache], layer_indices: Sequence[int],
+                images: Union[ImageStore, NpyImageDirectory], img_indices: Sequence[int],
+                k: int = 100, batch_size: int = 64,
+                device: Optional[Union[str, torch.device]] = None,
+                checkpoint_path: Optional[str] = None,
+                checkpoint_every: int = 50) -> Dict[int, PatchRanker]:
+    """
+    Ranks the image patches of all units of several layers in one pass over
+    the images.
+
+    Args:
+        model (nn.Module or TruncationCache): The neural network, or its
+        truncation cache.
+        layer_indices (list of int): The indices of the layers to rank.
+        images: Where to read the images from (see
+        image_store.open_image_source()).
+        img_indices (list of int): The images to rank.
+        k (int): The number of patches kept per unit and direction.
+        batch_size (int): The number of images per forward pass.
+        device (str or torch.device): The device of the model. Defaults to
+        the device of its parameters.
+        checkpoint_path (str): If given, the rankers are saved there every
+        checkpoint_every batches and at the end, and a run with the same
+        img_indices resumes from it.
+        checkpoint_every (int): The number of batches between checkpoints.
+
+    Returns:
+        {layer_index: PatchRanker}.
+    """
+    truncations = model if isinstance(model, TruncationCache) else TruncationCache(model)
+    multi_output_model = truncations.get_multi_output(layer_indices)
+    if device is None:
+        device = next(multi_output_model.parameters()).device
+    img_indices = list(img_indices)
+
+    num_done = 0
+    rankers = None
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        rankers, checkpoint_img_indices, num_done = load_rankers(checkpoint_path)
+        if checkpoint_img_indices.tolist() != img_indices or set(rankers) != set(layer_indices):
+            raise ValueError(f"The checkpoint {checkpoint_path} was made for other images "
+                             f"or layers. Delete it to start over.")
+
+    batches = _iter_image_batches(images, img_indices[num_done:], batch_size)
+    num_batches = -(-(len(img_indices) - num_done) // batch_size)
+    with torch.no_grad():
+        for batch_i, (batch_indices, batch) in enumerate(tqdm(batches, total=num_batches)):
+            responses = multi_output_model(batch.to(device))
+            if rankers is None:
+                rankers = {layer_index: PatchRanker(response.shape[1], k)
+                           for layer_index, response in responses.items()}
+            for layer_index, response in responses.items():
+                rankers[layer_index].update(response, batch_indices)
+            num_done += len(batch_indices)
+            if checkpoint_path is not None and (batch_i + 1) % checkpoint_every == 0:
+                save_rankers(checkpoint_path, rankers, img_indices, num_done)
+
+    if rankers is None:
+        raise ValueError("No images to rank.")
+    if checkpoint_path is not None:
+        save_rankers(checkpoint_path, rankers, img_indices, num_done)
+    return rankers
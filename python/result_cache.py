@@ -0,0 +1,114 @@
+"""
+A content-addressed cache of gradient ascent results. Every result is stored
+in its own file, named by a hash of everything that determines it: the model
+weights, the layer, the unit, and the optimization settings. Units are
+persisted as soon as they finish, so an interrupted run can be resumed, and
+changing one setting only recomputes the results that depend on it.
+
+Example:
+    cache = ResultCache(CACHE_DIR)
+    model_hash = hash_model_weights(model)
+    key = cache.make_key(model=model_hash, layer='conv2', unit_index=3,
+                         optimizer='SGD', lr=0.1, momentum=False,
+                         max_iter=100, init='zero')
+    result = cache.get(key)
+    if result is None:
+        result = ...  # compute it
+        cache.put(key, result)
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from typing import Any, Optional, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+__all__ = ['ResultCache', 'hash_model_weights']
+
+
+def hash_model_weights(model: nn.Module) -> str:
+    """
+    Returns a SHA-256 hash of the parameters and buffers of the model (their
+    names, shapes, dtypes, and values).
+    """
+    sha = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update(f"{name} {tuple(tensor.shape)} {tensor.dtype}".encode())
+        sha.update(tensor.view(-1).view(torch.uint8).numpy().tobytes()
+                   if tensor.numel() > 0 else b'')
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """
+    A directory of .npy files, each named by the hash of its key. Writes are
+    atomic, so several processes can share the same cache, and a crash never
+    leaves a partially written result behind.
+    """
+    def __init__(self, cache_dir: str):
+        """
+        Args:
+            cache_dir (str): The directory to store the results in. Created if
+            necessary.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, **settings: Any) -> str:
+        """
+        Returns the key of a result. The settings must be JSON-serializable
+        (numpy scalars are converted), and their order does not matter.
+
+        Include every setting that can change the result, even only by
+        rounding (e.g., the batch size or the compile backend). Results that
+        depend on an unseeded random number generator must not be cached.
+        """
+        text = json.dumps(settings, sort_keys=True, default=_to_json)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Use the first two characters as a subdirectory to avoid having
+        # hundreds of thousands of files in a single directory.
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached result, or None if there is none."""
+        try:
+            return np.load(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, result: Union[np.ndarray, torch.Tensor]) -> None:
+        """Stores a result (a numpy array or a tensor) under the key."""
+        if isinstance(result, torch.Tensor):
+            result = result.detach().cpu().numpy()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, result)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _to_json(value: Any) -> Any:
+    """Converts numpy scalars and arrays so that json can serialize them."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (tuple, set, range)):
+        return list(value)
+    raise TypeError(f"{type(value)} cannot be part of a cache key")
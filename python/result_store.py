@@ -0,0 +1,275 @@
+"""
+A compact, chunked on-disk store for the per-unit results of a layer.
+
+Instead of keeping a float64 (num_units, xn, xn, 3) array in RAM until the
+whole layer is done, the results are written unit by unit into memory-mapped
+chunk files (float32, or, opt-in, quantized to float16 or uint8). Different
+processes can write different units of the same store at the same time.
+Readers slice the store lazily, so their peak memory is bounded by one chunk.
+A store can be reopened to resume an interrupted run: the units that have
+been written are skipped.
+
+Layout of a store directory:
+    meta.json            num_units, unit_shape, dtype, chunk_size, key
+    written.npy          bool mask of the units that have been written
+    chunk_00000.npy      units [0, chunk_size)
+    chunk_00001.npy      units [chunk_size, 2 * chunk_size)
+    ...
+
+Example:
+    # In the main process
+    ResultStore.open_or_create(path, num_units=256, unit_shape=(99, 99, 3), key=settings_hash)
+
+    # In the workers
+    with ResultStore(path, mode='r+') as store:
+        for unit_index in unit_indices:
+            if not store.is_written(unit_index):
+                store.write(unit_index, process_tensor(result))
+
+    # Later
+    store = ResultStore(path)
+    for unit_start, results in store.iter_chunks():
+        ...
+
+"""
+
+import os
+import json
+import shutil
+import threading
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+__all__ = ['ResultStore', 'open_layer_results']
+
+DTYPES = ('float32', 'float16', 'uint8')
+DEFAULT_CHUNK_BYTES = 64 * 1024 ** 2
+
+
+class ResultStore:
+    """
+    The results of a layer, one array of shape unit_shape per unit. Values are
+    read back as float32. The uint8 dtype assumes that the values are in
+    [0.0, 1.0] (e.g., from process_tensor() or normalize_img()), and clips
+    them to that range.
+    """
+    def __init__(self, path: str, mode: str = 'r'):
+        """
+        Opens an existing store (see create()).
+
+        Args:
+            path (str): The directory of the store.
+            mode (str): 'r' (read-only) or 'r+' (read and write).
+        """
+        if mode not in ('r', 'r+'):
+            raise ValueError(f'mode must be "r" or "r+", but got "{mode}"')
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.mode = mode
+        self.num_units = meta['num_units']
+        self.unit_shape = tuple(meta['unit_shape'])
+        self.dtype = meta['dtype']
+        self.chunk_size = meta['chunk_size']
+        self.key = meta.get('key')
+        self._written = np.load(os.path.join(path, 'written.npy'), mmap_mode=mode)
+        self._chunks = {}
+        self._chunks_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path: str, num_units: int, unit_shape: Tuple[int, ...],
+               dtype: str = 'float32', chunk_size: Optional[int] = None,
+               key: Optional[str] = None) -> 'ResultStore':
+        """
+        Creates an empty store, replacing any existing store at path. All
+        chunk files are allocated up front (as sparse files), so that workers
+        can write to them concurrently.
+
+        Args:
+            path (str): The directory of the store.
+            num_units (int): The number of units.
+            unit_shape (tuple of ints): The shape of the result of one unit,
+            e.g., (xn, xn, 3).
+            dtype (str): 'float32', 'float16', or 'uint8'. The quantized
+            dtypes save space, but change the stored values.
+            chunk_size (int): The number of units per chunk file. Defaults to
+            about 64 MB per chunk.
+            key (str): Identifies the settings that the results depend on
+            (e.g., a hash of them). See open_or_create().
+
+        Returns:
+            The store, opened in 'r+' mode.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f'dtype "{dtype}" not supported. Options: {DTYPES}')
+        unit_bytes = int(np.prod(unit_shape)) * np.dtype(dtype).itemsize
+        if chunk_size is None:
+            chunk_size = max(1, DEFAULT_CHUNK_BYTES // unit_bytes)
+        chunk_size = max(1, min(chunk_size, num_units))
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        for chunk_index, unit_start in enumerate(range(0, num_units, chunk_size)):
+            unit_stop = min(unit_start + chunk_size, num_units)
+            chunk = np.lib.format.open_memmap(cls._chunk_path(path, chunk_index), mode='w+',
+                                              dtype=dtype, shape=(unit_stop - unit_start, *unit_shape))
+            del chunk
+        np.save(os.path.join(path, 'written.npy'), np.zeros(num_units, dtype=bool))
+        # The metadata is written last, so that a store without it is known
+        # to be incomplete.
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'num_units': num_units, 'unit_shape': list(unit_shape),
+                       'dtype': dtype, 'chunk_size': chunk_size, 'key': key}, f)
+        return cls(path, mode='r+')
+
+    @classmethod
+    def open_or_create(cls, path: str, num_units: int, unit_shape: Tuple[int, ...],
+                       dtype: str = 'float32', chunk_size: Optional[int] = None,
+                       key: Optional[str] = None) -> 'ResultStore':
+        """
+        Reopens the store at path if it is complete and was created with the
+        same num_units, unit_shape, dtype, chunk_size (if given), and key, so
+        that the units it already holds can be skipped (see is_written()).
+        Otherwise, creates a new store (see create()).
+
+        Returns:
+            The store, opened in 'r+' mode.
+        """
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            store = cls(path, mode='r+')
+            if (store.num_units == num_units and store.unit_shape == tuple(unit_shape) and
+                    store.dtype == dtype and store.key == key and
+                    chunk_size in (None, store.chunk_size)):
+                return store
+            store.close()
+        return cls.create(path, num_units, unit_shape, dtype=dtype, chunk_size=chunk_size, key=key)
+
+    @staticmethod
+    def _chunk_path(path: str, chunk_index: int) -> str:
+        return os.path.join(path, f"chunk_{chunk_index:05d}.npy")
+
+    def _get_chunk(self, chunk_index: int) -> np.memmap:
+        # write() may be called from several threads (e.g., the on_saved
+        # callbacks of an ImageWriter)
+        with self._chunks_lock:
+            if chunk_index not in self._chunks:
+                self._chunks[chunk_index] = np.load(self._chunk_path(self.path, chunk_index),
+                                                    mmap_mode=self.mode)
+            return self._chunks[chunk_index]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return (self.num_units, *self.unit_shape)
+
+    def __len__(self) -> int:
+        return self.num_units
+
+    def is_written(self, unit_index: int) -> bool:
+        """Whether the result of the unit has been written."""
+        return bool(self._written[unit_index])
+
+    @property
+    def num_written(self) -> int:
+        """The number of units that have been written."""
+        return int(np.count_nonzero(self._written))
+
+    def _encode(self, result: np.ndarray) -> np.ndarray:
+        if self.dtype == 'uint8':
+            return (np.clip(result, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+        return result.astype(self.dtype)
+
+    def _decode(self, stored: np.ndarray) -> np.ndarray:
+        if self.dtype == 'uint8':
+            return stored.astype(np.float32) / 255
+        return stored.astype(np.float32)
+
+    def write(self, unit_index: int, result: np.ndarray) -> None:
+        """
+        Writes the result of one unit, and marks the unit as written. Units
+        are independent, so different threads may write different units.
+        """
+        if self.mode != 'r+':
+            raise RuntimeError("The store was opened read-only.")
+        result = np.asarray(result)
+        if result.shape != self.unit_shape:
+            raise ValueError(f"The result of a unit must have shape {self.unit_shape}, "
+                             f"but got {result.shape}")
+        chunk_index, offset = divmod(unit_index, self.chunk_size)
+        self._get_chunk(chunk_index)[offset] = self._encode(result)
+        self._written[unit_index] = True
+
+    def read(self, unit_start: int, unit_stop: Optional[int] = None) -> np.ndarray:
+        """
+        Reads the results of units [unit_start, unit_stop) as float32. Only
+        these units are loaded into memory. If unit_stop is None, returns the
+        result of unit_start only, with shape unit_shape.
+        """
+        if unit_stop is None:
+            chunk_index, offset = divmod(unit_start, self.chunk_size)
+            return self._decode(self._get_chunk(chunk_index)[offset])
+
+        unit_stop = min(unit_stop, self.num_units)
+        results = np.empty((max(0, unit_stop - unit_start), *self.unit_shape), dtype=np.float32)
+        unit_index = unit_start
+        while unit_index < unit_stop:
+            chunk_index, offset = divmod(unit_index, self.chunk_size)
+            chunk = self._get_chunk(chunk_index)
+            num_units = min(len(chunk) - offset, unit_stop - unit_index)
+            results[unit_index - unit_start:unit_index - unit_start + num_units] = \
+                self._decode(chunk[offset:offset + num_units])
+            unit_index += num_units
+        return results
+
+    def __getitem__(self, index: Union[int, slice]) -> np.ndarray:
+        if isinstance(index, slice):
+            unit_start, unit_stop, step = index.indices(self.num_units)
+            if step != 1:
+                raise IndexError("ResultStore only supports slices with a step of 1.")
+            return self.read(unit_start, unit_stop)
+        if index < 0:
+            index += self.num_units
+        if not 0 <= index < self.num_units:
+            raise IndexError(f"unit index {index} out of range for {self.num_units} units")
+        return self.read(index)
+
+    def iter_chunks(self, chunk_size: Optional[int] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Iterates over the results, chunk_size units at a time (defaults to the
+        chunk size of the store). Yields (unit_start, results).
+        """
+        chunk_size = self.chunk_size if chunk_size is None else chunk_size
+        for unit_start in range(0, self.num_units, chunk_size):
+            yield unit_start, self.read(unit_start, unit_start + chunk_size)
+
+    def flush(self) -> None:
+        """Writes the pending changes to disk."""
+        if self.mode == 'r+':
+            for chunk in self._chunks.values():
+                chunk.flush()
+            self._written.flush()
+
+    def close(self) -> None:
+        """Flushes and unmaps the chunks."""
+        self.flush()
+        self._chunks = {}
+
+    def __enter__(self) -> 'ResultStore':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def open_layer_results(layer_dir: str, layer_name: str) -> Union[ResultStore, np.ndarray]:
+    """
+    Opens the results of a layer for lazy reading: the ResultStore at
+    layer_dir/{layer_name}.store, or, for results created before the store
+    existed, layer_dir/{layer_name}.npy as a memory-mapped array. Both can
+    be sliced by unit, and only the sliced units are loaded into memory.
+    """
+    store_path = os.path.join(layer_dir, f"{layer_name}.store")
+    if os.path.exists(os.path.join(store_path, 'meta.json')):
+        return ResultStore(store_path)
+    return np.load(os.path.join(layer_dir, f"{layer_name}.npy"), mmap_mode='r')
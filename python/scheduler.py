@@ -0,0 +1,179 @@
+"""
+A cost-aware scheduler for the per-unit work of the generation scripts.
+
+Running one process per layer leaves most workers idle, because the layers
+are very uneven (e.g., AlexNet conv1 has 64 units at 15 x 15 pixels, while
+conv5 has 256 units at 191 x 191 pixels). Instead, the work is split into
+(layer, unit range) shards of similar cost, and the shards are handed out
+most expensive first, so that the workers finish at about the same time.
+
+Example:
+    shards = make_shards('alexnet', ModelInfo(), num_workers=4)
+    results, report = run_shards(create_visualizations_for_shard, shards, num_workers=4)
+    print_report(report)
+
+"""
+
+import os
+import time
+import math
+import multiprocessing
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+
+from model_utils import ModelInfo
+
+__all__ = ['Shard', 'unit_cost', 'make_shards', 'run_shards', 'print_report']
+
+
+class Shard(NamedTuple):
+    """The units [unit_start, unit_stop) of a layer, and their estimated cost."""
+    layer_name: str
+    unit_start: int
+    unit_stop: int
+    cost: float
+
+    @property
+    def unit_indices(self) -> range:
+        return range(self.unit_start, self.unit_stop)
+
+
+def unit_cost(xn: int, layer_index: int) -> float:
+    """
+    Estimates the relative cost of optimizing one unit: the number of input
+    pixels times the number of layers they go through.
+    """
+    return xn ** 2 * (layer_index + 1)
+
+
+def make_shards(model_name: str, model_info: ModelInfo, num_workers: int,
+                shards_per_worker: int = 4, min_units: int = 1,
+                layer_names: Optional[Sequence[str]] = None,
+                cost_fn: Callable[[int, int], float] = unit_cost) -> List[Shard]:
+    """
+    Splits the units of every layer into shards of roughly equal cost, and
+    returns them ordered from the most to the least expensive.
+
+    Args:
+        model_name (str): The name of the model.
+        model_info (ModelInfo): Provides xn, layer_index, and num_units.
+        num_workers (int): The number of worker processes.
+        shards_per_worker (int): The approximate number of shards per worker.
+        More shards balance the load better, but every shard pays the fixed
+        cost of building its truncated model.
+        min_units (int): The minimum number of units in a shard (e.g., the
+        batch size of the gradient ascent).
+        layer_names (list of str): The layers to include. Defaults to all.
+        cost_fn (function): Estimates the cost of one unit from (xn,
+        layer_index).
+
+    Returns:
+        The shards, most expensive first.
+    """
+    if layer_names is None:
+        layer_names = model_info.get_layer_names(model_name)
+
+    layer_costs = {}
+    for layer_name in layer_names:
+        layer_info = model_info.get_layer_info(model_name, layer_name)
+        layer_costs[layer_name] = (layer_info.num_units,
+                                   cost_fn(layer_info.xn, layer_info.layer_index))
+
+    total_cost = sum(num_units * cost for num_units, cost in layer_costs.values())
+    target_cost = total_cost / max(1, num_workers * shards_per_worker)
+
+    shards = []
+    for layer_name, (num_units, cost) in layer_costs.items():
+        units_per_shard = max(min_units, math.ceil(target_cost / cost))
+        for unit_start in range(0, num_units, units_per_shard):
+            unit_stop = min(unit_start + units_per_shard, num_units)
+            shards.append(Shard(layer_name, unit_start, unit_stop,
+                                (unit_stop - unit_start) * cost))
+
+    return sorted(shards, key=lambda shard: shard.cost, reverse=True)
+
+
+def _init_worker(num_threads: int) -> None:
+    # Without this, every worker would use all cores for its intra-op
+    # parallelism, and the workers would fight over them.
+    torch.set_num_threads(num_threads)
+
+
+def _run_shard(args: Tuple[Callable[[Shard], Any], Shard]) -> Tuple[Shard, Any, float, float, int]:
+    shard_fn, shard = args
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    result = shard_fn(shard)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    return shard, result, wall_time, cpu_time, os.getpid()
+
+
+def run_shards(shard_fn: Callable[[Shard], Any], shards: Sequence[Shard],
+               num_workers: int, threads_per_worker: Optional[int] = None,
+               result_fn: Optional[Callable[[Shard, Any], None]] = None
+               ) -> Tuple[List[Tuple[Shard, Any]], Dict[str, Any]]:
+    """
+    Runs shard_fn on every shard with a pool of worker processes. The shards
+    are handed out in the given order (see make_shards()) as soon as a worker
+    becomes free.
+
+    The return values of shard_fn are sent back to the main process, so keep
+    them small: write large results from the worker (e.g., to a
+    result_store.ResultStore), or pass result_fn to consume each return
+    value as soon as it arrives instead of holding all of them until the end.
+
+    Args:
+        shard_fn (function): Takes a shard. Must be picklable, i.e., defined
+        at the top level of a module.
+        shards (list): The shards to run, e.g., from make_shards() or
+        patch_ranking.make_image_shards().
+        num_workers (int): The number of worker processes.
+        threads_per_worker (int): The number of torch threads per worker.
+        Defaults to the number of cores divided by the number of workers.
+        result_fn (function): If given, called with (shard, return value of
+        shard_fn) in the main process as soon as each shard finishes, and
+        the return values are not kept.
+
+    Returns:
+        results: (shard, return value of shard_fn) in the order they finished.
+        Empty if result_fn is given.
+        report: {'wall_time', 'cpu_time', 'num_cores', 'core_utilization'
+                 (cpu_time / (wall_time * num_cores)), 'worker_busy_time'
+                 (busy wall time of each worker)}
+    """
+    num_cores = os.cpu_count() or 1
+    if threads_per_worker is None:
+        threads_per_worker = max(1, num_cores // num_workers)
+
+    results = []
+    cpu_time = 0.0
+    worker_busy_time = {}
+    wall_start = time.perf_counter()
+    with multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                              initargs=(threads_per_worker,)) as pool:
+        tasks = [(shard_fn, shard) for shard in shards]
+        for shard, result, shard_wall_time, shard_cpu_time, pid in \
+                pool.imap_unordered(_run_shard, tasks):
+            if result_fn is not None:
+                result_fn(shard, result)
+            else:
+                results.append((shard, result))
+            cpu_time += shard_cpu_time
+            worker_busy_time[pid] = worker_busy_time.get(pid, 0.0) + shard_wall_time
+    wall_time = time.perf_counter() - wall_start
+
+    report = {'wall_time': wall_time,
+              'cpu_time': cpu_time,
+              'num_cores': num_cores,
+              'core_utilization': cpu_time / (wall_time * num_cores) if wall_time > 0 else 0.0,
+              'worker_busy_time': sorted(worker_busy_time.values(), reverse=True)}
+    return results, report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """Prints the report returned by run_shards()."""
+    print(f"Wall time: {report['wall_time']:.1f} s, CPU time: {report['cpu_time']:.1f} s")
+    print(f"Core utilization: {100 * report['core_utilization']:.1f}% of {report['num_cores']} cores")
+    busy_times = ", ".join(f"{t:.1f}" for t in report['worker_busy_time'])
+    print(f"Busy time of each worker (s): {busy_times}")
@@ -14,19 +14,29 @@ Tony Fu, Bair Lab, July 2022
 
 """
 
+import os
 import math
-import copy
+import json
+import hashlib
+import operator
+import tempfile
 from typing import Tuple, Optional, Union, Dict, List
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.fx as fx
+from torch.nn.modules.utils import _pair
 from torchvision import models
 
-__all__ = ['SpatialIndexConverter']
+from model_utils import copy_module_structure
+
+__all__ = ['SpatialIndexConverter', 'CenterConeModel']
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+GEOMETRY_CACHE_DIR = os.path.join(CURRENT_DIR, os.pardir, 'results', 'geometry_cache')
 
 
 #######################################.#######################################
@@ -41,7 +51,8 @@ class HookFunctionBase:
     implement hook_function(). The child class must also call
     self.register_forward_hook_to_layers() by itself.
     """
-    def __init__(self, model: nn.Module, layer_types: Tuple[nn.Module]):
+    def __init__(self, model: nn.Module, layer_types: Tuple[nn.Module],
+                 device: Union[str, torch.device] = DEVICE):
         """
         Constructs a HookFunctionBase object.
 
@@ -54,9 +65,14 @@ class HookFunctionBase:
             hook to. For example, layer_types = (nn.Conv2d, nn.ReLU) means
             that all the Conv2d and ReLU layers will be registered with the
             forward hook.
+        device : str or torch.device
+            The device of the hooked copy of the model. On the 'meta' device,
+            the copy holds no weights and only computes shapes.
         """
-        self.model = copy.deepcopy(model)
-        self.model.to(DEVICE)
+        # Hooks are registered on the modules of the copy, but the weights
+        # are shared with the original model.
+        self.model = copy_module_structure(model, device)
+        self.model.to(device)
         self.model.eval()
         self.layer_types = layer_types
 
@@ -104,16 +120,91 @@ class SizeInspector(HookFunctionBase):
     To get the indexing information for any arbitrary model, use the syntax:
         inspector = SizeInspector(model, image_size)
         inspector.print_summary()
+
+    The sizes are inferred by running the model on meta tensors, which only
+    propagate shapes, so no weights are copied and nothing is computed. The
+    sizes are also cached on disk (keyed by the architecture of the model and
+    the image shape), so that later runs skip the forward pass entirely.
     """
-    def __init__(self, model: nn.Module, image_shape: Tuple[int, int]):
-        super().__init__(model, layer_types=(torch.nn.Module))
+    def __init__(self, model: nn.Module, image_shape: Tuple[int, int],
+                 cache_dir: Optional[str] = GEOMETRY_CACHE_DIR):
+        """
+        Parameters
+        ----------
+        model : torchvision.models
+            The neural network.
+        image_shape : tuple of ints
+            (vertical_dimension, horizontal_dimension) in pixels.
+        cache_dir : str
+            The directory of the geometry cache. None disables the cache.
+        """
+        super().__init__(model, layer_types=(torch.nn.Module), device='meta')
         self.image_shape = image_shape
         self.layers = []
         self.input_sizes = []
         self.output_sizes = []
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"{_get_geometry_key(model, image_shape)}.json")
+            if self._load_geometry(cache_path):
+                return
+
         self.register_forward_hook_to_layers(self.model)
-        
-        self.model(torch.zeros((1,3,*image_shape)).to(DEVICE))
+        try:
+            self.model(torch.zeros((1,3,*image_shape), device='meta'))
+        except (NotImplementedError, RuntimeError):
+            # Some operations have no meta implementation (e.g., on old torch
+            # versions). Fall back to a forward pass with the real weights.
+            self.layers, self.input_sizes, self.output_sizes = [], [], []
+            self.model = copy_module_structure(model, DEVICE).to(DEVICE).eval()
+            self.register_forward_hook_to_layers(self.model)
+            self.model(torch.zeros((1,3,*image_shape)).to(DEVICE))
+
+        if cache_path is not None:
+            self._save_geometry(cache_path)
+
+    def _load_geometry(self, cache_path: str) -> bool:
+        """
+        Loads the cached sizes. The layers are taken from the traced graph of
+        the model instead of the forward hooks. Returns False if there is no
+        cache entry, or if the layers do not match it.
+        """
+        try:
+            with open(cache_path) as f:
+                geometry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        try:
+            nodes = make_graph(self.model).values()
+        except Exception:
+            return False
+        layers = [node.layer for node in sorted((node for node in nodes if node.idx is not None),
+                                                key=lambda node: node.idx)]
+        if [type(layer).__name__ for layer in layers] != geometry['layer_types']:
+            return False
+
+        self.layers = layers
+        self.input_sizes = [torch.Size(size) for size in geometry['input_sizes']]
+        self.output_sizes = [torch.Size(size) for size in geometry['output_sizes']]
+        return True
+
+    def _save_geometry(self, cache_path: str) -> None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        geometry = {'layer_types': [type(layer).__name__ for layer in self.layers],
+                    'input_sizes': [list(size) for size in self.input_sizes],
+                    'output_sizes': [list(size) for size in self.output_sizes]}
+        # Write atomically, so that concurrent processes never read a
+        # partially written file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(geometry, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
     def hook_function(self, module: nn.Module, ten_in: torch.Tensor, ten_out: torch.Tensor) -> None:
         if (isinstance(module, self.layer_types)):
@@ -134,6 +225,19 @@ class SizeInspector(HookFunctionBase):
                 print(" This layer is not 2D.")
 
 
+def _get_geometry_key(model: nn.Module, image_shape: Tuple[int, int]) -> str:
+    """
+    Returns a hash of the architecture of the model (its modules and, for a
+    GraphModule, its generated code) and the image shape.
+    """
+    sha = hashlib.sha256()
+    sha.update(repr(model).encode())
+    if isinstance(model, fx.graph_module.GraphModule):
+        sha.update(model.code.encode())
+    sha.update(f"{tuple(image_shape)} {torch.__version__}".encode())
+    return sha.hexdigest()
+
+
 if __name__ == '__main__':
     model = models.alexnet()
     inspector = SizeInspector(model, (227, 227))
@@ -199,7 +303,7 @@ def make_graph(truncated_model: Union[fx.graph_module.GraphModule, torch.nn.Modu
     """
     # Make sure that the truncated_model is a GraphModule. 
     if not isinstance(truncated_model, fx.graph_module.GraphModule):
-        truncated_model = copy.deepcopy(truncated_model)
+        truncated_model = copy_module_structure(truncated_model)
         graph = fx.Tracer().trace(truncated_model.eval())
         truncated_model = fx.GraphModule(truncated_model, graph)
 
@@ -256,7 +360,8 @@ class SpatialIndexConverter(SizeInspector):
     mapping and other tasks that involve the mappings of spatial locations
     onto a different layer.
     """
-    def __init__(self, model: nn.Module, image_shape: Tuple[int, int]):
+    def __init__(self, model: nn.Module, image_shape: Tuple[int, int],
+                 cache_dir: Optional[str] = GEOMETRY_CACHE_DIR):
         """
         Constructs a SpatialIndexConverter object.
 
@@ -266,8 +371,11 @@ class SpatialIndexConverter(SizeInspector):
             The neural network.
         image_shape : tuple of ints
             (vertical_dimension, horizontal_dimension) in pixels.
+        cache_dir : str
+            The directory of the geometry cache (see SizeInspector). None
+            disables the cache.
         """
-        super().__init__(model, image_shape)
+        super().__init__(model, image_shape, cache_dir=cache_dir)
         self.dont_need_conversion = (nn.Sequential,
                                     nn.ModuleList,
                                     nn.Sigmoid,
@@ -278,10 +386,19 @@ class SpatialIndexConverter(SizeInspector):
                                     nn.Dropout2d,)
         self.need_convsersion = (nn.Conv2d, nn.AvgPool2d, nn.MaxPool2d)
         
-        # Represent the model as a directed, acyclic graph stored in a dict
-        self.graph_dict = make_graph(model)
+        # Represent the model as a directed, acyclic graph stored in a dict.
+        # Only the structure is needed, so trace the weightless copy.
+        self.graph_dict = make_graph(self.model)
         self.idx_to_node = {node.idx: name for name, node in self.graph_dict.items()}
 
+        # Lookup tables of convert_many(), keyed by (start_layer_index,
+        # end_layer_index, is_forward).
+        self._lookup_tables = {}
+
+        # Nodes on the paths between two layers, keyed by (start_layer_name,
+        # end_layer_name, is_forward). See _get_path_order().
+        self._path_orders = {}
+
     def _forward_transform(self, x_min: int, x_max: int, stride: int,
                            kernel_size: int, padding: int, max_size: int) -> Tuple[int, int]:
         x_min = math.floor((x_min + padding - kernel_size)/stride + 1)
@@ -375,8 +492,94 @@ class SpatialIndexConverter(SizeInspector):
                max([box[2] for box in box_list]),\
                max([box[3] for box in box_list])
 
+    def _get_path_order(self, start_layer_name: str, end_layer_name: str,
+                        is_forward: bool) -> List[str]:
+        """
+        Returns the nodes on the paths from start_layer_name to end_layer_name
+        (following the children if is_forward, otherwise the parents) in
+        topological order, starting with start_layer_name.
+        """
+        key = (start_layer_name, end_layer_name, is_forward)
+        if key in self._path_orders:
+            return self._path_orders[key]
+
+        def next_nodes(name):
+            node = self.graph_dict[name]
+            return node.children if is_forward else node.parents
+
+        # Depth-first search that stops at the end node. The reverse
+        # post-order is a topological order.
+        post_order = []
+        visited = {start_layer_name}
+        stack = [(start_layer_name, iter(next_nodes(start_layer_name)
+                                          if start_layer_name != end_layer_name else ()))]
+        while stack:
+            name, remaining = stack[-1]
+            next_name = next(remaining, None)
+            if next_name is None:
+                stack.pop()
+                post_order.append(name)
+                if name != end_layer_name and not next_nodes(name):
+                    raise ValueError(f"There is a path from {start_layer_name} that does not "
+                                     f"go through {end_layer_name}, so the box cannot be "
+                                     f"projected onto {end_layer_name}.")
+            elif next_name not in visited:
+                visited.add(next_name)
+                stack.append((next_name, iter(next_nodes(next_name)
+                                              if next_name != end_layer_name else ())))
+
+        order = post_order[::-1]
+        self._path_orders[key] = order
+        return order
+
+    def _convert(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
+                 start_layer_name: str, end_layer_name: str,
+                 is_forward: bool) -> Tuple[int, int, int, int]:
+        """
+        Projects the box from start_layer_name to end_layer_name in a single
+        pass over the nodes in topological order. The box of each node is the
+        merge of the boxes coming from all its predecessors on the way, so
+        every node is projected once instead of once per path.
+
+        This gives the same result as following every path separately and
+        merging at the end (see _forward_convert_recursive()), because each
+        bound of a projection is a non-decreasing function of the same bound
+        before it, and therefore commutes with taking the min/max.
+        """
+        boxes = {}
+        for name in self._get_path_order(start_layer_name, end_layer_name, is_forward):
+            if name == start_layer_name:
+                box = (vx_min, hx_min, vx_max, hx_max)
+            else:
+                node = self.graph_dict[name]
+                previous_names = node.parents if is_forward else node.children
+                box = self._merge_boxes([boxes[previous_name] for previous_name in previous_names
+                                         if previous_name in boxes])
+
+            # If this node is a layer (as opposed to an operation), calculate
+            # the new box.
+            layer_index = self.graph_dict[name].idx
+            if isinstance(layer_index, int):
+                box = self._one_projection(layer_index, *box, is_forward=is_forward)
+            boxes[name] = box
+        return boxes[end_layer_name]
+
     def _forward_convert(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
                          start_layer_name: str, end_layer_name:str) -> Tuple[int, int, int, int]:
+        return self._convert(vx_min, hx_min, vx_max, hx_max,
+                             start_layer_name, end_layer_name, is_forward=True)
+
+    def _backward_convert(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
+                          start_layer_name: str, end_layer_name: str) -> Tuple[int, int, int, int]:
+        return self._convert(vx_min, hx_min, vx_max, hx_max,
+                             start_layer_name, end_layer_name, is_forward=False)
+
+    def _forward_convert_recursive(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
+                                   start_layer_name: str, end_layer_name:str) -> Tuple[int, int, int, int]:
+        # The original implementation of _forward_convert(). It follows every
+        # path separately, so its cost grows exponentially with the number of
+        # branches (e.g., residual blocks). Kept for benchmarking.
+
         # If this 'start_layer_name' is a layer (as opposed to an operation),
         # calculate the new box.
         layer_index = self.graph_dict[start_layer_name].idx
@@ -392,11 +595,14 @@ class SpatialIndexConverter(SizeInspector):
         children = self.graph_dict[start_layer_name].children
         boxes = []
         for child in children:
-            boxes.append(self._forward_convert(vx_min, hx_min, vx_max, hx_max, child, end_layer_name))
+            boxes.append(self._forward_convert_recursive(vx_min, hx_min, vx_max, hx_max, child, end_layer_name))
         return self._merge_boxes(boxes)
 
-    def _backward_convert(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
-                          start_layer_name: str, end_layer_name: str) -> Tuple[int, int, int, int]:
+    def _backward_convert_recursive(self, vx_min: int, hx_min: int, vx_max: int, hx_max: int,
+                                    start_layer_name: str, end_layer_name: str) -> Tuple[int, int, int, int]:
+        # The original implementation of _backward_convert(). Kept for
+        # benchmarking.
+
         # If this 'start_layer_name' is a layer (as opposed to an operation),
         # calculate the new box.
         layer_index = self.graph_dict[start_layer_name].idx
@@ -413,7 +619,7 @@ class SpatialIndexConverter(SizeInspector):
         boxes = []
         for parent in parents:
             # Recurse case:
-            boxes.append(self._backward_convert(vx_min, hx_min, vx_max, hx_max, parent, end_layer_name))
+            boxes.append(self._backward_convert_recursive(vx_min, hx_min, vx_max, hx_max, parent, end_layer_name))
         return self._merge_boxes(boxes)
 
     def convert(self, index: Union[int, Tuple[int, int]],
@@ -494,9 +700,316 @@ class SpatialIndexConverter(SizeInspector):
                                           start_layer_name, end_layer_name)
         # Return format: (vx_min, hx_min, vx_max, hx_max)
 
+    def _get_lookup_tables(self, start_layer_index: int, end_layer_index: int,
+                           is_forward: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the (vertical, horizontal) lookup tables of convert_many().
+        Row i of the vertical table is (vx_min, vx_max) of the box converted
+        from vertical index i, and likewise for the horizontal table.
+
+        Every projection and merge treats the two spatial dimensions (and the
+        min and max of each) independently, so the vertical extent of a box
+        only depends on the vertical index, and vice versa. The tables are
+        therefore filled with one convert() call per row and per column,
+        which also guarantees identical results.
+        """
+        key = (start_layer_index, end_layer_index, is_forward)
+        if key not in self._lookup_tables:
+            # A forward projection starts at the input of the start layer, a
+            # backward projection at its output.
+            sizes = self.input_sizes if is_forward else self.output_sizes
+            _, height, width = sizes[start_layer_index]
+            v_table = np.empty((height, 2), dtype=np.int64)
+            h_table = np.empty((width, 2), dtype=np.int64)
+            for vx in range(height):
+                vx_min, _, vx_max, _ = self.convert((vx, 0), start_layer_index,
+                                                    end_layer_index, is_forward)
+                v_table[vx] = vx_min, vx_max
+            for hx in range(width):
+                _, hx_min, _, hx_max = self.convert((0, hx), start_layer_index,
+                                                    end_layer_index, is_forward)
+                h_table[hx] = hx_min, hx_max
+            self._lookup_tables[key] = (v_table, h_table)
+        return self._lookup_tables[key]
+
+    def convert_many(self, indices: Union[np.ndarray, Tuple[np.ndarray, np.ndarray]],
+                     start_layer_index: int, end_layer_index: int,
+                     is_forward: bool) -> np.ndarray:
+        """
+        Converts many spatial indices at once. Equivalent to calling convert()
+        on every index, but after the first call for a pair of layers, it is
+        a single vectorized table lookup.
+
+        Parameters
+        ----------
+        indices : numpy.ndarray or tuple of two numpy.ndarrays
+            Either an integer array of 1D spatial indices (of any shape),
+            which are unraveled like in convert(), or a tuple (vx, hx) of
+            integer arrays of vertical and horizontal indices.
+        start_layer_index, end_layer_index, is_forward
+            See convert().
+
+        Returns
+        -------
+        boxes : numpy.ndarray
+            The boxes in (vx_min, hx_min, vx_max, hx_max) format, with shape
+            (*indices.shape, 4).
+        """
+        if isinstance(indices, tuple):
+            vx, hx = np.asarray(indices[0]), np.asarray(indices[1])
+        else:
+            _, output_height, output_width = self.output_sizes[start_layer_index]
+            vx, hx = np.unravel_index(np.asarray(indices), (output_height, output_width))
+
+        v_table, h_table = self._get_lookup_tables(start_layer_index, end_layer_index, is_forward)
+        if vx.size and (vx.min() < 0 or vx.max() >= len(v_table) or
+                        hx.min() < 0 or hx.max() >= len(h_table)):
+            raise IndexError(f"Spatial indices must be within ({len(v_table)}, {len(h_table)})")
+        return np.stack([v_table[vx, 0], h_table[hx, 0], v_table[vx, 1], h_table[hx, 1]], axis=-1)
+
 
 if __name__ == '__main__':
     model = models.resnet18()
     converter = SpatialIndexConverter(model, (227, 227))
     coord = converter.convert((64, 64), 21, 0, is_forward=False)
     print(coord)
+
+
+#######################################.#######################################
+#                                                                             #
+#                              CENTER CONE MODEL                              #
+#                                                                             #
+###############################################################################
+class CenterConeModel(nn.Module):
+    """
+    Executes a truncated model on the "dependency cone" of its center unit.
+    Gradient ascent only uses the response at the center of the last layer,
+    but the truncated model computes the full spatial map at every
+    intermediate layer. This wrapper uses the geometry of a
+    SpatialIndexConverter to find, for every operation in the graph, the box
+    of its output that can influence the center output location, and then
+    only computes that box: convolutions and poolings are applied to the
+    cropped input (with their own padding emulated explicitly at the image
+    borders), and element-wise operations are applied to crops aligned to the
+    same box.
+
+    The output has shape (num_images, num_units, 1, 1), so the center unit is
+    still at (ny//2, nx//2) and GradientAscent works unchanged:
+
+        truncated_model = get_truncated_model(model, layer_index)
+        cone_model = CenterConeModel(truncated_model, (xn, xn))
+        ga = GradientAscent(cone_model, unit_indices, img)
+
+    The model can only be used with input images of shape image_shape.
+    """
+    elementwise_functions = (operator.add, operator.mul, torch.add, torch.mul,
+                             torch.relu, F.relu)
+    elementwise_methods = ('add', 'mul', 'relu')
+
+    def __init__(self, truncated_model: Union[fx.graph_module.GraphModule, torch.nn.Module],
+                 image_shape: Tuple[int, int]):
+        """
+        Constructs a CenterConeModel object.
+
+        Parameters
+        ----------
+        truncated_model : UNION[fx.graph_module.GraphModule, torch.nn.Module]
+            The neural network. Can be truncated or not, but its output must
+            be a 2D feature map.
+        image_shape : tuple of ints
+            (vertical_dimension, horizontal_dimension) in pixels.
+        """
+        super().__init__()
+        # Make sure that the truncated_model is a GraphModule so that the node
+        # names agree with the ones in the converter's graph.
+        if not isinstance(truncated_model, fx.graph_module.GraphModule):
+            graph = fx.Tracer().trace(truncated_model.eval())
+            truncated_model = fx.GraphModule(truncated_model, graph)
+        self.truncated_model = truncated_model
+        self.image_shape = tuple(image_shape)
+        # Keep track of the units of a pruned model (see
+        # model_utils.prune_output_channels()).
+        self.unit_indices = getattr(truncated_model, 'unit_indices', None)
+
+        converter = SpatialIndexConverter(truncated_model, image_shape)
+        self.elementwise_layers = converter.dont_need_conversion
+        self.plan = self._make_plan(converter)
+
+    def rebind(self, truncated_model: fx.graph_module.GraphModule) -> 'CenterConeModel':
+        """
+        Returns a CenterConeModel that runs another version of the same graph,
+        e.g., one pruned with model_utils.prune_output_channels(), without
+        recomputing the geometry.
+        """
+        cone_model = CenterConeModel.__new__(CenterConeModel)
+        nn.Module.__init__(cone_model)
+        cone_model.truncated_model = truncated_model
+        cone_model.image_shape = self.image_shape
+        cone_model.unit_indices = getattr(truncated_model, 'unit_indices', None)
+        cone_model.elementwise_layers = self.elementwise_layers
+        cone_model.plan = self.plan
+        return cone_model
+
+    def _get_sizes(self, converter: SpatialIndexConverter, node: fx.node.Node) -> Tuple[int, int, int, int]:
+        """Returns (input_height, input_width, output_height, output_width) of a layer."""
+        idx = converter.graph_dict[node.name].idx
+        _, in_h, in_w = converter.input_sizes[idx]
+        _, out_h, out_w = converter.output_sizes[idx]
+        return in_h, in_w, out_h, out_w
+
+    def _input_range(self, x_min: int, x_max: int, stride: int, kernel_size: int,
+                     padding: int, max_size: int) -> Tuple[int, int, int, int]:
+        """
+        Same as SpatialIndexConverter._backward_transform(), but also returns
+        the unclipped range, which tells us how much padding to add.
+        """
+        unclipped_min = (x_min * stride) - padding
+        unclipped_max = (x_max * stride) + kernel_size - 1 - padding
+        return (clip(unclipped_min, 0, max_size - 1), clip(unclipped_max, 0, max_size - 1),
+                unclipped_min, unclipped_max)
+
+    def _make_plan(self, converter: SpatialIndexConverter) -> List[Tuple]:
+        """
+        Determines the box (vx_min, hx_min, vx_max, hx_max) needed from each
+        node by walking the graph backward from the center output location,
+        then records how each node should be computed from the boxes of its
+        inputs.
+        """
+        nodes = list(self.truncated_model.graph.nodes)
+        boxes = {}
+
+        def require(node: fx.node.Node, box: Tuple[int, int, int, int]) -> None:
+            if node.name in boxes:
+                box = converter._merge_boxes([boxes[node.name], box])
+            boxes[node.name] = box
+
+        # Backward pass: determine the box needed from each node.
+        for node in reversed(nodes):
+            if node.op == 'output':
+                last_node = node.args[0]
+                if not (isinstance(last_node, fx.node.Node) and last_node.op == 'call_module'):
+                    raise ValueError("The output of the model must be the output of a layer.")
+                _, _, out_h, out_w = self._get_sizes(converter, last_node)
+                require(last_node, (out_h//2, out_w//2, out_h//2, out_w//2))
+                continue
+            if node.name not in boxes or node.op == 'placeholder':
+                continue
+
+            vx_min, hx_min, vx_max, hx_max = boxes[node.name]
+            if node.op == 'call_module':
+                layer = self.truncated_model.get_submodule(node.target)
+                if isinstance(layer, converter.need_convsersion):
+                    stride, kernel_size, padding = self._check_layer(layer)
+                    in_h, in_w, _, _ = self._get_sizes(converter, node)
+                    v_min, v_max, _, _ = self._input_range(vx_min, vx_max, stride[0],
+                                                           kernel_size[0], padding[0], in_h)
+                    h_min, h_max, _, _ = self._input_range(hx_min, hx_max, stride[1],
+                                                           kernel_size[1], padding[1], in_w)
+                    require(node.args[0], (v_min, h_min, v_max, h_max))
+                    continue
+                if not isinstance(layer, self.elementwise_layers):
+                    raise ValueError(f"{type(layer)} is currently not supported by CenterConeModel.")
+            elif not ((node.op == 'call_function' and node.target in self.elementwise_functions) or
+                      (node.op == 'call_method' and node.target in self.elementwise_methods)):
+                raise ValueError(f"{node.op} '{node.target}' is currently not supported by CenterConeModel.")
+
+            # Element-wise operations need the same box from all their inputs.
+            for arg in node.args:
+                if isinstance(arg, fx.node.Node):
+                    require(arg, boxes[node.name])
+
+        # Forward pass: record how to compute each node from its inputs.
+        plan = []
+        for node in nodes:
+            if node.op == 'output':
+                plan.append(('output', node.args[0].name))
+                break
+            if node.name not in boxes:
+                continue
+
+            vx_min, hx_min, vx_max, hx_max = boxes[node.name]
+            if node.op == 'placeholder':
+                crop = (slice(vx_min, vx_max + 1), slice(hx_min, hx_max + 1))
+                plan.append(('placeholder', node.name, crop))
+                continue
+
+            if node.op == 'call_module':
+                layer = self.truncated_model.get_submodule(node.target)
+                if isinstance(layer, converter.need_convsersion):
+                    stride, kernel_size, padding = self._check_layer(layer)
+                    in_h, in_w, _, _ = self._get_sizes(converter, node)
+                    v_min, v_max, v_unclipped_min, v_unclipped_max =\
+                        self._input_range(vx_min, vx_max, stride[0], kernel_size[0], padding[0], in_h)
+                    h_min, h_max, h_unclipped_min, h_unclipped_max =\
+                        self._input_range(hx_min, hx_max, stride[1], kernel_size[1], padding[1], in_w)
+                    crop = self._relative_crop(boxes[node.args[0].name], (v_min, h_min, v_max, h_max))
+                    # (left, right, top, bottom), the format expected by F.pad()
+                    pad = (h_min - h_unclipped_min, h_unclipped_max - h_max,
+                           v_min - v_unclipped_min, v_unclipped_max - v_max)
+                    plan.append(('window', node.name, node.target, node.args[0].name, crop, pad))
+                    continue
+
+            args = []
+            for arg in node.args:
+                if isinstance(arg, fx.node.Node):
+                    args.append((arg.name, self._relative_crop(boxes[arg.name], boxes[node.name])))
+                else:
+                    args.append((None, arg))
+            plan.append(('elementwise', node.name, node.op, node.target, args, node.kwargs))
+        return plan
+
+    def _check_layer(self, layer: nn.Module) -> Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]:
+        """Returns the (stride, kernel_size, padding) of a conv/pool layer as pairs."""
+        if isinstance(layer, nn.Conv2d):
+            if layer.dilation != (1, 1):
+                raise ValueError("Dilated convolution is currently not supported by CenterConeModel.")
+            if layer.padding_mode != 'zeros':
+                raise ValueError(f"Padding mode '{layer.padding_mode}' is currently not supported by CenterConeModel.")
+        if isinstance(layer, nn.MaxPool2d) and (_pair(layer.dilation) != (1, 1)):
+            raise ValueError("Dilated max pooling is currently not supported by CenterConeModel.")
+        if isinstance(layer, nn.AvgPool2d) and (layer.ceil_mode or not layer.count_include_pad):
+            raise ValueError("Only zero-padded average pooling is supported by CenterConeModel.")
+        return _pair(layer.stride), _pair(layer.kernel_size), _pair(layer.padding)
+
+    def _relative_crop(self, available_box: Tuple[int, int, int, int],
+                       needed_box: Tuple[int, int, int, int]) -> Tuple[slice, slice]:
+        """Slices needed_box out of a tensor that covers available_box."""
+        v_offset, h_offset = available_box[0], available_box[1]
+        return (slice(needed_box[0] - v_offset, needed_box[2] - v_offset + 1),
+                slice(needed_box[1] - h_offset, needed_box[3] - h_offset + 1))
+
+    def _window(self, layer: nn.Module, x: torch.Tensor, pad: Tuple[int, int, int, int]) -> torch.Tensor:
+        """Applies a conv/pool layer to a crop, emulating the layer's padding."""
+        if isinstance(layer, nn.Conv2d):
+            return F.conv2d(F.pad(x, pad), layer.weight, layer.bias, layer.stride,
+                            0, layer.dilation, layer.groups)
+        if isinstance(layer, nn.MaxPool2d):
+            return F.max_pool2d(F.pad(x, pad, value=-math.inf), layer.kernel_size, layer.stride)
+        return F.avg_pool2d(F.pad(x, pad), layer.kernel_size, layer.stride,
+                            divisor_override=layer.divisor_override)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if tuple(x.shape[-2:]) != self.image_shape:
+            raise ValueError(f"CenterConeModel was built for images of shape {self.image_shape}, "
+                             f"but got {tuple(x.shape[-2:])}")
+        env = {}
+        for step in self.plan:
+            kind, name = step[0], step[1]
+            if kind == 'placeholder':
+                env[name] = x[..., step[2][0], step[2][1]]
+            elif kind == 'window':
+                _, _, target, input_name, crop, pad = step
+                layer = self.truncated_model.get_submodule(target)
+                env[name] = self._window(layer, env[input_name][..., crop[0], crop[1]], pad)
+            elif kind == 'elementwise':
+                _, _, op, target, args, kwargs = step
+                values = [env[arg][..., crop[0], crop[1]] if arg is not None else crop
+                          for arg, crop in args]
+                if op == 'call_method':
+                    env[name] = getattr(values[0], target)(*values[1:], **kwargs)
+                elif op == 'call_module':
+                    env[name] = self.truncated_model.get_submodule(target)(*values, **kwargs)
+                else:
+                    env[name] = target(*values, **kwargs)
+            else:  # output
+                return env[name]
@@ -0,0 +1,185 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from grad_ascent import GradientAscent, UnitStats, run_gradient_ascent, precision_fidelity_report
+from model_utils import TruncationCache, prune_output_channels
+
+XN = 7
+
+
+def make_model(dead_units=(), zero_units=()):
+    """
+    A conv layer followed by a ReLU. All units respond to the zero image,
+    except the units in dead_units, which have a negative bias (so they have
+    no gradient at the zero image). The units in zero_units have no weights
+    at all (so they never have a gradient).
+    """
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 6, 3), nn.ReLU()).eval()
+    with torch.no_grad():
+        model[0].bias.fill_(0.1)
+        for unit_index in dead_units:
+            model[0].bias[unit_index] = -0.1
+        for unit_index in zero_units:
+            model[0].weight[unit_index] = 0
+    return model
+
+
+def zero_img(unit_index):
+    return torch.zeros(1, 3, XN, XN)
+
+
+def random_img(unit_index):
+    return torch.randn(1, 3, XN, XN, generator=torch.Generator().manual_seed(unit_index))
+
+
+def run_alone(model, unit_index, img, num_iter, **kwargs):
+    ga = GradientAscent(model, unit_index, img.clone(), **kwargs)
+    for _ in range(num_iter):
+        ga.step()
+    return ga.img.detach()
+
+
+def test_unit_stats():
+    stats = UnitStats(3)
+    assert stats.num_steps == 0 and not stats.is_finished
+    assert repr(stats) == "UnitStats(unit_index=3, status='running', num_steps=0, response=None)"
+
+    model = make_model()
+    ga = GradientAscent(model, [0, 1], torch.cat([random_img(0), random_img(1)]),
+                        lr=0.1, max_iter=2, record_norms=True)
+    ga.step()
+    stats = ga.stats[1]
+    assert stats.num_steps == 1 and not stats.is_finished
+    assert len(stats.grad_norms) == len(stats.step_sizes) == 1
+    # Plain SGD moves the image by lr times the gradient
+    assert stats.step_sizes[0] == pytest.approx(0.1 * stats.grad_norms[0], rel=1e-4)
+    ga.step()
+    assert [stats.status for stats in ga.stats] == ['max_iter', 'max_iter']
+    assert ga.finished_slots() == [0, 1]
+
+
+def test_unit_stats_norms_are_optional():
+    ga = GradientAscent(make_model(), [0, 1], torch.cat([random_img(0), random_img(1)]))
+    ga.step()
+    assert ga.stats[0].num_steps == 1
+    assert ga.stats[0].grad_norms == [] and ga.stats[0].step_sizes == []
+
+
+def test_retire_and_backfill_order():
+    # Units 1 and 2 have no gradient, so they converge (grad_tol=0) after one
+    # step, and their slot goes to the next pending unit.
+    model = make_model(zero_units=(1, 2))
+    runs = list(run_gradient_ascent(model, [0, 1, 2, 3], zero_img, batch_size=2,
+                                    max_iter=3, grad_tol=0))
+    assert [unit_index for unit_index, _, _ in runs] == [1, 2, 0, 3]
+    assert [stats.status for _, _, stats in runs] == ['converged', 'converged', 'max_iter', 'max_iter']
+    assert [stats.num_steps for _, _, stats in runs] == [1, 1, 3, 3]
+
+    # A backfilled unit starts from its own image with a fresh optimizer state
+    results = {unit_index: result for unit_index, result, _ in runs}
+    for unit_index in (0, 3):
+        expected = run_alone(model, unit_index, zero_img(unit_index), 3)
+        torch.testing.assert_close(results[unit_index], expected)
+
+
+@pytest.mark.parametrize('optimizer', ['SGD', 'Adam'])
+def test_no_tolerance_matches_plain_loop(optimizer):
+    model = make_model()
+    num_iter = 5
+    runs = run_gradient_ascent(model, range(6), random_img, batch_size=4, optimizer=optimizer,
+                               max_iter=num_iter, rel_tol=None, grad_tol=None)
+    for unit_index, result, stats in runs:
+        assert stats.status == 'max_iter' and stats.num_steps == num_iter
+        expected = run_alone(model, unit_index, random_img(unit_index), num_iter, optimizer=optimizer)
+        torch.testing.assert_close(result, expected)
+
+
+def test_pruned_model_matches_full_model():
+    truncated_model = TruncationCache(make_model()).get(1)
+    calls = []
+
+    def model_fn(unit_indices):
+        calls.append(list(unit_indices))
+        return prune_output_channels(truncated_model, unit_indices)
+
+    kwargs = dict(batch_size=2, max_iter=3, grad_tol=0)
+    full = {unit_index: result for unit_index, result, _
+            in run_gradient_ascent(truncated_model, range(6), random_img, **kwargs)}
+    pruned = {unit_index: result for unit_index, result, _
+              in run_gradient_ascent(truncated_model, range(6), random_img, model_fn=model_fn, **kwargs)}
+    assert full.keys() == pruned.keys()
+    for unit_index in full:
+        torch.testing.assert_close(pruned[unit_index], full[unit_index])
+    # The model covers the next batch_size pending units, so it is not
+    # rebuilt after every retirement.
+    assert len(calls) < 6
+
+
+def test_dead_units_skip():
+    model = make_model(dead_units=(1, 4))
+    runs = list(run_gradient_ascent(model, range(6), zero_img, batch_size=4, max_iter=3,
+                                    dead_units='skip'))
+    # The dead units are returned first, unchanged
+    assert [unit_index for unit_index, _, _ in runs[:2]] == [1, 4]
+    for _, result, stats in runs[:2]:
+        assert stats.status == 'dead' and stats.num_steps == 1
+        assert stats.grad_norms == [0]
+        assert torch.equal(result, zero_img(0))
+    assert sorted(unit_index for unit_index, _, _ in runs[2:]) == [0, 2, 3, 5]
+    assert all(stats.status == 'max_iter' for _, _, stats in runs[2:])
+
+
+def test_dead_units_restart():
+    model = make_model(dead_units=(1, 4))
+
+    def restart_img_fn(unit_index):
+        # The weights of the unit, at the center, make the unit respond
+        img = torch.zeros(1, 3, XN, XN)
+        img[0, :, XN//2 - 1:XN//2 + 2, XN//2 - 1:XN//2 + 2] = 10 * model[0].weight[unit_index].detach()
+        return img
+
+    runs = {unit_index: (result, stats) for unit_index, result, stats
+            in run_gradient_ascent(model, range(6), zero_img, batch_size=4, max_iter=3,
+                                   dead_units='restart', restart_img_fn=restart_img_fn)}
+    assert sorted(runs) == list(range(6))
+    for unit_index, (result, stats) in runs.items():
+        assert stats.status == 'max_iter'
+        start_img = restart_img_fn(unit_index) if unit_index in (1, 4) else zero_img(unit_index)
+        torch.testing.assert_close(result, run_alone(model, unit_index, start_img, 3))
+    assert not torch.equal(runs[1][0], restart_img_fn(1))
+
+
+def test_dead_units_invalid_option():
+    with pytest.raises(ValueError):
+        list(run_gradient_ascent(make_model(), range(2), zero_img, dead_units='revive'))
+
+
+def test_measure_matches_probe():
+    ga = GradientAscent(make_model(), [0, 3], torch.cat([random_img(0), random_img(3)]))
+    responses, _ = ga.probe()
+    assert ga.measure() == pytest.approx(responses)
+
+
+def test_precision_fidelity_thresholds():
+    model = make_model()
+    kwargs = dict(precision='bfloat16', num_samples=3, max_iter=3)
+    report = precision_fidelity_report(model, range(6), random_img, **kwargs)
+    assert len(report) == 3 and all(row['passed'] for row in report)
+    report = precision_fidelity_report(model, range(6), random_img, min_correlation=1.1, **kwargs)
+    assert not any(row['passed'] for row in report)
+
+
+def test_dead_units_restart_seed():
+    model = make_model(dead_units=(1,))
+
+    def run(seed):
+        return {unit_index: result for unit_index, result, _
+                in run_gradient_ascent(model, range(3), zero_img, max_iter=2,
+                                       dead_units='restart', seed=seed)}
+
+    first, second = run(seed=0), run(seed=0)
+    assert torch.equal(first[1], second[1])
+    assert not torch.equal(first[1], zero_img(1))
+    assert not torch.equal(first[1], run(seed=1)[1])
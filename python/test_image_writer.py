@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+from image_writer import ImageWriter
+
+
+def test_on_saved_is_called_after_the_image_is_saved(tmp_path):
+    saved = []
+    paths = [str(tmp_path / f"{i}.png") for i in range(5)]
+    with ImageWriter() as writer:
+        for i, path in enumerate(paths):
+            writer.write(path, np.full((4, 4, 3), 0.5),
+                         on_saved=lambda path=path: saved.append(os.path.exists(path)))
+    assert saved == [True] * 5
+
+
+def test_writer_stops_after_an_error(tmp_path):
+    saved = []
+    missing_dir = tmp_path / 'missing'
+    img = np.zeros((4, 4, 3))
+    writer = ImageWriter(num_threads=1)
+    writer.write(str(missing_dir / '0.png'), img, on_saved=lambda: saved.append(0))
+    writer._queue.join()
+    # The later images are not saved, and their callbacks are not called
+    with pytest.raises(RuntimeError, match='0.png'):
+        writer.write(str(tmp_path / '1.png'), img, on_saved=lambda: saved.append(1))
+    with pytest.raises(RuntimeError, match='0.png') as error:
+        writer.close()
+    assert isinstance(error.value.__cause__, OSError)
+    assert writer.unsaved_paths == [str(missing_dir / '0.png')]
+    assert saved == [] and not os.path.exists(tmp_path / '1.png')
+
+
+def test_queued_images_are_reported_after_an_error(tmp_path):
+    img = np.zeros((4, 4, 3))
+    paths = [str(tmp_path / 'missing' / '0.png')] + [str(tmp_path / f"{i}.png") for i in range(1, 4)]
+    writer = ImageWriter(num_threads=1)
+    # Hold the worker until every image is queued
+    writer._lock.acquire()
+    writer.write(paths[0], img)
+    for path in paths[1:]:
+        writer.write(path, img)
+    writer._lock.release()
+    with pytest.raises(RuntimeError):
+        writer.close()
+    assert sorted(writer.unsaved_paths) == sorted(paths)
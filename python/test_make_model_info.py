@@ -0,0 +1,30 @@
+import os
+import re
+import json
+
+import pytest
+from torchvision import models
+
+from make_model_info import CURRENT_DIR, MODEL_NAMES, compare_with_table, derive_model_info, to_rf_data
+from model_utils import ModelInfo
+
+DOCS_JS_DIR = os.path.join(CURRENT_DIR, os.pardir, 'docs', 'js')
+
+
+def read_rf_data(js_path):
+    with open(js_path) as f:
+        return json.loads(re.search(r"let rf_data = (\{.*?\n\})", f.read(), re.DOTALL).group(1))
+
+
+@pytest.mark.parametrize('model_name', MODEL_NAMES)
+def test_derived_rows_match_table(model_name):
+    rows = derive_model_info(getattr(models, model_name)(), model_name)
+    model_info = ModelInfo()
+    assert compare_with_table(rows, model_info) == []
+    assert len(rows) == len(model_info.get_layer_names(model_name))
+
+
+@pytest.mark.parametrize('js_file', ['playground.js', 'gallery.js'])
+def test_web_app_rf_data_matches_table(js_file):
+    table_rows = ModelInfo().to_dataframe().to_dict('records')
+    assert read_rf_data(os.path.join(DOCS_JS_DIR, js_file)) == to_rf_data(table_rows)
@@ -0,0 +1,19 @@
+import torch
+from torchvision import models
+
+from model_utils import TruncationCache
+
+
+def test_truncated_model_returns_last_layer_response():
+    # Regression test: the output node of a truncated model used to reference
+    # the node of the traced graph instead of its copy, and newer torch.fx
+    # versions returned None.
+    model = models.alexnet().eval()
+    truncations = TruncationCache(model)
+    x = torch.randn(2, 3, 63, 63)
+    with torch.no_grad():
+        for layer_index, expected in [(0, model.features[0](x)),
+                                      (2, model.features[:3](x))]:
+            y = truncations.get(layer_index)(x)
+            assert isinstance(y, torch.Tensor)
+            torch.testing.assert_close(y, expected)
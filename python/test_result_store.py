@@ -0,0 +1,55 @@
+import functools
+
+import numpy as np
+import pytest
+
+from image_writer import ImageWriter
+from result_store import ResultStore
+
+
+def test_open_or_create_resumes_matching_store(tmp_path):
+    path = str(tmp_path / 'conv1.store')
+    with ResultStore.open_or_create(path, 4, (3, 3, 3), key='settings') as store:
+        assert store.dtype == 'float32'
+        store.write(2, np.full((3, 3, 3), 0.1))
+
+    # Same settings: the written unit is kept, and its value is exact
+    with ResultStore.open_or_create(path, 4, (3, 3, 3), key='settings') as store:
+        assert [store.is_written(unit_index) for unit_index in range(4)] == [False, False, True, False]
+        assert store.num_written == 1
+        assert np.array_equal(store[2], np.full((3, 3, 3), 0.1, dtype=np.float32))
+
+
+def test_open_or_create_replaces_other_store(tmp_path):
+    path = str(tmp_path / 'conv1.store')
+    with ResultStore.open_or_create(path, 4, (3, 3, 3), key='settings') as store:
+        store.write(2, np.ones((3, 3, 3)))
+
+    for kwargs in [dict(key='other settings'), dict(key='settings', dtype='float16')]:
+        with ResultStore.open_or_create(path, 4, (3, 3, 3), **kwargs) as store:
+            assert store.num_written == 0
+            store.write(2, np.ones((3, 3, 3)))
+    with ResultStore.open_or_create(path, 5, (3, 3, 3), key='settings', dtype='float16') as store:
+        assert store.num_written == 0
+
+
+def test_units_are_written_only_once_their_image_is_saved(tmp_path):
+    path = str(tmp_path / 'conv1.store')
+    img_dir = tmp_path / 'conv1'
+    result = np.full((3, 3, 3), 0.5)
+    # img_dir does not exist, so no image is saved, and no unit is written
+    with pytest.raises(RuntimeError):
+        with ResultStore.create(path, 4, (3, 3, 3), chunk_size=2) as store, ImageWriter() as writer:
+            for unit_index in range(4):
+                writer.write(str(img_dir / f"{unit_index}.png"), result,
+                             on_saved=functools.partial(store.write, unit_index, result))
+    assert ResultStore(path).num_written == 0
+
+    img_dir.mkdir()
+    with ResultStore(path, mode='r+') as store, ImageWriter() as writer:
+        for unit_index in range(4):
+            writer.write(str(img_dir / f"{unit_index}.png"), result,
+                         on_saved=functools.partial(store.write, unit_index, result))
+    store = ResultStore(path)
+    assert store.num_written == 4
+    assert np.array_equal(store[:], np.full((4, 3, 3, 3), 0.5, dtype=np.float32))